@@ -1,4 +1,5 @@
 import logging
+from threading import RLock
 import unittest
 from pymongo import MongoClient
 import pymongo
@@ -6,6 +7,7 @@ from pymongo.collection import Collection
 from pymongo.database import Database
 from pymongo.errors import OperationFailure
 from api.config import Configuration
+from api.core.utility import getEpochMs
 
 __author__ = 'Michael Pryor'
 
@@ -13,6 +15,26 @@ logger = logging.getLogger(__name__)
 client = None
 database = None
 
+# Workloads which can be given their own connection pool, timeouts, write concern and read preference,
+# so that for example a long bulk download cannot use up the connections tweets are written with.
+WORKLOAD_INTERACTIVE = 'interactive' # web pages and everything not listed below.
+WORKLOAD_INGEST = 'ingest' # writing tweets, users, counts and temporal data.
+WORKLOAD_GEOCODE = 'geocode' # geocode cache.
+WORKLOAD_EXPORT = 'export' # bulk downloads.
+
+# Workload -> MongoClient and Database, other than WORKLOAD_INTERACTIVE which uses client and database.
+workloadClients = dict()
+workloadDatabases = dict()
+
+# Held while building clients so that threads connecting at the same time don't each build one.
+connectionLock = RLock()
+
+# Before pymongo 3 keyword arguments of MongoClient used a different name for pool size.
+if pymongo.version_tuple[0] < 3:
+    MONGO_CLIENT_POOL_SIZE_OPTION = 'max_pool_size'
+else:
+    MONGO_CLIENT_POOL_SIZE_OPTION = 'maxPoolSize'
+
 def _initializeUsePower2(collectionName):
     # I commented this out in case it was causing instability in MongoDB.
     pass
@@ -22,46 +44,159 @@ def _initializeUsePower2(collectionName):
     #except OperationFailure as e:
     #    logger.warn('Failed to set usePowerOf2Sizes: %s' % e.message)
 
-def getDatabase():
+def _getWorkloadSetting(settings, workload, default):
+    value = settings.get(workload, None)
+    if value is None:
+        return default
+
+    return value
+
+def _buildClient(workload):
+    # Disabling write concern might be a good idea, but could cause problems.. need to experiment.
+    if Configuration.MONGO_WRITE_CONCERN_ENABLED:
+        writeConcern = 1
+    else:
+        writeConcern = 0
+
+    options = {'socketTimeoutMS' : Configuration.MONGO_OPERATION_TIMEOUT,
+               'connectTimeoutMS' : Configuration.MONGO_CONNECTION_TIMEOUT,
+               'w' : writeConcern}
+
+    if workload is not None:
+        options['socketTimeoutMS'] = int(_getWorkloadSetting(Configuration.MONGO_WORKLOAD_OPERATION_TIMEOUT, workload, options['socketTimeoutMS']))
+        options['w'] = int(_getWorkloadSetting(Configuration.MONGO_WORKLOAD_WRITE_CONCERN, workload, options['w']))
+
+        poolSize = _getWorkloadSetting(Configuration.MONGO_WORKLOAD_POOL_SIZE, workload, None)
+        if poolSize is not None:
+            options[MONGO_CLIENT_POOL_SIZE_OPTION] = int(poolSize)
+
+        readPreference = _getWorkloadSetting(Configuration.MONGO_WORKLOAD_READ_PREFERENCE, workload, None)
+        if readPreference is not None:
+            options['readPreference'] = readPreference
+
+    logger.info('Initializing mongo db connection: %s, %s, workload: %s, options: %s' % (Configuration.MONGO_DB_IP, Configuration.MONGO_DB_PORT, workload, unicode(options)))
+    return MongoClient(Configuration.MONGO_DB_IP, Configuration.MONGO_DB_PORT, **options)
+
+def _buildDatabase(theClient):
+    db = theClient.__getattr__(Configuration.MONGO_DB_DATABASE_NAME)
+
+    if Configuration.MONGO_DB_DATABASE_AUTHENTICATION_ENABLED:
+        username = Configuration.MONGO_DB_DATABASE_AUTHENTICATION_USER_NAME
+        password = Configuration.MONGO_DB_DATABASE_AUTHENTICATION_PASSWORD
+        db.authenticate(username, password)
+
+    return db
+
+def _getWorkloadDatabase(workload):
+    db = workloadDatabases.get(workload, None)
+    if db is not None:
+        return db
+
+    with connectionLock:
+        db = workloadDatabases.get(workload, None)
+        if db is None:
+            workloadClient = workloadClients.get(workload, None)
+            if workloadClient is None:
+                workloadClient = _buildClient(workload)
+                workloadClients[workload] = workloadClient
+
+            db = _buildDatabase(workloadClient)
+            workloadDatabases[workload] = db
+
+    return db
+
+def resetConnections():
+    """ Forgets all connections, use this in child processes which cannot share the parent's connections. """
     global client
     global database
 
-    if client is None:
-        logger.info('Initializing mongo db connection: %s, %s' % (Configuration.MONGO_DB_IP, Configuration.MONGO_DB_PORT))
+    client = None
+    database = None
+    workloadClients.clear()
+    workloadDatabases.clear()
 
-        # Disabling write concern might be a good idea, but could cause problems.. need to experiment.
-        if Configuration.MONGO_WRITE_CONCERN_ENABLED:
-            writeConcern = 1
-        else:
-            writeConcern = 0
+def getDatabase(workload=None):
+    """ @param workload one of the WORKLOAD_ constants, only used if MONGO_WORKLOAD_CLIENTS_ENABLED is set.
+                        WORKLOAD_INTERACTIVE if None. """
+    global client
+    global database
 
-        client = MongoClient(Configuration.MONGO_DB_IP, Configuration.MONGO_DB_PORT, w=writeConcern, socketTimeoutMS=Configuration.MONGO_OPERATION_TIMEOUT, connectTimeoutMS=Configuration.MONGO_CONNECTION_TIMEOUT)
+    if workload is not None and workload != WORKLOAD_INTERACTIVE and Configuration.MONGO_WORKLOAD_CLIENTS_ENABLED:
+        return _getWorkloadDatabase(workload)
 
-    if database is None:
-        database = client.__getattr__(Configuration.MONGO_DB_DATABASE_NAME)
+    if database is not None:
+        return database
 
-        if Configuration.MONGO_DB_DATABASE_AUTHENTICATION_ENABLED:
-            username = Configuration.MONGO_DB_DATABASE_AUTHENTICATION_USER_NAME
-            password = Configuration.MONGO_DB_DATABASE_AUTHENTICATION_PASSWORD
-            database.authenticate(username, password)
+    with connectionLock:
+        if client is None:
+            if Configuration.MONGO_WORKLOAD_CLIENTS_ENABLED:
+                client = _buildClient(WORKLOAD_INTERACTIVE)
+            else:
+                client = _buildClient(None)
 
-        if Configuration.ENABLE_MONGO_PROFILING is True:
-            database.set_profiling_level(pymongo.OFF)
-            logger.info('Erasing old MongoDB profiling data..')
-            getDatabase().system.profile.drop()
+        if database is None:
+            database = _buildDatabase(client)
 
-            logger.info('Enabling MongoDB profiling..')
-            database.set_profiling_level(Configuration.MONGO_PROFILING_LEVEL)
+            if Configuration.ENABLE_MONGO_PROFILING is True:
+                database.set_profiling_level(pymongo.OFF)
+                logger.info('Erasing old MongoDB profiling data..')
+                getDatabase().system.profile.drop()
+
+                logger.info('Enabling MongoDB profiling..')
+                database.set_profiling_level(Configuration.MONGO_PROFILING_LEVEL)
 
     return database
 
-def getCollection(collectionName):
-    db = getDatabase()
+def getCollection(collectionName, workload=None):
+    db = getDatabase(workload)
     return getattr(db,collectionName)
 
 def getCollections():
     return getDatabase().collection_names()
 
+# Collection name prefix -> list of (keys, options) tuples.
+# Indexes are created once when a collection is first initialized,
+# not on every write.
+collectionIndexes = dict()
+
+def registerCollectionIndex(collectionPrefix, keys, **options):
+    collectionIndexes.setdefault(collectionPrefix, []).append((keys, options))
+
+def getCollectionIndexes(collectionName):
+    result = []
+    for collectionPrefix, indexes in collectionIndexes.iteritems():
+        if collectionName.startswith(collectionPrefix):
+            result += indexes
+    return result
+
+def createCollectionIndexes(collectionName, background=None):
+    """ Creates all registered indexes of a collection.
+        @return number of indexes created. """
+    if background is None:
+        background = Configuration.MONGO_BUILD_INDEXES_IN_BACKGROUND
+
+    indexes = getCollectionIndexes(collectionName)
+    if len(indexes) == 0:
+        return 0
+
+    collection = getCollection(collectionName)
+    timer = getEpochMs()
+
+    for keys, options in indexes:
+        collection.create_index(keys, background=background, **options)
+
+    logger.info('Created %d indexes on collection %s in %dms (background: %s)' % (len(indexes), collectionName, getEpochMs() - timer, background))
+    return len(indexes)
+
+def createAllCollectionIndexes(background=None):
+    """ Creates registered indexes on all existing collections.
+        @return number of collections which were indexed. """
+    count = 0
+    for collectionName in getCollections():
+        if createCollectionIndexes(collectionName, background) > 0:
+            count += 1
+    return count
+
 class testMongo(unittest.TestCase):
     def testDatabase(self):
         myData = {'_id' : '1', 'text' : 'hello world', 'myList' : [1,2,3,4]}
@@ -0,0 +1,186 @@
+import json
+import logging
+import unittest
+import zlib
+from bson.binary import Binary
+from api.config import Configuration
+
+__author__ = 'Michael Pryor'
+
+logger = logging.getLogger(__name__)
+
+# Tweet and user documents store the JSON received from Twitter in 'data', most of which
+# we never read. A storage schema keeps only the listed fields in 'data', the rest
+# is compressed into 'data_z' which is only read when the whole JSON is needed.
+#
+# Documents without 'data_z' hold all their JSON in 'data', either because they were written
+# before compact storage was enabled or nothing was left over, and are read as they are.
+
+COMPRESSED_DATA_FIELD = 'data_z'
+
+def _buildFieldTree(fields):
+    """ @param fields paths of fields to keep, nested fields separated by '.'.
+        @return dictionary of field name to dictionary of nested fields to keep,
+                or True to keep whole field. """
+    tree = dict()
+    for field in fields:
+        node = tree
+        path = field.split('.')
+        for name in path[:-1]:
+            child = node.get(name,None)
+            if child is True:
+                break
+
+            if child is None:
+                child = dict()
+                node[name] = child
+
+            node = child
+        else:
+            node[path[-1]] = True
+
+    return tree
+
+def _splitData(data, fieldTree):
+    """ @return kept fields and remaining fields. """
+    kept = dict()
+    remainder = dict()
+
+    for key, value in data.iteritems():
+        subTree = fieldTree.get(key,None)
+        if subTree is None:
+            remainder[key] = value
+        elif subTree is True or not isinstance(value, dict):
+            kept[key] = value
+        else:
+            keptValue, remainderValue = _splitData(value, subTree)
+            kept[key] = keptValue
+
+            if len(remainderValue) > 0:
+                remainder[key] = remainderValue
+
+    return kept, remainder
+
+def _mergeData(data, remainder):
+    for key, value in remainder.iteritems():
+        existing = data.get(key,None)
+        if isinstance(existing, dict) and isinstance(value, dict):
+            _mergeData(existing, value)
+        else:
+            data[key] = value
+
+def expandData(data, compressedData):
+    """ @return whole JSON of document from its 'data' and 'data_z' fields. """
+    if compressedData is None:
+        return data
+
+    remainder = json.loads(zlib.decompress(compressedData))
+
+    if data is None:
+        return remainder
+
+    _mergeData(data, remainder)
+    return data
+
+def expandDocument(document):
+    """ Moves the contents of 'data_z' back into 'data' if it was read. """
+    if document is None:
+        return None
+
+    compressedData = document.pop(COMPRESSED_DATA_FIELD, None)
+    if compressedData is not None:
+        document['data'] = expandData(document.get('data',None), compressedData)
+
+    return document
+
+
+class StorageSchema(object):
+    def __init__(self, fields, keepRemainder=True, compressionLevel=6):
+        """ @param fields paths of fields stored in 'data', nested fields separated by '.'.
+            @param keepRemainder if false fields not in the schema are discarded instead of compressed. """
+        super(StorageSchema,self).__init__()
+
+        self.field_tree = _buildFieldTree(fields)
+        self.keep_remainder = keepRemainder
+        self.compression_level = compressionLevel
+
+    def compact(self, data):
+        """ @return data to store in 'data' and 'data_z', 'data_z' is None if there is nothing to compress. """
+        if data is None:
+            return None, None
+
+        kept, remainder = _splitData(data, self.field_tree)
+
+        if not self.keep_remainder or len(remainder) == 0:
+            return kept, None
+
+        compressedData = zlib.compress(json.dumps(remainder, separators=(',',':')), self.compression_level)
+        return kept, Binary(compressedData)
+
+def _buildStorageSchema(fields):
+    if not Configuration.COMPACT_STORAGE_ENABLED:
+        return None
+
+    return StorageSchema(fields, Configuration.COMPACT_STORAGE_KEEP_REMAINDER, Configuration.COMPACT_STORAGE_COMPRESSION_LEVEL)
+
+# None when compact storage is disabled.
+tweetStorageSchema = _buildStorageSchema(Configuration.COMPACT_STORAGE_TWEET_FIELDS)
+userStorageSchema = _buildStorageSchema(Configuration.COMPACT_STORAGE_USER_FIELDS)
+
+def compactCollection(collection, schema, batchSize=500):
+    """ Converts documents of collection written before compact storage was enabled.
+        @return number of documents converted. """
+    assert isinstance(schema, StorageSchema)
+
+    count = 0
+    batch = collection.initialize_unordered_bulk_op()
+    batchCount = 0
+
+    cursor = collection.find({COMPRESSED_DATA_FIELD : {'$exists' : False}, 'data' : {'$ne' : None}}, {'data' : True})
+    for document in cursor:
+        data, compressedData = schema.compact(document['data'])
+        if compressedData is None and data == document['data']:
+            continue
+
+        update = {'data' : data}
+        if compressedData is not None:
+            update[COMPRESSED_DATA_FIELD] = compressedData
+
+        batch.find({'_id' : document['_id']}).update_one({'$set' : update})
+        batchCount += 1
+        count += 1
+
+        if batchCount >= batchSize:
+            batch.execute()
+            batch = collection.initialize_unordered_bulk_op()
+            batchCount = 0
+
+    if batchCount > 0:
+        batch.execute()
+
+    logger.info('Compacted %d documents of collection %s' % (count, collection.name))
+    return count
+
+
+class testCompactStorage(unittest.TestCase):
+    def testCompactExpand(self):
+        schema = StorageSchema(['id', 'user.id', 'user.name', 'place', 'missing.field'])
+
+        data = {'id' : 5,
+                'text' : u'hello \xe9',
+                'place' : {'full_name' : 'London'},
+                'user' : {'id' : 7, 'name' : 'bob', 'lang' : 'en', 'entities' : {'url' : None}},
+                'entities' : {'hashtags' : [1, 2]}}
+
+        kept, compressedData = schema.compact(data)
+        assert kept == {'id' : 5, 'place' : {'full_name' : 'London'}, 'user' : {'id' : 7, 'name' : 'bob'}}
+        assert compressedData is not None
+
+        document = {'data' : kept, COMPRESSED_DATA_FIELD : compressedData}
+        assert expandDocument(document)['data'] == data
+        assert COMPRESSED_DATA_FIELD not in document
+
+        # Old documents and documents with nothing left over.
+        assert expandDocument({'data' : {'id' : 5}})['data'] == {'id' : 5}
+        assert schema.compact({'id' : 5}) == ({'id' : 5}, None)
+        assert StorageSchema(['id'], keepRemainder=False).compact(data) == ({'id' : 5}, None)
@@ -1,4 +1,5 @@
 import logging
+from threading import Lock
 from pymongo.errors import DuplicateKeyError
 from api.caching.caching_shared import getDatabase
 
@@ -26,6 +27,59 @@ def removeInstance(instanceKey):
 def setInstanceTemporalSourceLastTime(instanceKey, sourceProviderId, sourcePlaceId, lastTimeId):
     getInstanceLifetimeCollection().update({'_id' : {'instance_key' : instanceKey}}, {'$set' : {'temporal_last_time_id.%s.%s' % (sourceProviderId,sourcePlaceId) : lastTimeId}})
 
+def setInstanceTemporalSourceLastTimes(instanceKey, lastTimeIdBySource):
+    """ @param lastTimeIdBySource (source provider ID, source place ID) -> last time ID, all written with one update. """
+    setQuery = dict()
+    for (sourceProviderId, sourcePlaceId), lastTimeId in lastTimeIdBySource.iteritems():
+        setQuery['temporal_last_time_id.%s.%s' % (sourceProviderId,sourcePlaceId)] = lastTimeId
+
+    if len(setQuery) == 0:
+        return
+
+    getInstanceLifetimeCollection().update({'_id' : {'instance_key' : instanceKey}}, {'$set' : setQuery})
+
+
+class TemporalSourceLastTimeCheckpoints(object):
+    """ Keeps the last time ID of temporal sources in memory and writes those which
+        have changed when flushed, with one update per instance.
+
+        Checkpoints in the database can be behind by up to one flush period,
+        so they are reconciled with temporal data when instances are loaded. """
+
+    def __init__(self):
+        super(TemporalSourceLastTimeCheckpoints,self).__init__()
+
+        # instance key -> (source provider ID, source place ID) -> last time ID, not yet written.
+        self._dirty = dict()
+        self._lock = Lock()
+
+    def set(self, instanceKey, sourceProviderId, sourcePlaceId, lastTimeId):
+        with self._lock:
+            self._dirty.setdefault(instanceKey, dict())[(sourceProviderId, sourcePlaceId)] = lastTimeId
+
+    def flush(self):
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = dict()
+
+        for instanceKey, lastTimeIdBySource in dirty.iteritems():
+            try:
+                setInstanceTemporalSourceLastTimes(instanceKey, lastTimeIdBySource)
+            except Exception as e:
+                logger.error('Failed to write %d temporal checkpoints of instance %s: %s' % (len(lastTimeIdBySource), instanceKey, e))
+
+                # Retry next flush unless a later time has been set since.
+                with self._lock:
+                    pending = self._dirty.setdefault(instanceKey, dict())
+                    for source, lastTimeId in lastTimeIdBySource.iteritems():
+                        pending.setdefault(source, lastTimeId)
+
+    def discardInstance(self, instanceKey):
+        with self._lock:
+            self._dirty.pop(instanceKey, None)
+
+temporalSourceLastTimeCheckpoints = TemporalSourceLastTimeCheckpoints()
+
 def getInstances(onInstanceDataFunc):
     cursor = getInstanceLifetimeCollection().find()
     for item in cursor:
@@ -0,0 +1,285 @@
+import json
+import logging
+import unittest
+from api.caching.caching_shared import getDatabase
+from api.caching.tweet_user import getTweetQueryHint, getUserQueryHint
+
+__author__ = 'Michael Pryor'
+
+logger = logging.getLogger(__name__)
+
+# Summarises operations logged by MongoDB profiling (see ENABLE_MONGO_PROFILING), offline.
+#
+# Operations are grouped by collection family and query shape, the shape being the query with
+# values removed. Queries of tweets and users are checked against the index cursorItemsFromCache
+# hints, because when the hint is missing or MongoDB picks another plan those queries
+# examine far more documents than they return.
+
+COLLECTION_FAMILIES = ['user_', 'tweet_', 'influence_', 'count_']
+
+def getCollectionFamily(namespace):
+    """ @param namespace database and collection name separated by '.' as logged by profiling. """
+    collectionName = namespace.split('.', 1)[-1]
+
+    for prefix in COLLECTION_FAMILIES:
+        if collectionName.startswith(prefix):
+            return prefix + '*'
+
+    return collectionName
+
+def getQueryShape(query):
+    """ @return query with values replaced by 1, keeping field names and operators. """
+    if isinstance(query, dict):
+        return dict([(key, getQueryShape(value)) for key, value in query.iteritems()])
+
+    if isinstance(query, (list, tuple)):
+        # Lists of values ($in) have the same shape whatever their length, lists of queries ($or) do not.
+        shapes = []
+        for item in query:
+            shape = getQueryShape(item)
+            if shape not in shapes:
+                shapes.append(shape)
+
+        return shapes
+
+    return 1
+
+def _formatShape(shape):
+    if shape is None:
+        return '-'
+
+    return json.dumps(shape, sort_keys=True, separators=(',',':'))
+
+def _parseQuery(item):
+    """ Profiling logs queries differently depending on MongoDB version.
+        @return filter, hint and sort of operation. """
+    query = item.get('query', None)
+    if query is None:
+        query = item.get('command', None)
+        if query is None:
+            return None, None, None
+
+    if 'filter' in query:
+        return query.get('filter'), query.get('hint', None), query.get('sort', None)
+
+    if '$query' in query:
+        return query.get('$query'), query.get('$hint', None), query.get('$orderby', None)
+
+    if item.get('op', None) == 'command':
+        # Only the name of the command is interesting.
+        return dict([(x, 1) for x in query.keys()[:1]]), None, None
+
+    return query, None, None
+
+def _getFieldNames(query, result=None):
+    """ @return names of fields used by query, including those inside $and and $or. """
+    if result is None:
+        result = set()
+
+    if isinstance(query, dict):
+        for key, value in query.iteritems():
+            if key.startswith('$'):
+                if isinstance(value, list):
+                    for subQuery in value:
+                        _getFieldNames(subQuery, result)
+            else:
+                result.add(key)
+
+    return result
+
+def _formatIndex(index):
+    """ Formats an index like MongoDB plan summaries do, i.e. { timestamp: 1 }. """
+    if index is None:
+        return None
+
+    if isinstance(index, dict):
+        index = index.items()
+
+    if len(index) == 0:
+        return None
+
+    def formatDirection(direction):
+        if isinstance(direction, float):
+            return int(direction)
+        return direction
+
+    return '{ %s }' % ', '.join(['%s: %s' % (key, formatDirection(direction)) for key, direction in index])
+
+def getExpectedHints(family, query, sort):
+    """ @return formatted indexes which cursorItemsFromCache could hint for query, empty if it gives no hint. """
+    fields = _getFieldNames(query)
+    usesPlaceField = 'geocode.placeId' in fields
+
+    if family == 'tweet_*':
+        hints = [getTweetQueryHint('timestamp' in fields, usesPlaceField)]
+    elif family == 'user_*':
+        usesFolloweeField = 'known_followees' in fields
+        usesFollowersLoadedField = 'is_followers_loaded' in fields
+
+        # Users are sorted by timestamp even when timestamp is not asked for, in which case it is not hinted.
+        usesTimestampOptions = ['timestamp' in fields]
+        if sort is not None and 'timestamp' in sort and 'timestamp' not in fields:
+            usesTimestampOptions.append(True)
+
+        hints = [getUserQueryHint(usesFolloweeField, usesPlaceField, usesFollowersLoadedField, x) for x in usesTimestampOptions]
+    else:
+        return []
+
+    return [x for x in set([_formatIndex(hint) for hint in hints]) if x is not None]
+
+def _getPercentile(sortedValues, percentile):
+    if len(sortedValues) == 0:
+        return 0
+
+    index = int(round(percentile / 100.0 * (len(sortedValues) - 1)))
+    return sortedValues[index]
+
+
+class QueryShapeStatistics(object):
+    def __init__(self, family, operation, shape):
+        super(QueryShapeStatistics,self).__init__()
+
+        self.family = family
+        self.operation = operation
+        self.shape = shape
+
+        self.millis = []
+        self.docs_examined = 0
+        self.docs_returned = 0
+
+        self.num_collection_scans = 0
+
+        # Operations not using the index cursorItemsFromCache hints.
+        self.num_not_hinted = 0
+        self.expected_hints = []
+        self.plans = set()
+
+    def add(self, item, hint, expectedHints):
+        self.millis.append(item.get('millis', 0))
+
+        docsExamined = item.get('docsExamined', item.get('nscanned', None))
+        if docsExamined is not None:
+            self.docs_examined += docsExamined
+
+        self.docs_returned += item.get('nreturned', item.get('nMatched', 0))
+
+        planSummary = item.get('planSummary', None)
+        if planSummary is not None:
+            self.plans.add(planSummary)
+            if 'COLLSCAN' in planSummary:
+                self.num_collection_scans += 1
+
+        self.expected_hints = expectedHints
+        if len(expectedHints) > 0:
+            usedIndex = _formatIndex(hint)
+            if planSummary is not None:
+                isHinted = any([('IXSCAN ' + x) in planSummary for x in expectedHints])
+            else:
+                isHinted = usedIndex in expectedHints
+
+            if not isHinted:
+                self.num_not_hinted += 1
+
+    @property
+    def count(self):
+        return len(self.millis)
+
+    @property
+    def total_millis(self):
+        return sum(self.millis)
+
+    def getPercentile(self, percentile):
+        return _getPercentile(sorted(self.millis), percentile)
+
+    @property
+    def max_millis(self):
+        return max(self.millis)
+
+    @property
+    def docs_examined_ratio(self):
+        """ Documents examined per document returned, high values mean an index is missing or not used. """
+        return float(self.docs_examined) / max(self.docs_returned, 1)
+
+
+def buildProfilingReport(profileItems):
+    """ @param profileItems documents of system.profile collection.
+        @return list of QueryShapeStatistics, most total time first. """
+    statistics = dict()
+
+    for item in profileItems:
+        namespace = item.get('ns', None)
+        if namespace is None:
+            continue
+
+        family = getCollectionFamily(namespace)
+        operation = item.get('op', None)
+        query, hint, sort = _parseQuery(item)
+
+        shape = _formatShape(getQueryShape(query) if query is not None else None)
+        if sort is not None:
+            shape += ' sort ' + _formatShape(getQueryShape(sort))
+
+        key = (family, operation, shape)
+        shapeStatistics = statistics.get(key)
+        if shapeStatistics is None:
+            shapeStatistics = QueryShapeStatistics(family, operation, shape)
+            statistics[key] = shapeStatistics
+
+        if operation in ('query', 'getmore'):
+            expectedHints = getExpectedHints(family, query, sort)
+        else:
+            expectedHints = []
+
+        shapeStatistics.add(item, hint, expectedHints)
+
+    return sorted(statistics.itervalues(), key=lambda x: x.total_millis, reverse=True)
+
+def formatProfilingReport(report):
+    """ @return lines of text describing report. """
+    lines = []
+    for shapeStatistics in report:
+        lines.append('%s %s %s' % (shapeStatistics.family, shapeStatistics.operation, shapeStatistics.shape))
+        lines.append('    count: %d, p50: %dms, p95: %dms, max: %dms, total: %dms, examined per returned: %.1f' % (shapeStatistics.count,
+                                                                                                                 shapeStatistics.getPercentile(50),
+                                                                                                                 shapeStatistics.getPercentile(95),
+                                                                                                                 shapeStatistics.max_millis,
+                                                                                                                 shapeStatistics.total_millis,
+                                                                                                                 shapeStatistics.docs_examined_ratio))
+        if len(shapeStatistics.plans) > 0:
+            lines.append('    plans: %s' % ', '.join(sorted(shapeStatistics.plans)))
+
+        if shapeStatistics.num_collection_scans > 0:
+            lines.append('    WARNING: %d collection scans' % shapeStatistics.num_collection_scans)
+
+        if shapeStatistics.num_not_hinted > 0:
+            lines.append('    WARNING: %d operations not using expected index %s' % (shapeStatistics.num_not_hinted, ' or '.join(shapeStatistics.expected_hints)))
+
+    return lines
+
+def readProfilingReport(minimumMillis=0):
+    """ @return report of operations logged by profiling which took longer than minimumMillis. """
+    return buildProfilingReport(getDatabase().system.profile.find({'millis' : {'$gte' : minimumMillis}}))
+
+
+class testProfilingReport(unittest.TestCase):
+    def testBuildReport(self):
+        hinted = {'op' : 'query', 'ns' : 'db.tweet_abc', 'millis' : 10, 'nscanned' : 5, 'nreturned' : 5,
+                  'query' : {'$query' : {'timestamp' : {'$gte' : 5, '$lt' : 10}}, '$orderby' : {'timestamp' : 1}, '$hint' : [('timestamp', 1)]}}
+        unhinted = {'op' : 'query', 'ns' : 'db.tweet_def', 'millis' : 30, 'docsExamined' : 100, 'nreturned' : 5, 'planSummary' : 'COLLSCAN',
+                    'query' : {'find' : 'tweet_def', 'filter' : {'timestamp' : {'$gte' : 7, '$lt' : 8}}, 'sort' : {'timestamp' : 1}}}
+        place = {'op' : 'query', 'ns' : 'db.place', 'millis' : 1, 'query' : {'_id' : {'$in' : [1, 2, 3]}}}
+
+        report = buildProfilingReport([hinted, unhinted, place])
+        assert len(report) == 2
+
+        tweets = report[0]
+        assert tweets.family == 'tweet_*'
+        assert tweets.shape == '{"timestamp":{"$gte":1,"$lt":1}} sort {"timestamp":1}'
+        assert tweets.count == 2
+        assert tweets.max_millis == 30
+        assert tweets.docs_examined_ratio == 10.5
+        assert tweets.num_collection_scans == 1
+        assert tweets.num_not_hinted == 1
+
+        assert report[1].shape == '{"_id":{"$in":[1]}}'
+        assert report[1].num_not_hinted == 0
@@ -2,9 +2,12 @@
     was chosen because it means we can do fast lookups when merging data. If we have a list of tuples we need to iterate over both
     the source and destination in full with every merge so writes would become very expensive. However, this has the drawback
     that on reading it is more expensive to order the data by count since we first have to convert it into a list. """
+import copy
 import logging
+from threading import RLock
 import time
-from api.caching.caching_shared import getCollection, getDatabase, _initializeUsePower2
+import unittest
+from api.caching.caching_shared import getCollection, getDatabase, _initializeUsePower2, registerCollectionIndex, createCollectionIndexes
 from api.config import Configuration
 from api.core.utility import getEpochMs, upperPowerTwo, Timer
 __author__ = 'Michael Pryor'
@@ -16,17 +19,24 @@ logger = logging.getLogger(__name__)
 indexOneEnabled = True
 indexTwoEnabled = False
 
+if indexOneEnabled:
+    registerCollectionIndex('influence_', [('_id.source',1),('_id.time',-1),('_id.length',-1)])
+
+if indexTwoEnabled:
+    registerCollectionIndex('influence_', [('_id.source',1),('_id.length',-1),('_id.time',-1)])
+
 def _initCollection(collectionName):
     logger.info('Initializing collection: %s' % collectionName)
     _initializeUsePower2(collectionName)
+    createCollectionIndexes(collectionName)
 
 initializedTemporalInfluenceCollections = set()
 
-def getTemporalInfluenceCollection(instanceId):
+def getTemporalInfluenceCollection(instanceId, workload=None):
     global initializedTemporalInfluenceCollections
 
     collectionName = 'influence_%s' % unicode(instanceId)
-    r = getCollection(collectionName)
+    r = getCollection(collectionName, workload)
 
     if collectionName not in initializedTemporalInfluenceCollections:
         _initCollection(collectionName)
@@ -34,6 +44,11 @@ def getTemporalInfluenceCollection(instanceId):
 
     return r
 
+def dropTemporalInfluenceCollection(instanceId):
+    collectionName = 'influence_%s' % unicode(instanceId)
+    initializedTemporalInfluenceCollections.discard(collectionName)
+    getCollection(collectionName).drop()
+
 def isTemporalInfluenceCollection(collectionName):
     return collectionName.startswith('influence_')
 
@@ -54,36 +69,123 @@ def addTemporalEntry(collection, lastTimeId, timeId, source, destination, destin
     update = {destinationProviderId : {destination : 1}}
     leafTemporalEntry(collection, timeId, 1, source, update, True)
 
-def getTemporalRange(collection, timeIdStart, timeIdEnd, source, combineWith=None, preciseFromBack=True, preciseFromFront=True):
-    if timeIdEnd < timeIdStart:
-        timeIdEnd = timeIdStart
+def getTemporalRangeCover(timeIdStart, timeIdEnd, preciseFromBack=True, preciseFromFront=True):
+    """ Chooses the nodes to combine to cover the time range (timeIdStart, timeIdEnd], making
+        the same choices as searching backwards from the end of the range if every node exists.
+
+        A node (time, length) covers (time - length, time], and is built by
+        branchTemporalEntryForwards for every time which is a multiple of its length.
+        @return list of (time, length), latest first. """
+    result = list()
+    currentEnd = timeIdEnd
+    while currentEnd > timeIdStart:
+        timeRange = currentEnd - timeIdStart
+
+        # This speeds things up by allowing us to over estimate. We avoid
+        # going through smaller nodes to calculate the precise value.
+        if not preciseFromBack:
+            timeRange = upperPowerTwo(timeRange)
+
+        length = upperPowerTwo(timeRange)
+        if length > timeRange:
+            length /= 2
+
+        if preciseFromFront:
+            # We prioritise time over length.
+            while currentEnd % length != 0:
+                length /= 2
+            time = currentEnd
+        else:
+            # We prioritise the larger length but may get a less accurate time.
+            while currentEnd - (currentEnd % length) <= timeIdStart:
+                length /= 2
+            time = currentEnd - (currentEnd % length)
+
+        result.append((time, length))
+        currentEnd = time - length
 
-    timeRange = timeIdEnd - timeIdStart
+    return result
 
-    # This speeds things up by allowing us to over estimate. We avoid
-    # going through smaller nodes to calculate the precise value.
-    if not preciseFromBack:
-        timeRange = upperPowerTwo(timeRange)
+def _getLatestTemporalLeafTime(collection, timeIdStart, timeIdEnd, source):
+    """ @return time of the latest leaf in (timeIdStart, timeIdEnd], None if there isn't one. """
+    global indexOneEnabled
+    assert indexOneEnabled # need to maintain optimum performance
 
-    value = getTemporalEntryLongestLength(collection, timeIdStart, timeIdEnd, source, timeRange, preciseFromFront)
-    if value is None:
+    cursor = collection.find({'_id.source' : source,
+                              '_id.time' : {'$gt' : timeIdStart, '$lte' : timeIdEnd},
+                              '_id.length' : 1},
+                             {'_id' : True}).sort([('_id.time',-1),('_id.length',-1)]).limit(1)
+
+    if Configuration.MONGO_EXPLAINS_ENABLED:
+        logger.critical('Influence Explain: %s' % unicode(cursor.explain()))
+
+    for item in cursor:
+        return item['_id']['time']
+
+    return None
+
+def getTemporalRange(collection, timeIdStart, timeIdEnd, source, combineWith=None, preciseFromBack=True, preciseFromFront=True):
+    """ Combines all data of source in the time range (timeIdStart, timeIdEnd].
+
+        Uses two queries, one for the latest leaf in the range and one for the nodes covering the range.
+        Nodes containing the latest leaf are only built when the next time step is written, see
+        branchTemporalEntryForwards, so the range is covered by that leaf and the nodes before it.
+        Nodes before it which do not exist have no data.
+        @return combined data or None if there is no data. """
+    timer = getEpochMs()
+
+    latestLeafTime = _getLatestTemporalLeafTime(collection, timeIdStart, timeIdEnd, source)
+    if latestLeafTime is None:
+        logger.info('Reading temporal data TS:%d, TE:%d, S:%s: no data, %dms' % (timeIdStart, timeIdEnd, source, getEpochMs() - timer))
         return None
 
-    currentTimeLength = value['_id']['length']
-    currentTime = value['_id']['time']
+    cover = [(latestLeafTime, 1)] + getTemporalRangeCover(timeIdStart, latestLeafTime - 1, preciseFromBack, preciseFromFront)
+
+    cursor = collection.find({'_id' : {'$in' : [_buildTemporalEntryId(time, length, source)['_id'] for time, length in cover]}})
+
+    if Configuration.MONGO_EXPLAINS_ENABLED:
+        logger.critical('Influence Explain: %s' % unicode(cursor.explain()))
 
     if combineWith is None:
         combineWith = dict()
 
-    mergeCacheData(value['destination'], combineWith)
-
-    nextTime = currentTime - currentTimeLength
-    if timeIdEnd > nextTime > timeIdStart:
-        getTemporalRange(collection, timeIdStart, nextTime, source, combineWith, preciseFromBack, preciseFromFront)
+    numNodes = 0
+    for item in cursor:
+        mergeCacheData(item.get('destination', dict()), combineWith)
+        numNodes += 1
 
+    logger.info('Reading temporal data TS:%d, TE:%d, S:%s: %d nodes used of %d, %dms' % (timeIdStart, timeIdEnd, source, numNodes, len(cover), getEpochMs() - timer))
     return combineWith
 
 
+def reconcileTemporalSourceLastTimes(collection, lastTimeIdBySource):
+    """ Checkpoints of the last time ID of each source are written periodically, so after a restart they
+        may be behind the temporal data which was written, or missing. Reading on from an old
+        time ID would overwrite merged nodes with ones missing the later data.
+
+        @param lastTimeIdBySource (source provider ID, source place ID) -> last time ID, as checkpointed.
+        @return (source provider ID, source place ID) -> latest of checkpoint and newest leaf in collection. """
+    result = dict(lastTimeIdBySource)
+
+    for source in collection.distinct('_id.source'):
+        if source is None:
+            continue
+
+        sourceKey = (source['providerId'], source['placeId'])
+        lastTimeId = result.get(sourceKey, None)
+
+        findDic = {'_id.source' : source, '_id.length' : 1}
+        if lastTimeId is not None:
+            findDic['_id.time'] = {'$gt' : lastTimeId}
+
+        newest = list(collection.find(findDic, {'_id' : True}).sort('_id.time', -1).limit(1))
+        if len(newest) > 0:
+            newestTimeId = newest[0]['_id']['time']
+            logger.info('Temporal checkpoint of source %s/%s in collection %s was behind: %s -> %d' % (sourceKey[0], sourceKey[1], collection.name, lastTimeId, newestTimeId))
+            result[sourceKey] = newestTimeId
+
+    return result
+
 def getTemporalEntry(collection, time, length, source):
     result =  collection.find_one({'_id' : {'time' : time,
                                             'length' : length,
@@ -91,69 +193,33 @@ def getTemporalEntry(collection, time, length, source):
     logger.debug('Attempting to read temporal data T:%s , L:%s , S:%s: %s' % (time, length, source, unicode(result)))
     return result
 
-def getTemporalEntryLongestLength(collection, timeStart, timeEnd, source, maxLength=None, preciseFromFront=True):
-    global indexOneEnabled
-    global indexTwoEnabled
-
-    findDic = {'_id.source' : source}
-
-    if maxLength is not None:
-        findDic.update({'_id.time' : {'$gte' : timeStart, '$lte' : timeEnd},
-                        '_id.length' : {'$lte' : maxLength}})
+def _buildTemporalEntryId(time, length, source):
+    return {'_id' : {'time' : time,
+                     'length' : length,
+                     'source' : source}}
 
-    # When dealing with tweets closest to the max length.
-    # If precise, then we prioritise time over length.
-    # If imprecise, then we will prioritise the larger length but may get a less accurate time.
-    if preciseFromFront:
-        assert indexOneEnabled # need to maintain optimum performance
-        result =  collection.find(findDic).sort([('_id.time',-1),('_id.length',-1)]).limit(1)
-    else:
-        assert indexTwoEnabled # need to maintain optimum performance
-        result =  collection.find(findDic).sort([('_id.length',-1),('_id.time',-1)]).limit(1)
+def _buildTemporalEntryUpdate(destinationsInc, increment):
+    """ @return update query or None if there is nothing to update. """
+    if destinationsInc is None:
+        return None
 
-    if Configuration.MONGO_EXPLAINS_ENABLED:
-        logger.critical('Influence Explain: %s' % unicode(result.explain()))
+    incDic = dict()
+    for providerId, providerIdData in destinationsInc.iteritems():
+        for destination, incBy in providerIdData.iteritems():
+            incDic['destination.%s.%s' % (providerId,unicode(destination))] = incBy
 
-    returnMe = None
-    for item in result:
-        returnMe = item
-        break
+    if len(incDic) == 0:
+        return None
 
-    if returnMe is None:
-        resultStr = 'None'
+    if increment:
+        return {'$inc' : incDic}
     else:
-        resultStr = '(T: %s, L: %s)' % (returnMe['_id']['time'], returnMe['_id']['length'])
-
-    logger.info('Attempting to read temporal data TS:%d, TE:%d, L: (longest, max %s), S:%s: %s' % (timeStart, timeEnd, maxLength, source, resultStr))
-    return returnMe
+        return {'$set' : incDic}
 
 def leafTemporalEntry(collection, time, length, source, destinationsInc, increment):
-    global indexOneEnabled
-    global indexTwoEnabled
-
-    if indexOneEnabled:
-        collection.ensure_index([('_id.source',1),('_id.time',-1),('_id.length',-1)])
-
-    if indexTwoEnabled:
-        collection.ensure_index([('_id.source',1),('_id.length',-1),('_id.time',-1)])
-
-    cacheId = {'_id' : {'time' : time,
-                        'length' : length,
-                        'source' : source}}
-
-    if destinationsInc is not None:
-        incDic = dict()
-        for providerId, providerIdData in destinationsInc.iteritems():
-            for destination, incBy in providerIdData.iteritems():
-                incDic['destination.%s.%s' % (providerId,unicode(destination))] = incBy
-
-        if len(incDic) > 0:
-            if increment:
-                cacheUpdate = {'$inc' : incDic}
-            else:
-                cacheUpdate = {'$set' : incDic}
-
-            collection.update(cacheId, cacheUpdate, upsert=True)
+    cacheUpdate = _buildTemporalEntryUpdate(destinationsInc, increment)
+    if cacheUpdate is not None:
+        collection.update(_buildTemporalEntryId(time, length, source), cacheUpdate, upsert=True)
 
 def mergeCacheData(mergeSource, mergeDestination):
     for level1, dataLevel1 in mergeSource.iteritems():
@@ -213,4 +279,201 @@ def branchTemporalEntryForwards(collection, time, length, source, destinationsIn
         leafTemporalEntry(collection, storeMergeResultIn, mergedLength, source, destinationsInc, False)
 
         # Recurse, in case there is more merging to be done.
-        branchTemporalEntryForwards(collection, storeMergeResultIn, mergedLength, source, destinationsInc, endTimeLimit)
\ No newline at end of file
+        branchTemporalEntryForwards(collection, storeMergeResultIn, mergedLength, source, destinationsInc, endTimeLimit)
+
+class _TemporalSourceState(object):
+    def __init__(self, collection, source, timeId, isLeafComplete):
+        super(_TemporalSourceState,self).__init__()
+
+        self.collection = collection
+        self.source = source
+        self.time_id = timeId
+
+        # All data of the current leaf, and the part of it not yet written to the database.
+        # If not complete, some of the leaf was written before we started (e.g. before a restart).
+        self.leaf = dict()
+        self.pending = dict()
+        self.is_leaf_complete = isLeafComplete
+
+        # length -> (time, destinations) of the last node created with that length.
+        # The next node of the same length merges with it, so we don't need to read it back.
+        self.nodes = dict()
+
+
+class TemporalInfluenceAggregator(object):
+    """ Accumulates temporal influence entries in memory.
+
+        Increments to the current leaf of each source are written periodically using a single $inc.
+        When a source moves to a new time step, its leaf and all merged nodes are calculated
+        in memory (like branchTemporalEntryForwards) and written in one bulk operation. """
+
+    def __init__(self):
+        super(TemporalInfluenceAggregator,self).__init__()
+
+        # (collection name, source provider ID, source place ID) -> _TemporalSourceState.
+        self._states = dict()
+        self._lock = RLock()
+
+        self._num_entries = 0
+        self._num_write_operations = 0
+        self._num_read_operations = 0
+        self._log_timer = Timer(Configuration.LOG_DROP_AMOUNT_FREQ_MS, False)
+
+    def addTemporalEntry(self, collection, lastTimeId, timeId, source, destination, destinationProviderId):
+        key = (collection.name, source['providerId'], source['placeId'])
+
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                if lastTimeId is None:
+                    state = _TemporalSourceState(collection, source, timeId, True)
+                else:
+                    state = _TemporalSourceState(collection, source, lastTimeId, False)
+
+                self._states[key] = state
+
+            if state.time_id != timeId:
+                self._rollOver(state, timeId)
+
+            # Keys must be strings so that they match data read back from the database.
+            destinationProviderId = unicode(destinationProviderId)
+            destination = unicode(destination)
+
+            update = {destinationProviderId : {destination : 1}}
+            mergeCacheData(update, state.leaf)
+            mergeCacheData(update, state.pending)
+            self._num_entries += 1
+
+    def _getNode(self, state, time, length, leafTime):
+        cached = state.nodes.get(length)
+        if cached is not None and cached[0] == time:
+            return cached[1]
+
+        # Nothing can have been written after the leaf we are rolling over.
+        if time - length >= leafTime:
+            return dict()
+
+        self._num_read_operations += 1
+        result = getTemporalEntry(state.collection, time, length, state.source)
+        if result is None:
+            return dict()
+
+        return result.get('destination', dict())
+
+    def _rollOver(self, state, newTimeId):
+        collection = state.collection
+        source = state.source
+        operations = list()
+
+        leafTime = state.time_id
+        if state.is_leaf_complete:
+            operations.append((leafTime, 1, _buildTemporalEntryUpdate(state.pending, True)))
+            destinations = state.leaf
+        else:
+            # Need the whole leaf from the database to merge it.
+            leafTemporalEntry(collection, leafTime, 1, source, state.pending, True)
+            self._num_write_operations += 1
+
+            self._num_read_operations += 1
+            result = getTemporalEntry(collection, leafTime, 1, source)
+            if result is None:
+                destinations = dict()
+            else:
+                destinations = result.get('destination', dict())
+
+        time = leafTime
+        length = 1
+        while time < newTimeId:
+            state.nodes[length] = (time, destinations)
+
+            # See branchTemporalEntryForwards.
+            mergedLength = length * 2
+            if (time / length) % 2 != 0:
+                mergeWithTime = time + length
+                storeMergeResultIn = mergeWithTime
+            else:
+                mergeWithTime = time - length
+                storeMergeResultIn = time
+
+            if mergeWithTime >= newTimeId:
+                break
+
+            mergedDestinations = copy.deepcopy(destinations)
+            mergeCacheData(self._getNode(state, mergeWithTime, length, leafTime), mergedDestinations)
+
+            operations.append((storeMergeResultIn, mergedLength, _buildTemporalEntryUpdate(mergedDestinations, False)))
+
+            time = storeMergeResultIn
+            length = mergedLength
+            destinations = mergedDestinations
+
+        operations = [x for x in operations if x[2] is not None]
+        if len(operations) > 0:
+            bulk = collection.initialize_unordered_bulk_op()
+            for operationTime, operationLength, cacheUpdate in operations:
+                bulk.find(_buildTemporalEntryId(operationTime, operationLength, source)).upsert().update_one(cacheUpdate)
+            bulk.execute()
+
+            self._num_write_operations += 1
+
+        state.time_id = newTimeId
+        state.leaf = dict()
+        state.pending = dict()
+        state.is_leaf_complete = True
+
+    def flush(self):
+        """ Writes pending increments of current leaves, one bulk operation per collection. """
+        with self._lock:
+            bulkByCollection = dict()
+            for state in self._states.itervalues():
+                cacheUpdate = _buildTemporalEntryUpdate(state.pending, True)
+                if cacheUpdate is None:
+                    continue
+
+                bulk = bulkByCollection.get(state.collection.name)
+                if bulk is None:
+                    bulk = state.collection.initialize_unordered_bulk_op()
+                    bulkByCollection[state.collection.name] = bulk
+
+                bulk.find(_buildTemporalEntryId(state.time_id, 1, state.source)).upsert().update_one(cacheUpdate)
+                state.pending = dict()
+
+            for bulk in bulkByCollection.itervalues():
+                bulk.execute()
+                self._num_write_operations += 1
+
+            if self._log_timer.ticked():
+                logger.info('Temporal influence aggregator: %d entries, %d write operations, %d read operations, %d sources in memory' % (self._num_entries, self._num_write_operations, self._num_read_operations, len(self._states)))
+                self._num_entries = 0
+                self._num_write_operations = 0
+                self._num_read_operations = 0
+
+    def discardCollection(self, collectionName):
+        with self._lock:
+            for key in [x for x in self._states.iterkeys() if x[0] == collectionName]:
+                del self._states[key]
+
+temporalInfluenceAggregator = TemporalInfluenceAggregator()
+
+
+class testTemporalAnalytics(unittest.TestCase):
+    def testGetTemporalRangeCover(self):
+        assert getTemporalRangeCover(0, 8) == [(8, 8)]
+        assert getTemporalRangeCover(1, 8) == [(8, 4), (4, 2), (2, 1)]
+        assert getTemporalRangeCover(2, 7) == [(7, 1), (6, 2), (4, 2)]
+        assert getTemporalRangeCover(3, 3) == []
+        assert getTemporalRangeCover(0, 1000) == [(1000, 8), (992, 32), (960, 64), (896, 128), (768, 256), (512, 512)]
+
+        # Imprecise may overshoot the start of the range.
+        assert getTemporalRangeCover(1, 8, preciseFromBack=False) == [(8, 8)]
+        assert getTemporalRangeCover(1, 8, preciseFromFront=False) == [(8, 4), (4, 2), (2, 1)]
+        assert getTemporalRangeCover(0, 7, preciseFromFront=False) == [(4, 4)]
+
+        # Every time in the range is covered exactly once.
+        for timeIdStart in range(0, 20):
+            for timeIdEnd in range(timeIdStart, 40):
+                covered = list()
+                for time, length in getTemporalRangeCover(timeIdStart, timeIdEnd):
+                    assert time % length == 0
+                    covered += range(time - length + 1, time + 1)
+                assert sorted(covered) == range(timeIdStart + 1, timeIdEnd + 1)
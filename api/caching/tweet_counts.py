@@ -0,0 +1,261 @@
+import logging
+from threading import Lock
+import unittest
+import pymongo
+from api.caching.caching_shared import getCollection, WORKLOAD_INGEST, _initializeUsePower2, registerCollectionIndex, createCollectionIndexes
+from api.config import Configuration
+from api.core.utility import getEpochMs
+
+__author__ = 'Michael Pryor'
+
+logger = logging.getLogger(__name__)
+
+# Counts of tweets per instance, place and time bucket are kept up to date as tweets are written,
+# so that counts and histograms of a time range are read from a few small documents instead of
+# counting tweets.
+#
+# A tweet is counted once for every place it was geocoded to (the place and places containing it,
+# as it is stored in the tweet's geocode field) and once for the whole instance, with place None.
+#
+# Counts are per bucket, so a time range which starts part way through a bucket
+# includes the whole of that bucket.
+
+registerCollectionIndex('count_', [('place.providerId', pymongo.ASCENDING), ('place.placeId', pymongo.ASCENDING), ('time', pymongo.ASCENDING)])
+
+def _initCollection(collectionName):
+    logger.info('Initializing collection: %s' % collectionName)
+    _initializeUsePower2(collectionName)
+    createCollectionIndexes(collectionName)
+
+initializedTweetCountCollections = set()
+
+def getTweetCountCollection(instanceId, workload=None):
+    global initializedTweetCountCollections
+
+    collectionName = 'count_%s' % unicode(instanceId)
+    r = getCollection(collectionName, workload)
+
+    if collectionName not in initializedTweetCountCollections:
+        _initCollection(collectionName)
+        initializedTweetCountCollections.add(collectionName)
+
+    return r
+
+def _buildExpiredCountQuery(epochMs):
+    # Buckets which end before epochMs, a bucket which spans it still counts tweets we keep.
+    return {'time' : {'$lte' : epochMs - Configuration.TWEET_COUNT_BUCKET_SIZE_MS}}
+
+def dropTweetCountsBefore(instanceId, epochMs):
+    """ Removes counts of tweets before epochMs, use when those tweets are dropped. """
+    getTweetCountCollection(instanceId, WORKLOAD_INGEST).remove(_buildExpiredCountQuery(epochMs))
+
+def dropTweetCountCollection(instanceId):
+    collectionName = 'count_%s' % unicode(instanceId)
+    tweetCountAggregator.discardInstance(instanceId)
+    initializedTweetCountCollections.discard(collectionName)
+    getCollection(collectionName).drop()
+
+def isTweetCountCollection(collectionName):
+    return collectionName.startswith('count_')
+
+def getTweetCountBucket(timestamp):
+    """ @return start of bucket containing timestamp. """
+    bucketSize = Configuration.TWEET_COUNT_BUCKET_SIZE_MS
+    return int(timestamp // bucketSize) * bucketSize
+
+def _getPlaceKey(place):
+    """ @return hashable key of cache ID of a place, or None for the whole instance. """
+    if place is None:
+        return None
+
+    return place['providerId'], place['placeId']
+
+def _getPlaceQuery(placeKey):
+    if placeKey is None:
+        providerId, placeId = None, None
+    else:
+        providerId, placeId = placeKey
+
+    # Documents of the whole instance have no place, which None matches.
+    return {'place.providerId' : providerId,
+            'place.placeId' : placeId}
+
+def _buildCountUpdate(placeKey, time, count):
+    if placeKey is None:
+        itemId = 'all_%d' % time
+        setQuery = {'time' : time}
+    else:
+        itemId = '%s_%s_%d' % (placeKey[0], placeKey[1], time)
+        setQuery = {'time' : time, 'place' : {'providerId' : placeKey[0], 'placeId' : placeKey[1]}}
+
+    return itemId, {'$set' : setQuery, '$inc' : {'count' : count}}
+
+def _addCounts(counts, places, timestamp):
+    time = getTweetCountBucket(timestamp)
+
+    placeKeys = set([None])
+    if places is not None:
+        for place in places:
+            placeKeys.add(_getPlaceKey(place))
+
+    for placeKey in placeKeys:
+        key = (placeKey, time)
+        counts[key] = counts.get(key, 0) + 1
+
+def _writeCounts(collection, counts):
+    """ Adds counts to collection with one bulk operation. """
+    if len(counts) == 0:
+        return
+
+    bulk = collection.initialize_unordered_bulk_op()
+    for (placeKey, time), count in counts.iteritems():
+        itemId, updateQuery = _buildCountUpdate(placeKey, time, count)
+        bulk.find({'_id' : itemId}).upsert().update_one(updateQuery)
+
+    bulk.execute()
+
+
+class TweetCountAggregator(object):
+    """ Accumulates counts in memory and adds them to the database when flushed,
+        so each tweet write does not cost a database operation of its own. """
+
+    def __init__(self):
+        super(TweetCountAggregator,self).__init__()
+
+        # instance ID -> (place key, bucket time) -> count.
+        self._counts = dict()
+        self._lock = Lock()
+
+    def addTweet(self, instanceId, places, timestamp):
+        """ @param places list of cache IDs of places the tweet was geocoded to, or None. """
+        if not Configuration.TWEET_COUNT_ROLLUP_ENABLED:
+            return
+
+        with self._lock:
+            _addCounts(self._counts.setdefault(unicode(instanceId), dict()), places, timestamp)
+
+    def flush(self):
+        with self._lock:
+            counts = self._counts
+            self._counts = dict()
+
+        for instanceId, instanceCounts in counts.iteritems():
+            try:
+                _writeCounts(getTweetCountCollection(instanceId, WORKLOAD_INGEST), instanceCounts)
+            except Exception as e:
+                logger.error('Failed to write %d tweet counts of instance %s: %s' % (len(instanceCounts), instanceId, e))
+
+    def discardInstance(self, instanceId):
+        with self._lock:
+            self._counts.pop(unicode(instanceId), None)
+
+tweetCountAggregator = TweetCountAggregator()
+
+def _buildTimeQuery(epochMsStartRange, epochMsEndRange):
+    timeQuery = dict()
+    if epochMsStartRange is not None:
+        timeQuery['$gte'] = getTweetCountBucket(epochMsStartRange)
+
+    if epochMsEndRange is not None:
+        timeQuery['$lt'] = epochMsEndRange
+
+    return timeQuery
+
+def readTweetCountHistogramFromCache(instanceId, placeId=None, epochMsStartRange=None, epochMsEndRange=None, bucketSizeMs=None):
+    """ @param placeId cache ID of place, None to count all tweets of instance.
+        @param bucketSizeMs size of histogram buckets, rounded up to a multiple of TWEET_COUNT_BUCKET_SIZE_MS.
+                            If None TWEET_COUNT_BUCKET_SIZE_MS is used.
+        @return list of (bucket start epoch ms, number of tweets) in time order, empty buckets are not included. """
+    if bucketSizeMs is None or bucketSizeMs < Configuration.TWEET_COUNT_BUCKET_SIZE_MS:
+        bucketSizeMs = Configuration.TWEET_COUNT_BUCKET_SIZE_MS
+    else:
+        bucketSizeMs = int(-(-bucketSizeMs // Configuration.TWEET_COUNT_BUCKET_SIZE_MS)) * Configuration.TWEET_COUNT_BUCKET_SIZE_MS
+
+    findDic = _getPlaceQuery(_getPlaceKey(placeId))
+
+    timeQuery = _buildTimeQuery(epochMsStartRange, epochMsEndRange)
+    if len(timeQuery) > 0:
+        findDic['time'] = timeQuery
+
+    histogram = dict()
+    for item in getTweetCountCollection(instanceId).find(findDic, {'_id' : False, 'time' : True, 'count' : True}):
+        time = int(item['time'] // bucketSizeMs) * bucketSizeMs
+        histogram[time] = histogram.get(time, 0) + item['count']
+
+    return sorted(histogram.iteritems())
+
+def readTweetCountFromCache(instanceId, placeId=None, epochMsStartRange=None, epochMsEndRange=None):
+    """ @return number of tweets of place in time range, see readTweetCountHistogramFromCache. """
+    return sum([count for time, count in readTweetCountHistogramFromCache(instanceId, placeId, epochMsStartRange, epochMsEndRange)])
+
+def checkTweetCountsComplete(instanceId, tweetCollections):
+    """ Counts are not kept for tweets written before counting was introduced, so counts of such
+        instances are too low until they are rebuilt with rebuildTweetCountsFromCache.
+        Logs a warning if the counts of instance start later than its tweets.
+        @return true if counts cover every tweet. """
+    firstTweetTime = None
+    for tweetCollection in tweetCollections:
+        for item in tweetCollection.find({}, {'_id' : False, 'timestamp' : True}).sort('timestamp', pymongo.ASCENDING).limit(1):
+            if firstTweetTime is None or item['timestamp'] < firstTweetTime:
+                firstTweetTime = item['timestamp']
+
+    if firstTweetTime is None:
+        return True
+
+    firstCounts = list(getTweetCountCollection(instanceId).find(_getPlaceQuery(None), {'_id' : False, 'time' : True}).sort('time', pymongo.ASCENDING).limit(1))
+    if len(firstCounts) == 0 or firstCounts[0]['time'] > getTweetCountBucket(firstTweetTime):
+        logger.warn('Tweet counts of instance %s do not include its earliest tweets, counts and histograms will be too low until rebuilt with --rebuild_tweet_counts' % instanceId)
+        return False
+
+    return True
+
+def rebuildTweetCountsFromCache(instanceId, tweetCollections):
+    """ Replaces the counts of an instance with counts of the tweets in tweetCollections,
+        use this for tweets written before counts were kept.
+        @return number of tweets counted. """
+    collection = getTweetCountCollection(instanceId)
+    tweetCountAggregator.discardInstance(instanceId)
+
+    timer = getEpochMs()
+    counts = dict()
+    numTweets = 0
+
+    for tweetCollection in tweetCollections:
+        for item in tweetCollection.find({}, {'_id' : False, 'timestamp' : True, 'geocode' : True}):
+            timestamp = item.get('timestamp', None)
+            if timestamp is None:
+                continue
+
+            _addCounts(counts, item.get('geocode', None), timestamp)
+            numTweets += 1
+
+    collection.remove()
+    _writeCounts(collection, counts)
+
+    logger.info('Rebuilt %d tweet counts from %d tweets of instance %s in %dms' % (len(counts), numTweets, instanceId, getEpochMs() - timer))
+    return numTweets
+
+
+class testTweetCounts(unittest.TestCase):
+    def setUp(self):
+        self.bucket_size = Configuration.TWEET_COUNT_BUCKET_SIZE_MS
+        Configuration.TWEET_COUNT_BUCKET_SIZE_MS = 1000
+
+    def tearDown(self):
+        Configuration.TWEET_COUNT_BUCKET_SIZE_MS = self.bucket_size
+
+    def testAddCounts(self):
+        london = {'providerId' : 1, 'placeId' : 10}
+        uk = {'providerId' : 1, 'placeId' : 20}
+
+        counts = dict()
+        _addCounts(counts, [london, uk], 1500)
+        _addCounts(counts, [london, uk], 1999)
+        _addCounts(counts, None, 2000)
+
+        assert counts == {(None, 1000) : 2, ((1, 10), 1000) : 2, ((1, 20), 1000) : 2, (None, 2000) : 1}
+
+        assert _buildCountUpdate(None, 2000, 1) == ('all_2000', {'$set' : {'time' : 2000}, '$inc' : {'count' : 1}})
+        assert _buildCountUpdate((1, 10), 1000, 2)[0] == '1_10_1000'
+        assert _buildTimeQuery(1500, 3000) == {'$gte' : 1000, '$lt' : 3000}
+        assert _buildExpiredCountQuery(3000) == {'time' : {'$lte' : 2000}}
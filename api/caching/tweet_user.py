@@ -1,28 +1,47 @@
 from abc import ABCMeta, abstractproperty
 import copy
 import logging
-from threading import Lock
+from threading import Lock, RLock
 import pymongo
 from pymongo.database import Database
-from pymongo.errors import AutoReconnect
-from api.caching.caching_shared import getDatabase, getCollection, _initializeUsePower2
+from pymongo.errors import AutoReconnect, BulkWriteError
+from api.caching.compact_storage import COMPRESSED_DATA_FIELD, tweetStorageSchema, userStorageSchema, expandDocument
+from api.caching.tweet_counts import tweetCountAggregator, dropTweetCountsBefore
+from api.caching.caching_shared import getDatabase, getCollection, getCollections, WORKLOAD_INGEST, _initializeUsePower2, registerCollectionIndex, createCollectionIndexes
 from api.config import Configuration
 from api.core.utility import getEpochMs, Timer
-from api.geocode.geocode_cached import geocodeFromCacheById
+from api.geocode.geocode_cached import geocodeFromCacheById, prefetchPlaces
 from api.twitter.feed import User, Tweet, Place, buildAnalyserFromName
 
 logger = logging.getLogger(__name__)
 
+# This is for the user page where followers are looked up.
+# Not sure if sparse=True does anything, pymongo docs not clear on how to create sparse index.
+registerCollectionIndex('user_', [('known_followees', pymongo.ASCENDING)], sparse = True)
+
+# For short follow information download.
+# Note: Only place ID is used because indexes are expensive on database RAM,
+# and we don't really need to do provider ID too since it is extremely rare
+# that two providers will have the same place ID. Also note I had some trouble
+# getting MongoDB to use an index with provider ID in it (not sure why, but it
+# wouldn't use the index properly, see: https://stackoverflow.com/questions/41085666/mongodb-explains-totalkeysexamined-more-than-limit).
+registerCollectionIndex('user_', [('is_followers_loaded', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)], sparse = True)
+registerCollectionIndex('user_', [('geocode.placeId', pymongo.ASCENDING), ('is_followers_loaded', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)], sparse = True)
+
+registerCollectionIndex('tweet_', [('timestamp', pymongo.ASCENDING)]) # for cache download where no place is specified.
+registerCollectionIndex('tweet_', [('geocode.placeId', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)])
+
 def _initCollection(collectionName):
     logger.info('Initializing collection: %s' % collectionName)
     _initializeUsePower2(collectionName)
+    createCollectionIndexes(collectionName)
 
 initializedUserCollections = set()
-def getUserCollection(instanceId):
+def getUserCollection(instanceId, workload=None):
     global isUserCollectionInitialized
 
     collectionName = 'user_%s' % unicode(instanceId)
-    r = getCollection(collectionName)
+    r = getCollection(collectionName, workload)
 
     if collectionName not in initializedUserCollections:
         _initCollection(collectionName)
@@ -31,18 +50,164 @@ def getUserCollection(instanceId):
     return r
 
 initializedTweetCollections = set()
-def getTweetCollection(instanceId):
+def getTweetCollection(instanceId, timestamp=None, workload=None):
+    """ @param timestamp if tweets are partitioned by time, epoch ms within the bucket to return the collection of,
+                         None for the collection of tweets which are not partitioned.
+        @param workload see caching_shared.getDatabase. """
     global isTweetCollectionInitialized
 
     collectionName = 'tweet_%s' % unicode(instanceId)
-    r = getCollection(collectionName)
+    bucket = None
+    if timestamp is not None and Configuration.TWEET_BUCKET_SIZE_MS > 0:
+        bucket = getTweetBucket(timestamp)
+        collectionName = '%s_%d' % (collectionName, bucket)
+
+    r = getCollection(collectionName, workload)
 
     if collectionName not in initializedTweetCollections:
+        if bucket is not None:
+            _onTweetBucketUsed(instanceId, bucket)
+
         _initCollection(collectionName)
         initializedTweetCollections.add(collectionName)
 
     return r
 
+def getUserCollectionsInRange(instanceId, epochMsStartRange=None, epochMsEndRange=None, workload=None):
+    return [getUserCollection(instanceId, workload)]
+
+def getTweetBucket(timestamp):
+    return int(timestamp // Configuration.TWEET_BUCKET_SIZE_MS)
+
+class _InstanceTweetBuckets(object):
+    def __init__(self, buckets, hasUnpartitionedCollection):
+        super(_InstanceTweetBuckets,self).__init__()
+
+        self.buckets = buckets
+
+        # Tweets written before partitioning was enabled.
+        self.has_unpartitioned_collection = hasUnpartitionedCollection
+
+# Instance ID -> _InstanceTweetBuckets, loaded from collection names when first used.
+tweetBuckets = dict()
+tweetBucketsLock = RLock()
+
+def _getTweetBuckets(instanceId):
+    instanceId = unicode(instanceId)
+
+    with tweetBucketsLock:
+        state = tweetBuckets.get(instanceId)
+        if state is None:
+            unpartitionedName = 'tweet_%s' % instanceId
+            prefix = unpartitionedName + '_'
+
+            buckets = set()
+            hasUnpartitionedCollection = False
+            for collectionName in getCollections():
+                if collectionName == unpartitionedName:
+                    hasUnpartitionedCollection = True
+                elif collectionName.startswith(prefix):
+                    try:
+                        buckets.add(int(collectionName[len(prefix):]))
+                    except ValueError:
+                        pass
+
+            state = _InstanceTweetBuckets(buckets, hasUnpartitionedCollection)
+            tweetBuckets[instanceId] = state
+
+        return state
+
+def _onTweetBucketUsed(instanceId, bucket):
+    with tweetBucketsLock:
+        state = _getTweetBuckets(instanceId)
+        if bucket in state.buckets:
+            return
+
+        state.buckets.add(bucket)
+        logger.info('Tweets of instance %s are now written to bucket %d' % (instanceId, bucket))
+
+        # A new bucket is a good time to check for old ones.
+        dropExpiredTweetBuckets(instanceId)
+
+def _dropTweetBucket(instanceId, bucket):
+    collectionName = 'tweet_%s_%d' % (unicode(instanceId), bucket)
+    logger.info('Dropping tweet bucket %s' % collectionName)
+
+    writeBatcher.discardCollection(collectionName)
+    initializedTweetCollections.discard(collectionName)
+    getCollection(collectionName).drop()
+
+def dropExpiredTweetBuckets(instanceId):
+    """ Drops buckets of tweets which are all older than TWEET_BUCKET_RETENTION_MS.
+        @return number of buckets dropped. """
+    if Configuration.TWEET_BUCKET_SIZE_MS <= 0 or Configuration.TWEET_BUCKET_RETENTION_MS <= 0:
+        return 0
+
+    oldestBucketKept = getTweetBucket(getEpochMs() - Configuration.TWEET_BUCKET_RETENTION_MS)
+
+    with tweetBucketsLock:
+        state = _getTweetBuckets(instanceId)
+        expiredBuckets = [x for x in state.buckets if x < oldestBucketKept]
+        for bucket in expiredBuckets:
+            state.buckets.discard(bucket)
+            _dropTweetBucket(instanceId, bucket)
+
+    # Otherwise counts would include tweets which no longer exist.
+    if len(expiredBuckets) > 0:
+        dropTweetCountsBefore(instanceId, (max(expiredBuckets) + 1) * Configuration.TWEET_BUCKET_SIZE_MS)
+
+    return len(expiredBuckets)
+
+def getTweetCollectionsInRange(instanceId, epochMsStartRange=None, epochMsEndRange=None, workload=None):
+    """ @return tweet collections which may contain tweets in range, in time order. """
+    if Configuration.TWEET_BUCKET_SIZE_MS <= 0:
+        return [getTweetCollection(instanceId, workload=workload)]
+
+    if epochMsStartRange is None:
+        firstBucket = None
+    else:
+        firstBucket = getTweetBucket(epochMsStartRange)
+
+    # End of range is exclusive.
+    if epochMsEndRange is None:
+        lastBucket = None
+    else:
+        lastBucket = getTweetBucket(epochMsEndRange - 1)
+
+    with tweetBucketsLock:
+        state = _getTweetBuckets(instanceId)
+        buckets = sorted(state.buckets)
+        hasUnpartitionedCollection = state.has_unpartitioned_collection
+
+    collections = []
+    if hasUnpartitionedCollection:
+        collections.append(getTweetCollection(instanceId, workload=workload))
+
+    for bucket in buckets:
+        if (firstBucket is None or bucket >= firstBucket) and (lastBucket is None or bucket <= lastBucket):
+            collections.append(getTweetCollection(instanceId, bucket * Configuration.TWEET_BUCKET_SIZE_MS, workload))
+
+    return collections
+
+def dropUserCollection(instanceId):
+    collectionName = 'user_%s' % unicode(instanceId)
+    initializedUserCollections.discard(collectionName)
+    userEnrichmentStateIndex.discardInstance(instanceId)
+    getCollection(collectionName).drop()
+
+def dropTweetCollection(instanceId):
+    """ Drops all tweets of instance, including all buckets. """
+    unpartitionedName = 'tweet_%s' % unicode(instanceId)
+    prefix = unpartitionedName + '_'
+
+    with tweetBucketsLock:
+        tweetBuckets.pop(unicode(instanceId), None)
+
+        for collectionName in getCollections():
+            if collectionName == unpartitionedName or collectionName.startswith(prefix):
+                initializedTweetCollections.discard(collectionName)
+                getCollection(collectionName).drop()
+
 def isUserCollection(collectionName):
     return collectionName.startswith('user_')
 
@@ -50,6 +215,9 @@ def isTweetCollection(collectionName):
     return collectionName.startswith('tweet_')
 
 
+# Compressed data is only read when asked for in a projection.
+EXCLUDE_COMPRESSED_DATA_PROJECTION = {COMPRESSED_DATA_FIELD : False}
+
 class Projection(object):
     __metaclass__ = ABCMeta
 
@@ -79,6 +247,23 @@ class NoQueryProjection(Projection):
     def do_query(self):
         return False
 
+class FieldProjection(Projection):
+    """ Projection of specific document fields, for reading documents without constructing objects. """
+    def __init__(self, fields):
+        super(FieldProjection,self).__init__()
+
+        pr = dict()
+        pr['_id'] = True
+
+        for field in fields:
+            pr[field] = True
+
+        self._projection = pr
+
+    @property
+    def projection(self):
+        return self._projection
+
 class UserDataProjection(Projection):
     def __init__(self, includeFields):
         super(UserDataProjection, self).__init__()
@@ -219,6 +404,320 @@ class UserProjection(Projection):
     def ExcludeRecursiveData(cls, dataProjection=None):
         return cls(True, True, dataProjection, True, False, None, False, None, True, True, True, True, True, True, True, True, True, True)
 
+class WriteBatcher(object):
+    """ Accumulates inserts and upserts per collection and writes them
+        to the database as unordered bulk operations.
+
+        Unordered bulk operations may be applied in any order, so an upsert
+        on a document which is already waiting to be written causes the batch
+        to be flushed first. Inserts which fail because the document already
+        exists are ignored, as they are when writing one document at a time. """
+
+    DUPLICATE_KEY_ERROR_CODE = 11000
+
+    def __init__(self, batchSize, maxAgeMs, maxPending):
+        super(WriteBatcher,self).__init__()
+
+        self.batch_size = batchSize
+        self.max_age = maxAgeMs
+        self.max_pending = maxPending
+
+        # collection name -> [collection, list of operations, set of item IDs, epoch ms of first operation].
+        self._batches = dict()
+        self._num_pending = 0
+
+        # Protects the above.
+        self._lock = Lock()
+
+        # Only one flush at a time so that writes to the same document happen in order.
+        self._flush_lock = Lock()
+
+        self._num_flushes = 0
+        self._num_operations_flushed = 0
+        self._num_synchronous_flushes = 0
+        self._num_operations_lost = 0
+        self._largest_batch = 0
+        self._total_flush_time = 0
+        self._longest_flush_time = 0
+        self._log_timer = Timer(Configuration.LOG_DROP_AMOUNT_FREQ_MS, False)
+
+    def _add(self, collection, operation, itemId, isUpsert):
+        collectionName = collection.name
+
+        with self._lock:
+            batch = self._batches.get(collectionName)
+            mustFlushFirst = isUpsert and batch is not None and itemId in batch[2]
+
+        if mustFlushFirst:
+            self.flushCollection(collectionName)
+
+        with self._lock:
+            batch = self._batches.get(collectionName)
+            if batch is None:
+                batch = [collection, [], set(), getEpochMs()]
+                self._batches[collectionName] = batch
+
+            batch[1].append(operation)
+            if itemId is not None:
+                batch[2].add(itemId)
+
+            self._num_pending += 1
+
+            batchFull = len(batch[1]) >= self.batch_size
+            tooManyPending = self._num_pending > self.max_pending
+
+            if tooManyPending and not batchFull:
+                self._num_synchronous_flushes += 1
+
+        if batchFull:
+            self.flushCollection(collectionName)
+        elif tooManyPending:
+            # Back pressure, caller waits for the database.
+            self.flushAll()
+
+    def addInsert(self, collection, document):
+        self._add(collection, (document,), document.get('_id'), False)
+
+    def addUpsert(self, collection, itemId, updateQuery):
+        assert itemId is not None
+        self._add(collection, (itemId, updateQuery), itemId, True)
+
+    def _takeBatch(self, collectionName):
+        with self._lock:
+            batch = self._batches.pop(collectionName, None)
+            if batch is not None:
+                self._num_pending -= len(batch[1])
+            return batch
+
+    def _writeBatch(self, batch):
+        collection, operations, itemIds, firstOperationEpoch = batch
+        if len(operations) == 0:
+            return
+
+        timer = getEpochMs()
+
+        bulk = collection.initialize_unordered_bulk_op()
+        for operation in operations:
+            if len(operation) == 1:
+                bulk.insert(operation[0])
+            else:
+                itemId, updateQuery = operation
+                bulk.find({'_id' : itemId}).upsert().update_one(updateQuery)
+
+        try:
+            bulk.execute()
+        except BulkWriteError as e:
+            writeErrors = e.details.get('writeErrors', [])
+            otherErrors = [x for x in writeErrors if x.get('code') != WriteBatcher.DUPLICATE_KEY_ERROR_CODE]
+            if len(otherErrors) > 0 or e.details.get('writeConcernErrors'):
+                logger.error('Bulk write to collection %s failed for %d of %d operations, first error: %s' % (collection.name, len(otherErrors), len(operations), unicode(otherErrors[:1] or e.details.get('writeConcernErrors'))))
+        except Exception as e:
+            # Not retried, the next batch may already hold newer writes to the same documents.
+            self._num_operations_lost += len(operations)
+            logger.error('Bulk write to collection %s failed, %d operations lost: %s' % (collection.name, len(operations), e))
+            logger.debug('Lost write operations to collection %s with IDs: %s' % (collection.name, unicode([x for x in itemIds])))
+            return
+
+        flushTime = getEpochMs() - timer
+
+        self._num_flushes += 1
+        self._num_operations_flushed += len(operations)
+        self._total_flush_time += flushTime
+        self._largest_batch = max(self._largest_batch, len(operations))
+        self._longest_flush_time = max(self._longest_flush_time, flushTime)
+
+    def flushCollection(self, collectionName):
+        with self._flush_lock:
+            batch = self._takeBatch(collectionName)
+            if batch is not None:
+                self._writeBatch(batch)
+
+    def flushAll(self):
+        with self._lock:
+            collectionNames = self._batches.keys()
+
+        for collectionName in collectionNames:
+            self.flushCollection(collectionName)
+
+    def flushDue(self):
+        """ Flushes batches which have been waiting longer than max age. """
+        with self._lock:
+            currentEpoch = getEpochMs()
+            collectionNames = [name for name, batch in self._batches.iteritems() if currentEpoch - batch[3] >= self.max_age]
+
+        for collectionName in collectionNames:
+            self.flushCollection(collectionName)
+
+        self.logStatistics()
+
+    def discardCollection(self, collectionName):
+        """ Throws away anything waiting to be written to a collection, use this
+            before dropping a collection so that it is not recreated by a late write. """
+        with self._flush_lock:
+            batch = self._takeBatch(collectionName)
+            if batch is not None:
+                logger.info('Discarded %d pending write operations to collection %s' % (len(batch[1]), collectionName))
+
+    def discardCollectionsWithPrefix(self, prefix):
+        """ Discards pending writes of all collections whose name starts with prefix. """
+        with self._lock:
+            collectionNames = [name for name in self._batches if name.startswith(prefix)]
+
+        for collectionName in collectionNames:
+            self.discardCollection(collectionName)
+
+    def logStatistics(self):
+        if not self._log_timer.ticked():
+            return
+
+        if self._num_flushes > 0:
+            averageBatch = float(self._num_operations_flushed) / self._num_flushes
+            averageFlushTime = float(self._total_flush_time) / self._num_flushes
+        else:
+            averageBatch = 0
+            averageFlushTime = 0
+
+        logger.info('Write batcher: %d flushes, %d operations written, %d lost, %d pending, average batch size %.1f (largest %d), average flush %dms (longest %dms), %d synchronous flushes due to back pressure' % (self._num_flushes, self._num_operations_flushed, self._num_operations_lost, self._num_pending, averageBatch, self._largest_batch, averageFlushTime, self._longest_flush_time, self._num_synchronous_flushes))
+
+        self._num_flushes = 0
+        self._num_operations_flushed = 0
+        self._num_synchronous_flushes = 0
+        self._num_operations_lost = 0
+        self._largest_batch = 0
+        self._total_flush_time = 0
+        self._longest_flush_time = 0
+
+    @property
+    def num_pending(self):
+        return self._num_pending
+
+writeBatcher = WriteBatcher(Configuration.MONGO_WRITE_BATCH_SIZE,
+                            Configuration.MONGO_WRITE_BATCH_MAX_AGE_MS,
+                            Configuration.MONGO_WRITE_BATCH_MAX_PENDING)
+
+def flushPendingWrites(dueOnly=False):
+    if dueOnly:
+        writeBatcher.flushDue()
+    else:
+        writeBatcher.flushAll()
+
+    tweetCountAggregator.flush()
+
+def discardPendingWrites(instanceId):
+    instanceId = unicode(instanceId)
+    writeBatcher.discardCollection('user_%s' % instanceId)
+    writeBatcher.discardCollectionsWithPrefix('tweet_%s' % instanceId)
+    tweetCountAggregator.discardInstance(instanceId)
+
+class _InstanceEnrichmentState(object):
+    def __init__(self):
+        super(_InstanceEnrichmentState,self).__init__()
+
+        self.user_ids = set()
+        self.is_loaded = False
+        self.is_loading = False
+        self.is_too_large = False
+
+class UserEnrichmentStateIndex(object):
+    """ Per instance set of IDs of users whose followers are loaded or who are queued
+        for follower enrichment.
+
+        Once a user is in this state in the database it never leaves it, so IDs are only added.
+        An instance's IDs are read from the database the first time it is asked about, after
+        that writeUserToCache keeps it up to date, including writes not yet flushed.
+
+        Loading is done without holding the lock, other instances and writes are not held up
+        by it. Until an instance is loaded we don't know, and the database is checked. """
+
+    def __init__(self, maxSizePerInstance):
+        super(UserEnrichmentStateIndex,self).__init__()
+
+        self.max_size = maxSizePerInstance
+        self._by_instance = dict()
+        self._lock = RLock()
+
+    def _getState(self, instanceId):
+        state = self._by_instance.get(instanceId)
+        if state is None:
+            state = _InstanceEnrichmentState()
+            self._by_instance[instanceId] = state
+        return state
+
+    def _addToState(self, state, userId):
+        if state.is_too_large:
+            return
+
+        state.user_ids.add(userId)
+        if len(state.user_ids) > self.max_size:
+            state.is_too_large = True
+            state.user_ids = set()
+
+    def _load(self, instanceId, state):
+        """ Called without the lock held, loads into a new set which is swapped in when complete. """
+        timer = getEpochMs()
+
+        userIds = set()
+        try:
+            cursor = getUserCollection(instanceId).find({'$or' : [{'is_followers_loaded' : True}, {'queued_for_follower_enrichment' : True}]}, {'_id' : True})
+            for item in cursor:
+                userIds.add(item['_id'])
+                if len(userIds) > self.max_size:
+                    break
+        finally:
+            with self._lock:
+                state.is_loading = False
+
+        with self._lock:
+            # Include users added while we were loading.
+            userIds |= state.user_ids
+            if len(userIds) > self.max_size:
+                logger.warn('Too many enriched users in instance %s to index in memory, reading from database instead' % instanceId)
+                state.is_too_large = True
+                state.user_ids = set()
+            else:
+                state.user_ids = userIds
+
+            state.is_loaded = True
+
+        logger.info('Loaded follower enrichment state of %d users for instance %s in %dms' % (len(userIds), instanceId, getEpochMs() - timer))
+
+    def add(self, instanceId, userId):
+        with self._lock:
+            self._addToState(self._getState(unicode(instanceId)), userId)
+
+    def contains(self, instanceId, userId):
+        """ @return true if user's followers are loaded or it is queued for enrichment,
+                    None if we don't know and the database must be checked. """
+        instanceId = unicode(instanceId)
+
+        with self._lock:
+            state = self._getState(instanceId)
+            if state.is_loaded or state.is_too_large:
+                return self._containsInState(state, userId)
+
+            # Another thread is loading it.
+            if state.is_loading:
+                return None
+
+            state.is_loading = True
+
+        self._load(instanceId, state)
+
+        with self._lock:
+            return self._containsInState(state, userId)
+
+    def _containsInState(self, state, userId):
+        if state.is_too_large or not state.is_loaded:
+            return None
+
+        return userId in state.user_ids
+
+    def discardInstance(self, instanceId):
+        with self._lock:
+            self._by_instance.pop(unicode(instanceId), None)
+
+userEnrichmentStateIndex = UserEnrichmentStateIndex(Configuration.USER_ENRICHMENT_STATE_INDEX_MAX_SIZE)
+
 logUserWritePerformanceTimer = Timer(Configuration.LOG_DROP_AMOUNT_FREQ_MS, False)
 def writeUserToCache(user, doUpdate):
     assert isinstance(user, User)
@@ -289,36 +788,21 @@ def writeUserToCache(user, doUpdate):
         theQuery.update({'$addToSet' : addToSetFields})
 
 
-    collection = getUserCollection(user.instance_key)
-
     timer = getEpochMs()
 
-    # This is for the user page where followers are looked up.
-    # Not sure if sparse=True does anything, pymongo docs not clear on how to create sparse index.
-    collection.ensure_index([('known_followees', pymongo.ASCENDING)], sparse = True)
-
-    # For short follow information download.
-    # Note: Only place ID is used because indexes are expensive on database RAM,
-    # and we don't really need to do provider ID too since it is extremely rare
-    # that two providers will have the same place ID. Also note I had some trouble
-    # getting MongoDB to use an index with provider ID in it (not sure why, but it
-    # wouldn't use the index properly, see: https://stackoverflow.com/questions/41085666/mongodb-explains-totalkeysexamined-more-than-limit).
-    collection.ensure_index([('is_followers_loaded', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)], sparse = True)
-    collection.ensure_index([('geocode.placeId', pymongo.ASCENDING), ('is_followers_loaded', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)], sparse = True)
-
-    ensureIndexTime = getEpochMs() - timer
-    timer = getEpochMs()
-
-    _writeItemToCache(getUserCollection, user.id, user.instance_key, user.data, user.isDataNew, user.timestamp, placeId, theQuery, doUpdate)
+    _writeItemToCache(lambda instanceId: getUserCollection(instanceId, WORKLOAD_INGEST), user.id, user.instance_key, user.data, user.isDataNew, user.timestamp, placeId, theQuery, doUpdate, userStorageSchema)
 
     writingToDatabaseTime = getEpochMs() - timer
 
     # This is an optimization, the next time we see this same user object we won't push its data.
     user.isDataNew = False
 
+    if user.is_followers_loaded or user.queued_for_follower_enrichment:
+        userEnrichmentStateIndex.add(user.instance_key, user.id)
+
     global logUserWritePerformanceTimer
     if logUserWritePerformanceTimer.ticked():
-        logger.info('Writing user to database took %dms ensuring index, %dms writing to database' % (ensureIndexTime, writingToDatabaseTime))
+        logger.info('Writing user to database took %dms' % writingToDatabaseTime)
 
 logTweetWritePerformanceTimer = Timer(Configuration.LOG_DROP_AMOUNT_FREQ_MS, False)
 def writeTweetToCache(tweet):
@@ -328,14 +812,11 @@ def writeTweetToCache(tweet):
 
     timer = getEpochMs()
 
-    collection = getTweetCollection(tweet.instance_key)
-
-    collection.ensure_index([('timestamp', pymongo.ASCENDING)]) # for cache download where no place is specified.
-    collection.ensure_index([('geocode.placeId', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)])
-
-    _writeItemToCache(getTweetCollection, None, tweet.instance_key, tweet.data, tweet.isDataNew, tweet.timestamp, placeId)
+    _writeItemToCache(lambda instanceId: getTweetCollection(instanceId, tweet.timestamp, WORKLOAD_INGEST), None, tweet.instance_key, tweet.data, tweet.isDataNew, tweet.timestamp, placeId, storageSchema=tweetStorageSchema)
     tweet.isDataNew = False
 
+    tweetCountAggregator.addTweet(tweet.instance_key, placeId, tweet.timestamp)
+
     writingToDatabaseTime = getEpochMs() - timer
 
     global logTweetWritePerformanceTimer
@@ -343,18 +824,26 @@ def writeTweetToCache(tweet):
         logger.info('Writing tweet to database took %dms' % writingToDatabaseTime)
 
 
-def _writeItemToCache(getCollectionFunc, itemId, instanceId, data, isDataNew, timestamp, placeId, typeSpecificUpdateQuery=None, doUpdate=True):
+def _writeItemToCache(getCollectionFunc, itemId, instanceId, data, isDataNew, timestamp, placeId, typeSpecificUpdateQuery=None, doUpdate=True, storageSchema=None):
+    """ @param storageSchema StorageSchema to store data with, or None to store all of it. """
     assert instanceId is not None
     instanceId = unicode(instanceId)
 
     collection = getCollectionFunc(instanceId)
 
+    compressedData = None
+    if isDataNew and storageSchema is not None:
+        data, compressedData = storageSchema.compact(data)
+
     # We always include these keys in our query.
     essentialQuery = {'timestamp' : timestamp}
     if isDataNew:
         essentialQuery['data'] = data
         essentialQuery['geocode'] = placeId
 
+        if compressedData is not None:
+            essentialQuery[COMPRESSED_DATA_FIELD] = compressedData
+
     # First include type specific query.
     updateQuery = dict()
     if typeSpecificUpdateQuery is not None:
@@ -364,8 +853,15 @@ def _writeItemToCache(getCollectionFunc, itemId, instanceId, data, isDataNew, ti
     if itemId is not None and doUpdate is True:
         updateQuery.setdefault('$set',{}).update(essentialQuery)
 
+        # Otherwise remainder of old data would be merged into new data when read.
+        if isDataNew and compressedData is None:
+            updateQuery['$unset'] = {COMPRESSED_DATA_FIELD : ''}
+
         # Perform update, use upsert so we insert if not already there.
-        collection.update({'_id' : itemId}, updateQuery, upsert=True)
+        if Configuration.MONGO_WRITE_BATCH_ENABLED:
+            writeBatcher.addUpsert(collection, itemId, updateQuery)
+        else:
+            collection.update({'_id' : itemId}, updateQuery, upsert=True)
     else:
         if typeSpecificUpdateQuery is not None:
             item = typeSpecificUpdateQuery.get('$set',None)
@@ -375,25 +871,34 @@ def _writeItemToCache(getCollectionFunc, itemId, instanceId, data, isDataNew, ti
         if itemId is not None:
             essentialQuery.update({'_id' : itemId})
 
-        collection.insert(essentialQuery)
+        if Configuration.MONGO_WRITE_BATCH_ENABLED:
+            writeBatcher.addInsert(collection, essentialQuery)
+        else:
+            collection.insert(essentialQuery)
 
 
-def _readItemFromCache(constructObjectFunc, getCollectionFunc, itemId, instanceId, projection=None):
+def _readItemFromCache(constructObjectFunc, getCollectionsFunc, itemId, instanceId, projection=None):
     query = {'_id' : itemId}
 
     assert constructObjectFunc is not None
-    assert getCollectionFunc is not None
+    assert getCollectionsFunc is not None
     assert instanceId is not None
     assert itemId is not None
 
     if projection is not None and projection.do_query is False:
         return None
 
-    collection = getCollectionFunc(instanceId)
     if projection is None:
-        data = collection.find_one(query)
+        projectionFields = EXCLUDE_COMPRESSED_DATA_PROJECTION
     else:
-        data = collection.find_one(query, projection.projection)
+        projectionFields = projection.projection
+
+    # Time of item is not known, so every collection it could be in is searched.
+    data = None
+    for collection in getCollectionsFunc(instanceId):
+        data = collection.find_one(query, projectionFields)
+        if data is not None:
+            break
 
     return constructObjectFunc(data)
 
@@ -408,10 +913,134 @@ def fixEpochMsRange(epochMsStartRange, epochMsEndRange):
 
     return epochMsStartRange, epochMsEndRange
 
-def cursorItemsFromCache(instanceId, getCollectionFunc, placeId=None, epochMsStartRange=None, epochMsEndRange=None, pageNum=None, pageSize=None, typeSpecificQuery=None, projection=None, sortByTimestamp=None, typeSpecificHint=None):
+class CursorPosition(object):
+    """ Position in a timestamp ordered cursor, so that the next page can be read
+        without MongoDB skipping over every earlier item.
+
+        Items with the same timestamp are returned in index order, so as well as the
+        timestamp of the last item we keep the number of items read with that timestamp. """
+
+    def __init__(self, timestamp=None, numAtTimestamp=0):
+        super(CursorPosition,self).__init__()
+
+        self.timestamp = timestamp
+        self.num_at_timestamp = numAtTimestamp
+
+    def advance(self, timestamp):
+        """ Call for each item read, in order. """
+        if timestamp == self.timestamp:
+            self.num_at_timestamp += 1
+        else:
+            self.timestamp = timestamp
+            self.num_at_timestamp = 1
+
+    def advanceAll(self, items):
+        if items is not None:
+            for item in items:
+                self.advance(item.timestamp)
+
+    @property
+    def token(self):
+        """ @return string to pass to fromToken to continue from this position. """
+        if self.timestamp is None:
+            return 'start'
+
+        return '%r_%d' % (self.timestamp, self.num_at_timestamp)
+
+    @classmethod
+    def fromToken(cls, token):
+        """ @return position, or None if token is invalid. """
+        if token == 'start':
+            return cls()
+
+        try:
+            timestamp, numAtTimestamp = token.split('_')
+            return cls(float(timestamp), int(numAtTimestamp))
+        except ValueError:
+            return None
+
+class MultiCollectionCursor(object):
+    """ Reads cursors on several collections one after another, as if they were one cursor.
+
+        Used with time buckets of tweets, cursors are given in time order so the results
+        stay sorted by timestamp if each cursor is. Skip and limit apply to the results
+        as a whole, whole cursors are skipped by counting them. """
+
+    def __init__(self, cursors):
+        super(MultiCollectionCursor,self).__init__()
+
+        self.cursors = cursors
+        self._skip = 0
+        self._limit = 0
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def __iter__(self):
+        skip = self._skip
+        remaining = self._limit
+
+        for cursor in self.cursors:
+            if skip > 0:
+                cursorSize = cursor.count()
+                if cursorSize <= skip:
+                    skip -= cursorSize
+                    continue
+
+                cursor.skip(skip)
+                skip = 0
+
+            if self._limit > 0:
+                if remaining <= 0:
+                    return
+
+                cursor.limit(remaining)
+
+            for item in cursor:
+                remaining -= 1
+                yield item
+
+    def count(self, withLimitAndSkip=False):
+        total = sum([cursor.count() for cursor in self.cursors])
+        if not withLimitAndSkip:
+            return total
+
+        total = max(total - self._skip, 0)
+        if self._limit > 0:
+            total = min(total, self._limit)
+
+        return total
+
+    def rewind(self):
+        for cursor in self.cursors:
+            cursor.rewind()
+
+        return self
+
+    def explain(self):
+        return [cursor.explain() for cursor in self.cursors]
+
+    def close(self):
+        for cursor in self.cursors:
+            cursor.close()
+
+def cursorItemsFromCache(instanceId, getCollectionsFunc, placeId=None, epochMsStartRange=None, epochMsEndRange=None, pageNum=None, pageSize=None, typeSpecificQuery=None, projection=None, sortByTimestamp=None, typeSpecificHint=None, position=None, workload=None):
+    """ @param getCollectionsFunc takes instance ID, time range and workload, returns collections to read in time order.
+        @param workload see caching_shared.getDatabase.
+        @param position if not None a CursorPosition, the page after this position is read
+                       and pageNum is ignored. """
     if sortByTimestamp is None:
         sortByTimestamp = True
 
+    if position is not None:
+        assert sortByTimestamp
+        assert pageSize is not None
+
     epochMsStartRange, epochMsEndRange = fixEpochMsRange(epochMsStartRange, epochMsEndRange)
 
     if epochMsEndRange is None:
@@ -423,10 +1052,11 @@ def cursorItemsFromCache(instanceId, getCollectionFunc, placeId=None, epochMsSta
         return None
 
     assert instanceId is not None
-    assert getCollectionFunc is not None
-    collection = getCollectionFunc(instanceId)
+    assert getCollectionsFunc is not None
 
     logFormatting = 'IN:%s, P:%s, ES:%s, EE:%s, PN:%s, PS:%s, T:%s, P:%s' % (instanceId, placeId, epochMsStartRange, epochMsEndRange, pageNum, pageSize, typeSpecificQuery, projection)
+    if position is not None:
+        logFormatting += ', C:%s' % position.token
 
     timer = Timer()
     logger.info('Attempting to read items from cache (%d) -- %s' % (timer.__hash__(),logFormatting))
@@ -446,6 +1076,16 @@ def cursorItemsFromCache(instanceId, getCollectionFunc, placeId=None, epochMsSta
 
         timestampDic.update({'$gte' : epochMsStartRange})
 
+    # Number of items at start of cursor which have already been read.
+    positionSkip = 0
+    if position is not None and position.timestamp is not None:
+        if epochMsStartRange is None or position.timestamp >= epochMsStartRange:
+            if timestampDic is None:
+                timestampDic = dict()
+
+            timestampDic.update({'$gte' : position.timestamp})
+            positionSkip = position.num_at_timestamp
+
     if timestampDic is not None:
         findDic.update({'timestamp' : timestampDic})
 
@@ -455,16 +1095,7 @@ def cursorItemsFromCache(instanceId, getCollectionFunc, placeId=None, epochMsSta
 
     # MongoDB sometimes gets it wrong, particularly with geocode.placeId.
     if typeSpecificHint is None:
-        if timestampDic is not None:
-            if placeId is not None:
-                hint = [('geocode.placeId', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)]
-            else:
-                hint = [('timestamp', pymongo.ASCENDING)]
-        else:
-            if placeId is not None:
-                hint = [('geocode.placeId', pymongo.ASCENDING)]
-            else:
-                hint = None
+        hint = getTweetQueryHint(timestampDic is not None, placeId is not None)
     else:
         hint = typeSpecificHint
 
@@ -472,14 +1103,40 @@ def cursorItemsFromCache(instanceId, getCollectionFunc, placeId=None, epochMsSta
         findDic.update(typeSpecificQuery)
 
     if projection is None:
-        cursor = collection.find(findDic).hint(hint)
+        projectionFields = EXCLUDE_COMPRESSED_DATA_PROJECTION
     else:
-        cursor = collection.find(findDic, projection.projection).hint(hint)
+        projectionFields = projection.projection
+        if position is not None and 'timestamp' not in projectionFields:
+            # Needed to advance position.
+            projectionFields = dict(projectionFields)
+            projectionFields['timestamp'] = True
+
+    # Only collections which can contain the time range are read.
+    if timestampDic is None:
+        collections = getCollectionsFunc(instanceId, workload=workload)
+    else:
+        collections = getCollectionsFunc(instanceId, timestampDic.get('$gte',None), timestampDic.get('$lt',None), workload)
+
+    cursors = []
+    for collection in collections:
+        cursor = collection.find(findDic, projectionFields).hint(hint)
 
-    if sortByTimestamp:
-        cursor = cursor.sort([('timestamp', pymongo.ASCENDING)])
+        if sortByTimestamp:
+            cursor = cursor.sort([('timestamp', pymongo.ASCENDING)])
 
-    if pageSize is not None and pageNum is not None:
+        cursors.append(cursor)
+
+    if len(cursors) == 1:
+        cursor = cursors[0]
+    else:
+        cursor = MultiCollectionCursor(cursors)
+
+    if position is not None:
+        # Only skips items with the position's timestamp, which we have already read.
+        if positionSkip > 0:
+            cursor = cursor.skip(positionSkip)
+        cursor = cursor.limit(pageSize)
+    elif pageSize is not None and pageNum is not None:
         cursor = cursor.skip(pageSize*pageNum).limit(pageSize)
 
     # We use this to calculate progress through the cursor,
@@ -534,6 +1191,12 @@ def timestampIterationFunc(obj):
     else:
         return obj.timestamp
 
+def rawTimestampIterationFunc(data):
+    if data is None:
+        return None
+    else:
+        return data.get('timestamp',None)
+
 def processCursor(cursor, constructObjectFunc, onIterationFunc=None, cursorSize=None, getCurrentIterationFunc=None):
     try:
         if cursor is None:
@@ -615,13 +1278,178 @@ def processCursor(cursor, constructObjectFunc, onIterationFunc=None, cursorSize=
         if cursor is not None:
             cursor.close()
 
-def _constructUser(instanceId, twitterSession, cacheData, recursive=True, userProjection=None, onIterationFunc=None):
+def readUserDataByIdsFromCache(instanceId, userIds, userProjection=None, workload=None):
+    """ @return user documents by user ID, read with one query. """
+    if len(userIds) == 0:
+        return dict()
+
+    if userProjection is not None and userProjection.do_query is False:
+        return dict()
+
+    query = {'_id' : {'$in' : list(userIds)}}
+
+    collection = getUserCollection(instanceId, workload)
+    if userProjection is None:
+        cursor = collection.find(query, EXCLUDE_COMPRESSED_DATA_PROJECTION)
+    else:
+        cursor = collection.find(query, userProjection.projection)
+
+    return dict([(data['_id'], data) for data in cursor])
+
+class UserPrefetch(object):
+    """ Reads what is needed to construct a batch of users from their cache documents
+        (followees, users they are waiting for in the enrichment queue and geocodes) with
+        one query per collection, instead of one per user.
+
+        Anything asked for by _constructUser which was not prefetched is read individually. """
+
+    # Number of users read from a cursor before prefetching their data.
+    BATCH_SIZE = 100
+
+    def __init__(self, instanceId, twitterSession, recursive, userProjection):
+        super(UserPrefetch,self).__init__()
+
+        self.instance_id = instanceId
+        self.twitter_session = twitterSession
+        self.recursive = recursive
+        self.user_projection = userProjection
+
+        # Cache ID tuple -> place document, see prefetchPlaces.
+        self.places = dict()
+
+        # User ID -> user object, or None if not in database.
+        self.followees = dict()
+        self.queue_waiting_for_users = dict()
+
+    def load(self, cacheDataList):
+        geocodeIds = []
+        followeeIds = set()
+        queueWaitingForUserIds = set()
+
+        for cacheData in cacheDataList:
+            if cacheData is None:
+                continue
+
+            geocodeId = cacheData.get('geocode',None)
+            if geocodeId is not None:
+                geocodeIds.append(geocodeId)
+
+            knownFolloweeIds = cacheData.get('known_followees',None)
+            if self.recursive and knownFolloweeIds is not None:
+                followeeIds.update(knownFolloweeIds)
+
+            tup = cacheData.get('follower_enrichment_progress',None)
+            if tup is not None and tup[4] is not None:
+                queueWaitingForUserIds.add(tup[4])
+
+        followeeProjection = None
+        if self.user_projection is not None:
+            followeeProjection = self.user_projection.followee_projection
+
+        followeeData = readUserDataByIdsFromCache(self.instance_id, followeeIds, followeeProjection)
+
+        for cacheData in followeeData.itervalues():
+            geocodeId = cacheData.get('geocode',None)
+            if geocodeId is not None:
+                geocodeIds.append(geocodeId)
+
+            tup = cacheData.get('follower_enrichment_progress',None)
+            if tup is not None and tup[4] is not None:
+                queueWaitingForUserIds.add(tup[4])
+
+        queueWaitingForUserData = readUserDataByIdsFromCache(self.instance_id, queueWaitingForUserIds, UserProjection.IdName())
+
+        self.places = prefetchPlaces(geocodeIds)
+
+        # Followees and users waited for are not recursive, the users they wait for are
+        # the ones read above and users waited for are read without geocodes or progress.
+        subPrefetch = UserPrefetch(self.instance_id, self.twitter_session, False, None)
+        subPrefetch.places = self.places
+
+        self.queue_waiting_for_users = dict()
+        for userId in queueWaitingForUserIds:
+            self.queue_waiting_for_users[userId] = _constructUser(self.instance_id, self.twitter_session, queueWaitingForUserData.get(userId,None), False, UserProjection.IdName(), None, subPrefetch)
+
+        subPrefetch.queue_waiting_for_users = self.queue_waiting_for_users
+
+        self.followees = dict()
+        for followeeId in followeeIds:
+            self.followees[followeeId] = _constructUser(self.instance_id, self.twitter_session, followeeData.get(followeeId,None), False, followeeProjection, None, subPrefetch)
+
+def processRawCursor(cursor, onIterationFunc, onBatchFunc=None, batchSize=None, numItems=None):
+    """ Passes documents read from cursor to onIterationFunc as they are, without constructing objects.
+        @param onBatchFunc if not None, called with each batch of batchSize documents before they are iterated.
+        @param numItems if not None, expected number of documents and iterations count documents,
+                        otherwise iterations are timestamps. """
+    if batchSize is None:
+        batchSize = UserPrefetch.BATCH_SIZE
+
+    if numItems is None:
+        cursorSize = getCursorSize(cursor)
+        getCurrentIterationFunc = rawTimestampIterationFunc
+    else:
+        cursorSize = numItems
+        getCurrentIterationFunc = None
+
+    if cursor is not None and onBatchFunc is not None:
+        cursor = _PrefetchingCursor(cursor, batchSize, onBatchFunc)
+
+    return processCursor(cursor, lambda data: data, onIterationFunc, cursorSize, getCurrentIterationFunc)
+
+class _PrefetchingCursor(object):
+    """ Reads from a cursor in batches, calling prefetchFunc with each batch
+        before its items are returned. """
+
+    def __init__(self, cursor, batchSize, prefetchFunc):
+        super(_PrefetchingCursor,self).__init__()
+
+        self.cursor = cursor
+        self.batch_size = batchSize
+        self.prefetch_func = prefetchFunc
+
+    @property
+    def upper_bound_timestamp(self):
+        return self.cursor.upper_bound_timestamp
+
+    def __iter__(self):
+        batch = []
+        for item in self.cursor:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self.prefetch_func(batch)
+                for batchItem in batch:
+                    yield batchItem
+                batch = []
+
+        if len(batch) > 0:
+            self.prefetch_func(batch)
+            for batchItem in batch:
+                yield batchItem
+
+    def close(self):
+        self.cursor.close()
+
+def _prefetchingUserCursor(cursor, prefetch):
+    if cursor is None:
+        return None
+
+    return _PrefetchingCursor(cursor, UserPrefetch.BATCH_SIZE, prefetch.load)
+
+# Maximum number of followers read with each user.
+FOLLOWERS_PAGE_SIZE = 200
+
+def _constructUser(instanceId, twitterSession, cacheData, recursive=True, userProjection=None, onIterationFunc=None, prefetch=None):
+    """ @param prefetch UserPrefetch which has loaded cacheData, or None to read everything individually. """
     if cacheData is None:
         return None
 
+    expandDocument(cacheData)
+
     geocodePlaceId = cacheData.get('geocode',None)
     if geocodePlaceId is None:
         geocode = None
+    elif prefetch is not None:
+        geocode = geocodeFromCacheById(geocodePlaceId, prefetchedPlaces=prefetch.places)
     else:
         geocode = geocodeFromCacheById(geocodePlaceId)
 
@@ -677,7 +1505,10 @@ def _constructUser(instanceId, twitterSession, cacheData, recursive=True, userPr
         for followeeId in known_followees_id:
             subUserIndex[0] += 1
 
-            followee = readUserFromCache(followeeId, twitterSession, instanceId, recursive=False, userProjection=followeeProjection)
+            if prefetch is not None and followeeId in prefetch.followees:
+                followee = prefetch.followees[followeeId]
+            else:
+                followee = readUserFromCache(followeeId, twitterSession, instanceId, recursive=False, userProjection=followeeProjection)
             if followee is not None:
                 known_followees.add(followee)
             else:
@@ -715,17 +1546,23 @@ def _constructUser(instanceId, twitterSession, cacheData, recursive=True, userPr
                 else:
                     return True
 
-            followersCursor = cursorUsersFromCache(instanceId, pageNum=0, pageSize=200, followeeOfRequirement=userId, userProjection=followerProjection, sortByTimestamp=False)
+            followersCursor = cursorUsersFromCache(instanceId, pageNum=0, pageSize=FOLLOWERS_PAGE_SIZE, followeeOfRequirement=userId, userProjection=followerProjection, sortByTimestamp=False)
+
+            followerPrefetch = UserPrefetch(instanceId, twitterSession, False, followerProjection)
+            followersCursor = _prefetchingUserCursor(followersCursor, followerPrefetch)
 
             assert num_followers is not None
-            processCursor(followersCursor, buildConstructUserFromCacheFunc(twitterSession, instanceId, recursive=False, userProjection=followerProjection, onIterationFunc=onFollowerLoadFunc), onFollowerLoadFunc, num_followers, None)
+            processCursor(followersCursor, buildConstructUserFromCacheFunc(twitterSession, instanceId, recursive=False, userProjection=followerProjection, onIterationFunc=onFollowerLoadFunc, prefetch=followerPrefetch), onFollowerLoadFunc, num_followers, None)
 
     tup = cacheData.get('follower_enrichment_progress',None)
     if tup is not None:
         queue_progress, user_progress, user_id_progress, enrichment_progress_description, queue_waiting_for_user = tup
 
         if queue_waiting_for_user is not None:
-            queue_waiting_for_user = readUserFromCache(queue_waiting_for_user, twitterSession, instanceId, recursive=False, userProjection=UserProjection.IdName())
+            if prefetch is not None and queue_waiting_for_user in prefetch.queue_waiting_for_users:
+                queue_waiting_for_user = prefetch.queue_waiting_for_users[queue_waiting_for_user]
+            else:
+                queue_waiting_for_user = readUserFromCache(queue_waiting_for_user, twitterSession, instanceId, recursive=False, userProjection=UserProjection.IdName())
 
         tup = (queue_progress,
                user_progress,
@@ -765,11 +1602,13 @@ def _constructUser(instanceId, twitterSession, cacheData, recursive=True, userPr
 
     return item
 
-def buildConstructUserFromCacheFunc(twitterSession, instanceId, recursive, userProjection, onIterationFunc=None):
-    return lambda(data): _constructUser(instanceId, twitterSession, data, recursive, userProjection, onIterationFunc)
+def buildConstructUserFromCacheFunc(twitterSession, instanceId, recursive, userProjection, onIterationFunc=None, prefetch=None):
+    return lambda(data): _constructUser(instanceId, twitterSession, data, recursive, userProjection, onIterationFunc, prefetch)
 
 def _constructTweet(instanceId, twitterSession, cacheData, retrieveUserData, userProjection):
     if cacheData is not None:
+        expandDocument(cacheData)
+
         geocode = geocodeFromCacheById(cacheData['geocode'])
         item = Tweet.FromCache(cacheData['data'], twitterSession, cacheData['timestamp'], geocode)
 
@@ -784,46 +1623,81 @@ def buildConstructTweetFromCacheFunc(twitterSession, instanceId, retrieveUserDat
     return lambda(data): _constructTweet(instanceId, twitterSession, data, retrieveUserData, userProjection)
 
 def readTweetFromCache(tweetId, twitterSession, instanceId, retrieveUserData=False, userProjection=None):
-    return _readItemFromCache(buildConstructTweetFromCacheFunc(twitterSession, instanceId, retrieveUserData, userProjection), getTweetCollection, tweetId, instanceId)
+    return _readItemFromCache(buildConstructTweetFromCacheFunc(twitterSession, instanceId, retrieveUserData, userProjection), getTweetCollectionsInRange, tweetId, instanceId)
 
 def readUserFromCache(userId, twitterSession, instanceId, recursive=True, userProjection=None):
-    return _readItemFromCache(buildConstructUserFromCacheFunc(twitterSession, instanceId, recursive, userProjection), getUserCollection, userId, instanceId, projection=userProjection)
+    if not recursive:
+        return _readItemFromCache(buildConstructUserFromCacheFunc(twitterSession, instanceId, recursive, userProjection), getUserCollectionsInRange, userId, instanceId, projection=userProjection)
 
-def readTweetsFromCache(twitterSession, instanceId, placeId=None, epochMsStartRange=None, epochMsEndRange=None, pageNum=None, pageSize=None, onIterationFunc=None, retrieveUserData=None, userProjection=None):
-    cursor = cursorItemsFromCache(instanceId, getTweetCollection, placeId, epochMsStartRange, epochMsEndRange, pageNum, pageSize)
-    return processCursor(cursor, buildConstructTweetFromCacheFunc(twitterSession, instanceId, retrieveUserData, userProjection), onIterationFunc, getCursorSize(cursor), timestampIterationFunc)
+    # Read followees together.
+    prefetch = UserPrefetch(instanceId, twitterSession, recursive, userProjection)
+    def constructFunc(data):
+        prefetch.load([data])
+        return _constructUser(instanceId, twitterSession, data, recursive, userProjection, None, prefetch)
 
-def cursorUsersFromCache(instanceId, placeId=None, epochMsStartRange=None, epochMsEndRange=None, pageNum=None, pageSize=None, followeeOfRequirement=None, isFollowersLoadedRequirement=None, associatedWithTweetRequirement=None, userProjection=None, sortByTimestamp=None):
-    customSearchCriteria = dict()
-    if followeeOfRequirement is not None:
-        customSearchCriteria.update({'known_followees' : followeeOfRequirement})
+    return _readItemFromCache(constructFunc, getUserCollectionsInRange, userId, instanceId, projection=userProjection)
 
-    if associatedWithTweetRequirement:
-        customSearchCriteria.update({'is_associated_with_tweet' : associatedWithTweetRequirement})
+def readTweetsFromCache(twitterSession, instanceId, placeId=None, epochMsStartRange=None, epochMsEndRange=None, pageNum=None, pageSize=None, onIterationFunc=None, retrieveUserData=None, userProjection=None, position=None):
+    """ @param position CursorPosition to read the page after, it is advanced past the items returned. """
+    cursor = cursorItemsFromCache(instanceId, getTweetCollectionsInRange, placeId, epochMsStartRange, epochMsEndRange, pageNum, pageSize, position=position)
+    results = processCursor(cursor, buildConstructTweetFromCacheFunc(twitterSession, instanceId, retrieveUserData, userProjection), onIterationFunc, getCursorSize(cursor), timestampIterationFunc)
 
-    if isFollowersLoadedRequirement:
-        customSearchCriteria.update({'is_followers_loaded' : isFollowersLoadedRequirement})
+    if position is not None:
+        position.advanceAll(results)
 
-    usesTimestampField = epochMsStartRange is not None or epochMsEndRange is not None or sortByTimestamp is not None
+    return results
 
+def getTweetQueryHint(usesTimestampField, usesPlaceField):
+    """ @return index cursorItemsFromCache hints for a query of tweets, None for no hint. """
+    if usesTimestampField:
+        if usesPlaceField:
+            return [('geocode.placeId', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)]
+        else:
+            return [('timestamp', pymongo.ASCENDING)]
+    else:
+        if usesPlaceField:
+            return [('geocode.placeId', pymongo.ASCENDING)]
+        else:
+            return None
+
+def getUserQueryHint(usesFolloweeField, usesPlaceField, usesFollowersLoadedField, usesTimestampField):
+    """ @return index cursorUsersFromCache hints for a query of users. """
     hint = list()
 
-    # Hints must match ensure_index during writing.
-    if followeeOfRequirement is not None:
+    # Hints must match indexes registered with registerCollectionIndex.
+    if usesFolloweeField:
         hint.append(('known_followees', pymongo.ASCENDING))
     else:
-        if placeId is not None:
+        if usesPlaceField:
             hint.append(('geocode.placeId', pymongo.ASCENDING))
 
-        if isFollowersLoadedRequirement is not None:
+        if usesFollowersLoadedField:
             hint.append(('is_followers_loaded', pymongo.ASCENDING))
 
             if usesTimestampField:
                 hint.append(('timestamp', pymongo.ASCENDING))
 
-    return cursorItemsFromCache(instanceId, getUserCollection, placeId, epochMsStartRange, epochMsEndRange, pageNum, pageSize, customSearchCriteria, userProjection, sortByTimestamp, hint)
+    return hint
+
+def cursorUsersFromCache(instanceId, placeId=None, epochMsStartRange=None, epochMsEndRange=None, pageNum=None, pageSize=None, followeeOfRequirement=None, isFollowersLoadedRequirement=None, associatedWithTweetRequirement=None, userProjection=None, sortByTimestamp=None, position=None, workload=None):
+    customSearchCriteria = dict()
+    if followeeOfRequirement is not None:
+        customSearchCriteria.update({'known_followees' : followeeOfRequirement})
+
+    if associatedWithTweetRequirement:
+        customSearchCriteria.update({'is_associated_with_tweet' : associatedWithTweetRequirement})
+
+    if isFollowersLoadedRequirement:
+        customSearchCriteria.update({'is_followers_loaded' : isFollowersLoadedRequirement})
+
+    usesTimestampField = epochMsStartRange is not None or epochMsEndRange is not None or sortByTimestamp is not None
+
+    hint = getUserQueryHint(followeeOfRequirement is not None, placeId is not None, isFollowersLoadedRequirement is not None, usesTimestampField)
+
+    return cursorItemsFromCache(instanceId, getUserCollectionsInRange, placeId, epochMsStartRange, epochMsEndRange, pageNum, pageSize, customSearchCriteria, userProjection, sortByTimestamp, hint, position, workload)
 
-def readUsersFromCache(twitterSession, instanceId, placeId=None, epochMsStartRange=None, epochMsEndRange=None, pageNum=None, pageSize=None, followeeOfRequirement=None, isFollowersLoadedRequirement=None, associatedWithTweetRequirement=None, recursive=True, userProjection=None, onIterationFunc=None, sortByTimestamp=None):
+def readUsersFromCache(twitterSession, instanceId, placeId=None, epochMsStartRange=None, epochMsEndRange=None, pageNum=None, pageSize=None, followeeOfRequirement=None, isFollowersLoadedRequirement=None, associatedWithTweetRequirement=None, recursive=True, userProjection=None, onIterationFunc=None, sortByTimestamp=None, position=None):
+    """ @param position CursorPosition to read the page after, it is advanced past the items returned. """
     lastIteration = [0]
     lastTotal = [0]
     def onCacheIteration(iteration, total, isFinished, data, iteratorId):
@@ -847,5 +1721,14 @@ def readUsersFromCache(twitterSession, instanceId, placeId=None, epochMsStartRan
     else:
         iterationFuncToUse = None
 
-    cursor = cursorUsersFromCache(instanceId, placeId, epochMsStartRange, epochMsEndRange, pageNum, pageSize, followeeOfRequirement, isFollowersLoadedRequirement, associatedWithTweetRequirement, userProjection, sortByTimestamp)
-    return processCursor(cursor, buildConstructUserFromCacheFunc(twitterSession, instanceId, recursive, userProjection, iterationFuncToUse), iterationFuncToUse, getCursorSize(cursor), timestampIterationFunc)
\ No newline at end of file
+    cursor = cursorUsersFromCache(instanceId, placeId, epochMsStartRange, epochMsEndRange, pageNum, pageSize, followeeOfRequirement, isFollowersLoadedRequirement, associatedWithTweetRequirement, userProjection, sortByTimestamp, position)
+
+    prefetch = UserPrefetch(instanceId, twitterSession, recursive, userProjection)
+    cursor = _prefetchingUserCursor(cursor, prefetch)
+
+    results = processCursor(cursor, buildConstructUserFromCacheFunc(twitterSession, instanceId, recursive, userProjection, iterationFuncToUse, prefetch), iterationFuncToUse, getCursorSize(cursor), timestampIterationFunc)
+
+    if position is not None:
+        position.advanceAll(results)
+
+    return results
\ No newline at end of file
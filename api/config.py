@@ -12,6 +12,7 @@ import math
 GE_GOOGLE = 1
 GE_MAP_QUEST = 2
 GE_GEO_NET = 3
+GE_GAZETTEER = 4
 
 class Configuration:
     # The server listens for connections on this IP/port
@@ -89,6 +90,8 @@ class Configuration:
     # GE_GOOGLE and GE_MAP_QUEST are external data providers.
     # GE_GEO_NET represents internal memory that we load from a CSV file
     # containing country and continent information.
+    # GE_GAZETTEER is a file of cities that we load into memory, it can be used
+    # instead of an external provider and is not rate limited.
     # To switch between external providers you only need to change
     # GEOCODE_EXTERNAL_PROVIDER. Everything will run as normal without
     # further configuration changes.
@@ -106,6 +109,17 @@ class Configuration:
     # This value is specified in milliseconds.
     TEMPORAL_STEP = 15 * 1000
 
+    # Temporal influence data is accumulated in memory and written periodically, and when
+    # moving to the next temporal step. This is how often (milliseconds) we write. Data
+    # accumulated since the last write is lost if the server stops.
+    TEMPORAL_AGGREGATOR_ENABLED = True
+    TEMPORAL_AGGREGATOR_FLUSH_MS = 5000
+
+    # The last time ID of each temporal source is kept in memory and written to the instance
+    # lifetime collection this often (milliseconds), and when the server stops. If the server
+    # does not stop cleanly, checkpoints are corrected from temporal data when instances are loaded.
+    TEMPORAL_CHECKPOINT_FLUSH_MS = 5000
+
     # We store geocode data in memory aswell as in the database for performance.
     # This value is the number of geocode entries to store in memory at any one time.
     # The in memory cache is a 'least recently used' cache.
@@ -113,10 +127,57 @@ class Configuration:
 
     GEOCODE_QUERY_IN_MEMORY_CACHE_SIZE = 50000
 
+    # Geocode queries which we looked up and found are not in the database are remembered
+    # for this long, so that common unknown locations don't cause a database read every time.
+    # A query is forgotten as soon as we write a result for it.
+    GEOCODE_QUERY_NEGATIVE_CACHE_SIZE = 50000
+    GEOCODE_QUERY_NEGATIVE_CACHE_TTL_MS = 1000 * 60 * 30
+
+    # The in memory geocode caches are written to this file when the server stops, and every
+    # GEOCODE_CACHE_SNAPSHOT_MS (0 for only when stopping), and are read back when it starts so that
+    # geocoding from memory doesn't start cold. Leave the file name empty to disable snapshots.
+    GEOCODE_CACHE_SNAPSHOT_FILE = 'geocode_cache_snapshot.json.gz'
+    GEOCODE_CACHE_SNAPSHOT_MS = 1000 * 60 * 15
+
+    # If there is no snapshot, the caches are filled with the queries which were found most often,
+    # counted in memory and added to the geocode collection every GEOCODE_QUERY_HITS_FLUSH_MS.
+    GEOCODE_CACHE_WARM_UP_FROM_DATABASE = True
+    GEOCODE_QUERY_HITS_FLUSH_MS = 1000 * 60
+
+    # Geocode processes (see GEOCODE_FROM_CACHE_PROCESS_MODE_ENABLED) each have their own in memory
+    # caches. If enabled, the server process also publishes what it geocodes and warms up to fixed
+    # size tables in memory mapped files which every geocode process reads before going to the database.
+    # Tables are created at start up, one file for queries and one for places, with names starting
+    # with the prefix and the server's process ID (/dev/shm keeps them in memory), and deleted when
+    # the server stops. Items bigger than a slot are not shared, slots can be at most 65551 bytes.
+    GEOCODE_SHARED_CACHE_ENABLED = False
+    GEOCODE_SHARED_CACHE_FILE_PREFIX = '/dev/shm/geotweetsearch_geocode'
+    GEOCODE_SHARED_CACHE_QUERY_SLOTS = 262144
+    GEOCODE_SHARED_CACHE_QUERY_SLOT_SIZE = 512
+    GEOCODE_SHARED_CACHE_PLACE_SLOTS = 65536
+    GEOCODE_SHARED_CACHE_PLACE_SLOT_SIZE = 2048
+
     # Files to load GE_GEO_NET data from.
     COUNTRY_DATA_CSV = 'country_data.csv'
     CONTINENT_DATA_CSV = 'continent_data.csv'
 
+    # File to load GE_GAZETTEER data from, in the tab separated format of GeoNames city dumps
+    # e.g. cities1000.txt from http://download.geonames.org/export/dump/.
+    # Cities with a smaller population are not loaded. If alternate names are disabled cities
+    # are only found by their name, which saves a lot of memory.
+    # A query is matched to at most GAZETTEER_MAX_RESULTS cities, most populated first.
+    GAZETTEER_DATA_FILE = 'cities1000.txt'
+    GAZETTEER_MIN_POPULATION = 0
+    GAZETTEER_ALTERNATE_NAMES_ENABLED = True
+    GAZETTEER_MAX_RESULTS = 10
+
+    # Users whose tweet is geotagged, or who tweet from a Twitter place, are geocoded to the
+    # nearest cached place within this distance (km) of where they tweeted from, found with a
+    # spatial index, instead of by their location text. If there is none in range, the country
+    # containing the coordinate is used if it is an acceptable place type.
+    REVERSE_GEOCODE_ENABLED = True
+    REVERSE_GEOCODE_MAX_DISTANCE_KM = 25
+
     # Twitter specifies maximum 25 geographical areas may
     # be specified in connection to streaming API.
     # This value sets an input limit on the instance setup page.
@@ -201,6 +262,10 @@ class Configuration:
     # for browsers to display without slowing them down alot.
     DISPLAY_MAX_NUM_INFLUENCE_RECORDS_PER_PLACE_TYPE = 20
 
+    # Number of influence page results to keep in memory. Only results for
+    # time ranges which have finished are kept since they never change.
+    INFLUENCE_RESULT_CACHE_SIZE = 2000
+
     LOG_DROP_AMOUNT_FREQ_MS = 60000
 
     PROJECT_NAME = 'GeoTweetSearch'
@@ -209,12 +274,48 @@ class Configuration:
     NUM_ANALYSIS_WORKERS = 3
     NUM_GEOCODE_FROM_CACHE_WORKERS_MEMORY_ONLY = 2
 
+    # If enabled, geocoding from cache is done by child processes so that it is not limited
+    # to one core. Worker threads above hand users to the processes and wait for results,
+    # so there should be at least as many workers as processes.
+    GEOCODE_FROM_CACHE_PROCESS_MODE_ENABLED = False
+
+    # Number of geocode processes, if 0 then one per CPU core.
+    GEOCODE_FROM_CACHE_NUM_PROCESSES = 0
+
     ANALYSIS_INPUT_THREAD_SIZE_CAP = 25
     GEOCODE_FROM_CACHE_PRIMARY_FAILURE_OUTPUT_QUEUE_SIZE = 10
     GEOCODE_FROM_EXTERNAL_INPUT_THREAD_SIZE_CAP_FOLLOWER_ENRICHMENT = 50
     GEOCODE_FROM_CACHE_INPUT_THREAD_SIZE_CAP = 200
 
-    GEOCODE_FROM_CACHE_THREAD_WAIT_TIME_MS = 100
+    # Queues between pipeline threads are bounded by the sizes above. When an item that
+    # we can afford to lose is offered to a full queue one of these policies is applied:
+    #   drop  - the item is discarded.
+    #   block - the thread offering waits until there is space, slowing down earlier stages.
+    #   spill - the item is passed to the queue's spill queue (geocode queues spill to analysis).
+    # Items that must not be lost (e.g. follower information) are always queued.
+    # Users waiting for the external geocoder with the same location text (see User.geocode_query_key)
+    # are grouped, joining a group does not count towards the queue size. Groups with the most users are
+    # geocoded first, with one external lookup, after which the rest of the group are geocoded from the cache.
+    # A group which has waited GEOCODE_FROM_EXTERNAL_MAX_GROUP_WAIT_MS goes first whatever its size, and users
+    # offered to a group of GEOCODE_FROM_EXTERNAL_MAX_GROUP_SIZE are spilled.
+    GEOCODE_FROM_EXTERNAL_COALESCING_ENABLED = True
+    GEOCODE_FROM_EXTERNAL_MAX_GROUP_SIZE = 1000
+    GEOCODE_FROM_EXTERNAL_MAX_GROUP_WAIT_MS = 1000 * 60
+
+    PIPELINE_QUEUE_POLICIES = {'geocode_cache_memory_input' : 'drop',
+                               'geocode_cache_input' : 'spill',
+                               'geocode_external_input' : 'spill',
+                               'follower_extractor_gate_input' : 'drop',
+                               'analysis_input' : 'drop'}
+
+    # Rate at which the database geocode from cache stage processes items, shared by all
+    # of its workers. The rate starts at the maximum and is halved when database lookups
+    # average more than the target latency, then increases again while they are faster,
+    # see AdaptiveRateLimiter.
+    GEOCODE_FROM_CACHE_TARGET_LATENCY_MS = 100
+    GEOCODE_FROM_CACHE_MINIMUM_RATE = 10 # per second
+    GEOCODE_FROM_CACHE_MAXIMUM_RATE = 2000 # per second
+    GEOCODE_FROM_CACHE_RATE_INCREASE = 20 # per second, every second
 
     ENABLE_MONGO_PROFILING = False
     MONGO_PROFILING_LEVEL = 1
@@ -226,6 +327,89 @@ class Configuration:
 
     MONGO_WRITE_CONCERN_ENABLED = True
 
+    # If enabled each workload (see caching_shared) has its own connection pool, so that a slow workload such as bulk
+    # downloads cannot use up the connections another depends on. Settings are per workload, workloads not listed
+    # use MONGO_OPERATION_TIMEOUT, MONGO_WRITE_CONCERN_ENABLED, the driver's pool size and primary read preference.
+    # Geocode cache reads are small so give up sooner, bulk downloads read whole collections so are given longer.
+    MONGO_WORKLOAD_CLIENTS_ENABLED = True
+    MONGO_WORKLOAD_POOL_SIZE = {'ingest' : '50', 'geocode' : '30', 'export' : '5'}
+    MONGO_WORKLOAD_OPERATION_TIMEOUT = {'geocode' : '30000', 'export' : '600000'}
+    MONGO_WORKLOAD_WRITE_CONCERN = {}
+    MONGO_WORKLOAD_READ_PREFERENCE = {'export' : 'secondaryPreferred'}
+
+    # Tweets and users are not written to the database one at a time, instead
+    # they are accumulated per collection and written as unordered bulk operations.
+    # A batch is flushed when it reaches MONGO_WRITE_BATCH_SIZE operations or when its
+    # oldest operation is older than MONGO_WRITE_BATCH_MAX_AGE_MS.
+    #
+    # If more than MONGO_WRITE_BATCH_MAX_PENDING operations are waiting to be written
+    # across all collections, the thread adding to the batch will write synchronously.
+    # This slows down analysis threads so that their input queues fill and upstream
+    # threads drop data, instead of us buffering an unlimited amount in memory.
+    MONGO_WRITE_BATCH_ENABLED = True
+    MONGO_WRITE_BATCH_SIZE = 500
+    MONGO_WRITE_BATCH_MAX_AGE_MS = 1000
+    MONGO_WRITE_BATCH_MAX_PENDING = 5000
+
+    # We remember in memory which users of each instance have had their followers loaded
+    # or are queued for follower enrichment, so the follower extractor gate does not
+    # read every user from the database. If an instance has more of these users than this
+    # we stop remembering them and go back to reading from the database.
+    USER_ENRICHMENT_STATE_INDEX_MAX_SIZE = 500000
+
+    # Tweet and user documents normally store all JSON received from Twitter, most of which
+    # we never read. If enabled only the fields listed here are stored as they are, nested fields
+    # separated by '.', everything else is compressed into one field which is only read
+    # when the whole JSON is needed (bulk downloads). If COMPACT_STORAGE_KEEP_REMAINDER is false
+    # everything else is discarded instead.
+    #
+    # Documents written before this was enabled are still read, use --compact_instance_data to convert them.
+    COMPACT_STORAGE_ENABLED = False
+    COMPACT_STORAGE_KEEP_REMAINDER = True
+    COMPACT_STORAGE_COMPRESSION_LEVEL = 6 # zlib, 1 is fastest and 9 is smallest.
+    COMPACT_STORAGE_TWEET_FIELDS = ['id',
+                                    'created_at',
+                                    'text',
+                                    'extended_tweet.full_text',
+                                    'retweeted_status.extended_tweet.full_text',
+                                    'retweet_count',
+                                    'coordinates',
+                                    'place',
+                                    'user.id',
+                                    'user.name',
+                                    'user.screen_name',
+                                    'user.location',
+                                    'user.description',
+                                    'user.profile_image_url',
+                                    'user.followers_count']
+    COMPACT_STORAGE_USER_FIELDS = ['id',
+                                   'name',
+                                   'screen_name',
+                                   'location',
+                                   'description',
+                                   'profile_image_url',
+                                   'followers_count']
+
+    # Tweets of an instance can be split into one collection per time bucket, so that reads of a time range
+    # only touch the buckets overlapping it and old tweets can be removed by dropping whole buckets.
+    # 0 disables bucketing (one tweet collection per instance), e.g. 1000 * 60 * 60 * 24 for daily buckets.
+    # Tweets written before bucketing was enabled remain readable in the unbucketed collection.
+    TWEET_BUCKET_SIZE_MS = 0
+
+    # Buckets older than this are dropped when a new bucket is first written to,
+    # 0 keeps buckets until the instance is shut down. Ignored if bucketing is disabled.
+    TWEET_BUCKET_RETENTION_MS = 0
+
+    # Number of tweets per place and time bucket are kept as tweets are written, so that counts and histograms
+    # of a time range can be read without counting tweets. Buckets are the smallest histogram
+    # interval, a count of a time range includes the whole bucket the range starts in.
+    TWEET_COUNT_ROLLUP_ENABLED = True
+    TWEET_COUNT_BUCKET_SIZE_MS = 60000
+
+    # Indexes of instance collections are created once when the collection is first used.
+    # Building in the background does not lock the database, but takes longer.
+    MONGO_BUILD_INDEXES_IN_BACKGROUND = True
+
     # See THREAD_FAILURE_DEFAULT_MAXIMUM_COUNT documentation.
     #
     # Thread failure count is reset after THREAD_FAILURE_DEFAULT_MAXIMUM_BACKOFF * 2 time, so
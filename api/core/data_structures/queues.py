@@ -1,21 +1,99 @@
 from Queue import Queue, Empty
+from collections import deque
+import heapq
 from threading import RLock, Thread, Event
 import time
+import unittest
 import gevent
 from api.core import utility
 
 __author__ = 'Michael Pryor'
 
 class QueueEx(Queue):
-    """ Implements an iterator on top of the queue class """
-    def __init__(self, continueRunningCheck=None, checkFrequency=None):
+    """ Implements an iterator on top of the queue class.
+
+        Items added with put are never dropped, put ignores maxSize on purpose so that
+        items which must not be lost can still be added to a full queue. Items added with
+        offer are subject to maxSize, if the queue is full then the overflow policy is applied:
+            - POLICY_DROP: item is discarded.
+            - POLICY_BLOCK: wait until there is space.
+            - POLICY_SPILL: item is offered to spillQueue instead (discarded if there is no spill queue,
+                            or the spill queue discards it). """
+
+    POLICY_DROP = 'drop'
+    POLICY_BLOCK = 'block'
+    POLICY_SPILL = 'spill'
+
+    # Results of offer.
+    QUEUED = 1
+    DROPPED = 2
+    SPILLED = 3
+
+    def __init__(self, continueRunningCheck=None, checkFrequency=None, maxSize=None, overflowPolicy=None, spillQueue=None):
         Queue.__init__(self)
 
         if continueRunningCheck is None:
             continueRunningCheck = lambda: True
 
+        if overflowPolicy is None:
+            overflowPolicy = QueueEx.POLICY_DROP
+
+        assert overflowPolicy in (QueueEx.POLICY_DROP, QueueEx.POLICY_BLOCK, QueueEx.POLICY_SPILL)
+
         self.continue_running_check = continueRunningCheck
         self.check_frequency = checkFrequency
+        self.max_size = maxSize
+        self.overflow_policy = overflowPolicy
+        self.spill_queue = spillQueue
+
+        self.num_dropped = 0
+        self.num_spilled = 0
+
+    def offer(self, item):
+        """ Adds item to the queue, applying the overflow policy if the queue is full.
+            @return QUEUED, DROPPED or SPILLED. """
+        if self.max_size is None:
+            self.put(item)
+            return QueueEx.QUEUED
+
+        if self.overflow_policy == QueueEx.POLICY_BLOCK:
+            # Queue.get notifies not_full every time an item is removed.
+            with self.not_full:
+                while self._qsize() >= self.max_size:
+                    self.not_full.wait()
+
+                self._putLocked(item)
+
+            return QueueEx.QUEUED
+
+        if self.qsize() < self.max_size:
+            self.put(item)
+            return QueueEx.QUEUED
+
+        return self._overflow(item)
+
+    def _putLocked(self, item):
+        """ Same as put, call with mutex held. """
+        self._put(item)
+        self.unfinished_tasks += 1
+        self.not_empty.notify()
+
+    def _overflow(self, item):
+        """ Applies the drop or spill overflow policy to an item which there is no space for.
+            @return DROPPED or SPILLED. """
+        if self.overflow_policy == QueueEx.POLICY_SPILL and self.spill_queue is not None:
+            if isinstance(self.spill_queue, QueueEx):
+                spillResult = self.spill_queue.offer(item)
+            else:
+                self.spill_queue.put(item)
+                spillResult = QueueEx.QUEUED
+
+            if spillResult != QueueEx.DROPPED:
+                self.num_spilled += 1
+                return QueueEx.SPILLED
+
+        self.num_dropped += 1
+        return QueueEx.DROPPED
 
     def __iter__(self):
         while True:
@@ -25,6 +103,217 @@ class QueueEx(Queue):
                 if not self.continue_running_check():
                     return
 
+class testQueueEx(unittest.TestCase):
+    def testOverflow(self):
+        spillQueue = QueueEx(maxSize=1)
+        queue = QueueEx(maxSize=1, overflowPolicy=QueueEx.POLICY_SPILL, spillQueue=spillQueue)
+
+        assert queue.offer(1) == QueueEx.QUEUED
+        assert queue.offer(2) == QueueEx.SPILLED
+        assert queue.offer(3) == QueueEx.DROPPED
+        assert queue.num_spilled == 1 and queue.num_dropped == 1
+
+        # Not bounded.
+        queue.put(4)
+        assert queue.qsize() == 2
+
+
+class CoalescingQueue(QueueEx):
+    """ Queue of items grouped by keyFunc(item). An item with the same key as items already waiting
+        joins their group instead of taking a place of its own, and maxSize limits the number of groups.
+        A group with maxGroupSize items is full, items offered to it are subject to the overflow policy
+        as if the queue was full (POLICY_BLOCK drops them, a group may not shrink for a long time).
+
+        get returns a whole group as a list, the group with most items first, then the oldest.
+        A group which has waited maxGroupWaitMs is returned before any other, so that small groups
+        are not held back forever by a stream of larger ones.
+
+        Until completeGroup is called with its key, items with that key are kept aside
+        for the consumer of the group. """
+
+    # The priority heap is rebuilt when it holds this many times more entries than there are groups.
+    MAX_HEAP_ENTRIES_PER_GROUP = 4
+
+    def __init__(self, keyFunc, continueRunningCheck=None, checkFrequency=None, maxSize=None, overflowPolicy=None, spillQueue=None, maxGroupSize=None, maxGroupWaitMs=None):
+        self.key_func = keyFunc
+        self.max_group_size = maxGroupSize
+        self.max_group_wait = maxGroupWaitMs
+        QueueEx.__init__(self, continueRunningCheck, checkFrequency, maxSize, overflowPolicy, spillQueue)
+
+    def _init(self, maxsize):
+        # Key -> (sequence number of first item, list of items).
+        self.groups = dict()
+
+        # Key -> items which arrived after get returned their group.
+        self.in_flight = dict()
+
+        # Entries are (-number of items, sequence number of first item, key). An entry is added every
+        # time a group grows, entries which no longer match their group are skipped, or removed when
+        # there are too many of them.
+        self.priority_heap = []
+        self.sequence = 0
+
+        # (sequence number of first item, epoch ms of first item, key) of groups in the order they
+        # were created. Entries of groups which have gone are skipped when they reach the front.
+        self.arrival_order = deque()
+
+        self.num_joined = 0
+
+    def _qsize(self, len=len):
+        return len(self.groups)
+
+    def _getGroupItems(self, key):
+        """ @return items with key which are waiting or in flight, None if there are none. """
+        inFlight = self.in_flight.get(key, None)
+        if inFlight is not None:
+            return inFlight
+
+        group = self.groups.get(key, None)
+        if group is not None:
+            return group[1]
+
+        return None
+
+    def _isCurrent(self, key, sequence):
+        group = self.groups.get(key, None)
+        return group is not None and group[0] == sequence
+
+    def _put(self, item):
+        key = self.key_func(item)
+
+        inFlight = self.in_flight.get(key, None)
+        if inFlight is not None:
+            inFlight.append(item)
+            self.num_joined += 1
+            return
+
+        group = self.groups.get(key, None)
+        if group is None:
+            group = (self.sequence, [])
+            self.groups[key] = group
+            self.arrival_order.append((self.sequence, utility.getEpochMs(), key))
+        else:
+            self.num_joined += 1
+
+        group[1].append(item)
+        heapq.heappush(self.priority_heap, (-len(group[1]), group[0], key))
+        self.sequence += 1
+
+        if len(self.priority_heap) > (len(self.groups) + 1) * CoalescingQueue.MAX_HEAP_ENTRIES_PER_GROUP:
+            self.priority_heap = [(-len(items), sequence, key) for key, (sequence, items) in self.groups.iteritems()]
+            heapq.heapify(self.priority_heap)
+
+    def _takeOldestIfWaitedTooLong(self):
+        """ @return key of oldest group if it has waited max group wait, None otherwise. """
+        while len(self.arrival_order) > 0:
+            sequence, arrivalTime, key = self.arrival_order[0]
+            if not self._isCurrent(key, sequence):
+                self.arrival_order.popleft()
+                continue
+
+            if self.max_group_wait is not None and utility.getEpochMs() - arrivalTime >= self.max_group_wait:
+                self.arrival_order.popleft()
+                return key
+
+            return None
+
+        return None
+
+    def _get(self):
+        key = self._takeOldestIfWaitedTooLong()
+
+        while key is None:
+            negativeCount, sequence, heapKey = heapq.heappop(self.priority_heap)
+            if self._isCurrent(heapKey, sequence) and len(self.groups[heapKey][1]) == -negativeCount:
+                key = heapKey
+
+        group = self.groups.pop(key)
+        if len(self.groups) == 0:
+            del self.priority_heap[:]
+            self.arrival_order.clear()
+
+        self.in_flight[key] = []
+        return group[1]
+
+    def offer(self, item):
+        """ Items joining a group are queued unless the group is full, otherwise see QueueEx.offer. """
+        key = self.key_func(item)
+
+        with self.not_full:
+            while True:
+                items = self._getGroupItems(key)
+                if items is not None:
+                    if self.max_group_size is None or len(items) < self.max_group_size:
+                        self._putLocked(item)
+                        return QueueEx.QUEUED
+                    break
+
+                if self.max_size is None or self._qsize() < self.max_size:
+                    self._putLocked(item)
+                    return QueueEx.QUEUED
+
+                if self.overflow_policy != QueueEx.POLICY_BLOCK:
+                    break
+
+                # Queue.get notifies not_full every time a group is removed.
+                self.not_full.wait()
+
+        return self._overflow(item)
+
+    def completeGroup(self, key):
+        """ Call when finished with a group returned by get.
+            @return items with the group's key which arrived since get. """
+        with self.mutex:
+            return self.in_flight.pop(key, [])
+
+
+class testCoalescingQueue(unittest.TestCase):
+    def testGroups(self):
+        queue = CoalescingQueue(lambda item: item[0], maxSize=2)
+
+        assert queue.offer('a1') == QueueEx.QUEUED
+        assert queue.offer('b1') == QueueEx.QUEUED
+        assert queue.offer('b2') == QueueEx.QUEUED
+        assert queue.offer('c1') == QueueEx.DROPPED
+        assert queue.offer('a2') == QueueEx.QUEUED
+        assert queue.offer('b3') == QueueEx.QUEUED
+        assert queue.qsize() == 2
+
+        assert queue.get() == ['b1', 'b2', 'b3']
+        queue.put('b4')
+        assert queue.qsize() == 1
+        assert queue.completeGroup('b') == ['b4']
+
+        # Equal size groups come out oldest first.
+        queue.put('d1')
+        queue.put('d2')
+        assert queue.get() == ['a1', 'a2']
+        assert queue.get() == ['d1', 'd2']
+        assert queue.qsize() == 0
+
+    def testLimits(self):
+        queue = CoalescingQueue(lambda item: item[0], maxGroupSize=2)
+        assert queue.offer('a1') == QueueEx.QUEUED
+        assert queue.offer('a2') == QueueEx.QUEUED
+        assert queue.offer('a3') == QueueEx.DROPPED
+
+        # Growing one group many times does not grow the heap without limit.
+        queue = CoalescingQueue(lambda item: item[0])
+        for n in range(1000):
+            queue.put('a%d' % n)
+        assert len(queue.priority_heap) <= 2 * CoalescingQueue.MAX_HEAP_ENTRIES_PER_GROUP
+        assert len(queue.get()) == 1000
+
+    def testMaxWait(self):
+        # Every group has waited long enough, so the oldest comes first whatever its size.
+        queue = CoalescingQueue(lambda item: item[0], maxGroupWaitMs=0)
+        queue.put('a1')
+        queue.put('b1')
+        queue.put('b2')
+        assert queue.get() == ['a1']
+        assert queue.get() == ['b1', 'b2']
+
+
 class QueueGreenlet(Queue):
     """ Implements an iterator on top of the queue class """
     def __init__(self, continueRunningCheck=None, checkFrequency=None):
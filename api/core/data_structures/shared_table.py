@@ -0,0 +1,286 @@
+import hashlib
+import mmap
+import os
+import struct
+from threading import Lock
+import unittest
+from api.core.utility import createBlockingPipe
+
+__author__ = 'Michael Pryor'
+
+# A fixed capacity hash table of byte string keys and values in a memory mapped file,
+# so that several processes can share it without copying. One process, the owner,
+# creates the file and writes to it. Other processes open it read only.
+#
+# Readers take no locks. Each slot has a sequence number which the owner makes odd
+# while it writes to the slot and even when finished (a sequence lock). A reader copies
+# the slot and checks the sequence number did not change and was not odd, otherwise it
+# tries again. This relies on stores being seen in order, as they are on x86.
+#
+# Keys are found by open addressing with a short probe sequence. Nothing is ever removed,
+# when the probe sequence is full a new key replaces one of its keys, so the table
+# behaves as a cache and never fills up.
+
+HEADER = struct.Struct('<8sII') # magic, number of slots, slot size.
+HEADER_MAGIC = 'GTSHTB01'
+
+SLOT_SEQUENCE = struct.Struct('<I')
+SLOT_HEADER = struct.Struct('<IQHH') # sequence, key hash, key length, value length.
+
+MAX_ITEM_SIZE = 0xFFFF
+MAX_PROBES = 8
+MAX_READ_ATTEMPTS = 100
+
+def _hashKey(key):
+    keyHash = struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+    # 0 marks empty slots.
+    if keyHash == 0:
+        keyHash = 1
+
+    return keyHash
+
+
+class SharedHashTable(object):
+    def __init__(self, fileName, numSlots=None, slotSize=None, isOwner=False):
+        """ @param numSlots, slotSize only needed by the owner, which creates an empty table
+                                     replacing any existing file. Readers get them from the file.
+            @param slotSize bytes per slot, keys and values longer than slotSize minus 16 bytes are not stored. """
+        super(SharedHashTable,self).__init__()
+
+        self.file_name = fileName
+        self.is_owner = isOwner
+
+        if isOwner:
+            assert numSlots > 0 and slotSize > SLOT_HEADER.size
+
+            # Lengths of keys and values are stored in 2 bytes.
+            assert slotSize <= SLOT_HEADER.size + MAX_ITEM_SIZE
+
+            # Created under another name and renamed, so that a reader of an existing
+            # file keeps its mapping and never sees a truncated file.
+            temporaryFileName = fileName + '.tmp'
+            with open(temporaryFileName, 'wb') as tableFile:
+                tableFile.write(HEADER.pack(HEADER_MAGIC, numSlots, slotSize))
+                tableFile.truncate(HEADER.size + numSlots * slotSize)
+
+            self._file = open(temporaryFileName, 'r+b')
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE)
+            os.rename(temporaryFileName, fileName)
+        else:
+            self._file = open(fileName, 'rb')
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, numSlots, slotSize = HEADER.unpack_from(self._map, 0)
+        if magic != HEADER_MAGIC:
+            self.close()
+            raise ValueError('File %s is not a shared hash table' % fileName)
+
+        self.num_slots = numSlots
+        self.slot_size = slotSize
+        self.max_item_size = slotSize - SLOT_HEADER.size
+
+        # Threads of the owner take turns to write.
+        self._write_lock = Lock()
+        self._num_replacements = 0
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_read_retries = 0
+
+    def close(self, removeFile=False):
+        """ @param removeFile if true and this is the owner the file is deleted,
+                               processes which still have it open can keep reading it. """
+        self._map.close()
+        self._file.close()
+
+        if removeFile and self.is_owner:
+            try:
+                os.remove(self.file_name)
+            except OSError:
+                pass
+
+    def _getSlotOffset(self, keyHash, probe):
+        return HEADER.size + ((keyHash + probe) % self.num_slots) * self.slot_size
+
+    def _readSlot(self, offset):
+        """ @return consistent copy of slot, None if the owner kept writing to it. """
+        for attempt in xrange(MAX_READ_ATTEMPTS):
+            sequence = SLOT_SEQUENCE.unpack_from(self._map, offset)[0]
+            if sequence % 2 == 0:
+                slot = self._map[offset:offset + self.slot_size]
+                if SLOT_SEQUENCE.unpack_from(self._map, offset)[0] == sequence:
+                    return slot
+
+            self.num_read_retries += 1
+
+        return None
+
+    def get(self, key):
+        """ @return value of key, None if not in the table. """
+        keyHash = _hashKey(key)
+
+        for probe in xrange(MAX_PROBES):
+            slot = self._readSlot(self._getSlotOffset(keyHash, probe))
+            if slot is None:
+                continue
+
+            sequence, slotKeyHash, keyLength, valueLength = SLOT_HEADER.unpack_from(slot, 0)
+            if slotKeyHash == 0:
+                # Empty, key would have been put here.
+                break
+
+            if slotKeyHash == keyHash and slot[SLOT_HEADER.size:SLOT_HEADER.size + keyLength] == key:
+                self.num_hits += 1
+                start = SLOT_HEADER.size + keyLength
+                return slot[start:start + valueLength]
+
+        self.num_misses += 1
+        return None
+
+    def put(self, key, value):
+        """ Owner only.
+            @return false if key and value are too big for a slot. """
+        assert self.is_owner
+
+        if len(key) + len(value) > self.max_item_size:
+            return False
+
+        keyHash = _hashKey(key)
+
+        with self._write_lock:
+            offset = None
+            for probe in xrange(MAX_PROBES):
+                probeOffset = self._getSlotOffset(keyHash, probe)
+                sequence, slotKeyHash, keyLength, valueLength = SLOT_HEADER.unpack_from(self._map, probeOffset)
+                if slotKeyHash == 0 or (slotKeyHash == keyHash and self._map[probeOffset + SLOT_HEADER.size:probeOffset + SLOT_HEADER.size + keyLength] == key):
+                    offset = probeOffset
+                    break
+
+            if offset is None:
+                # Take turns at which key of the probe sequence is replaced.
+                offset = self._getSlotOffset(keyHash, self._num_replacements % MAX_PROBES)
+                self._num_replacements += 1
+
+            sequence = SLOT_SEQUENCE.unpack_from(self._map, offset)[0]
+            SLOT_SEQUENCE.pack_into(self._map, offset, (sequence + 1) & 0xFFFFFFFF)
+
+            body = SLOT_HEADER.pack(0, keyHash, len(key), len(value))[SLOT_SEQUENCE.size:] + key + value
+            self._map[offset + SLOT_SEQUENCE.size:offset + SLOT_SEQUENCE.size + len(body)] = body
+
+            SLOT_SEQUENCE.pack_into(self._map, offset, (sequence + 2) & 0xFFFFFFFF)
+
+        return True
+
+    def __str__(self):
+        return 'hits %d, misses %d, read retries %d, replacements %d' % (self.num_hits, self.num_misses, self.num_read_retries, self._num_replacements)
+
+
+def _readInOtherProcess(fileName, connection):
+    """ Opens the table then reads each list of keys it is sent, until sent None. """
+    reader = SharedHashTable(fileName)
+    while True:
+        keys = connection.recv()
+        if keys is None:
+            break
+
+        connection.send([reader.get(key) for key in keys])
+
+    reader.close()
+
+
+class testSharedHashTable(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        fileHandle, self.file_name = tempfile.mkstemp()
+        os.close(fileHandle)
+
+    def tearDown(self):
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+    def testOwnerAndReader(self):
+        owner = SharedHashTable(self.file_name, 4, 64, True)
+        reader = SharedHashTable(self.file_name)
+        assert reader.num_slots == 4 and reader.slot_size == 64
+
+        assert owner.put('london', 'uk')
+        assert reader.get('london') == 'uk'
+        assert reader.get('paris') is None
+
+        owner.put('london', 'england')
+        assert reader.get('london') == 'england'
+
+        assert not owner.put('big', 'x' * 64)
+
+        # More keys than slots, older keys are replaced.
+        for n in range(10):
+            owner.put('key%d' % n, str(n))
+        assert reader.get('key9') == '9'
+
+        self.assertRaises(AssertionError, SharedHashTable, self.file_name + '_big', 4, SLOT_HEADER.size + MAX_ITEM_SIZE + 1, True)
+
+        reader.close()
+        owner.close(True)
+        assert not os.path.exists(self.file_name)
+
+    def testReplacement(self):
+        # Every probe sequence covers the whole table.
+        owner = SharedHashTable(self.file_name, MAX_PROBES, 64, True)
+
+        keys = ['key%d' % n for n in range(MAX_PROBES)]
+        for key in keys:
+            owner.put(key, key)
+        assert [owner.get(key) for key in keys] == keys
+
+        owner.put('extra', 'extra')
+        assert owner.get('extra') == 'extra'
+        assert len([key for key in keys if owner.get(key) == key]) == MAX_PROBES - 1
+
+        owner.close()
+
+    def testReadDuringWrite(self):
+        owner = SharedHashTable(self.file_name, 16, 64, True)
+        reader = SharedHashTable(self.file_name)
+        owner.put('london', 'uk')
+
+        # Make the slot look as if the owner is part way through writing it.
+        keyHash = _hashKey('london')
+        for probe in xrange(MAX_PROBES):
+            offset = owner._getSlotOffset(keyHash, probe)
+            if SLOT_HEADER.unpack_from(owner._map, offset)[1] == keyHash:
+                break
+        sequence = SLOT_SEQUENCE.unpack_from(owner._map, offset)[0]
+        SLOT_SEQUENCE.pack_into(owner._map, offset, sequence + 1)
+
+        assert reader.get('london') is None
+        assert reader.num_read_retries == MAX_READ_ATTEMPTS
+
+        SLOT_SEQUENCE.pack_into(owner._map, offset, sequence + 2)
+        assert reader.get('london') == 'uk'
+
+        reader.close()
+        owner.close()
+
+    def testOtherProcess(self):
+        from multiprocessing import Process
+
+        owner = SharedHashTable(self.file_name, 64, 64, True)
+        owner.put('london', 'uk')
+
+        parentConnection, childConnection = createBlockingPipe()
+        process = Process(target=_readInOtherProcess, args=(self.file_name, childConnection))
+        process.start()
+
+        parentConnection.send(['london', 'paris'])
+        assert parentConnection.recv() == ['uk', None]
+
+        # Written after the reader opened the table.
+        owner.put('paris', 'france')
+        parentConnection.send(['london', 'paris'])
+        assert parentConnection.recv() == ['uk', 'france']
+
+        parentConnection.send(None)
+        process.join()
+
+        owner.close()
@@ -6,12 +6,14 @@ import threading
 import time
 import thread
 
-from api.caching.temporal_analytics import getTimeIdFromTimestamp, getTemporalInfluenceCollection
+from api.caching.caching_shared import WORKLOAD_INGEST
+from api.caching.instance_lifetime import temporalSourceLastTimeCheckpoints
+from api.caching.temporal_analytics import getTimeIdFromTimestamp, getTemporalInfluenceCollection, temporalInfluenceAggregator
 from api.config import Configuration
-from api.core.data_structures.queues import QueueEx, QueueNotify
-from api.core.threads_core import BaseThread
-from api.core.utility import DummyIterable, getUniqueId, criticalSection, getEpochMs, Timer
-from api.geocode.geocode_cached import getGeocodeDataInMemoryCacheSize, getGeocodeQueryInMemoryCacheSize
+from api.core.data_structures.queues import QueueEx, QueueNotify, CoalescingQueue
+from api.core.threads_core import BaseThread, PeriodicThread, StageStatistics
+from api.core.utility import DummyIterable, getUniqueId, criticalSection, getEpochMs, Timer, AdaptiveRateLimiter
+from api.geocode.geocode_cached import getGeocodeDataInMemoryCacheSize, getGeocodeQueryInMemoryCacheSize, getGeocodeQueryNegativeCacheSize, getGeocodeQueryNegativeCacheHits, flushGeocodeQueryHits, saveGeocodeCacheSnapshot
 from api.geocode.geocode_shared import GeocodeResultAbstract
 from api.twitter.flow.data_core import DataCollection
 from api.twitter.feed import Tweet, User, TwitterSession, TwitterFeed, UserAnalysis, Place, UserGeocodeConfig
@@ -60,15 +62,27 @@ class TwitterThread(BaseThread):
 
                 self.output_queue.put(item)
 
-        self.num_dropped = 0
-        self.num_processed = 0
         self.num_twitter_geocoded_place = 0
         self.num_twitter_geocoded_coordinate = 0
         self.num_twitter_geocoded_both = 0
         self.num_not_twitter_geocoded = 0
         self.num_no_location = 0
         self.num_geocodeable = 0
-        self.log_num_dropped_timer = Timer(Configuration.LOG_DROP_AMOUNT_FREQ_MS,False)
+
+        # Output is GCQ = geocode cache queue.
+        self.stats = StageStatistics(self.getName(), None, self._describeInitialTweetState)
+
+    def _describeInitialTweetState(self):
+        result = 'initial tweet state: no twitter geocode %d, twitter place %d, twitter coord %d, twitter place and coord %d, num geocodeable %d, num not geocodeable %d' % (self.num_not_twitter_geocoded, self.num_twitter_geocoded_place, self.num_twitter_geocoded_coordinate, self.num_twitter_geocoded_both, self.num_geocodeable, self.num_no_location)
+
+        self.num_no_location = 0
+        self.num_twitter_geocoded_place = 0
+        self.num_twitter_geocoded_coordinate = 0
+        self.num_twitter_geocoded_both = 0
+        self.num_not_twitter_geocoded = 0
+        self.num_geocodeable = 0
+
+        return result
 
     def _onFailure(self, e):
         if not self.twitter_session.parent_instance.enable_shutdown_after_no_usage:
@@ -84,45 +98,13 @@ class TwitterThread(BaseThread):
         self.twitter_feed.restartConnection()
 
     def _run(self):
-        for tweet in self.input_queue:
+        for tweet in self.stats.iterate(self.input_queue):
             if self.stopped:
                 return 0
 
             if tweet is None:
                 continue
 
-            if self.log_num_dropped_timer.ticked():
-                numProcessed = self.num_processed
-                numDropped = self.num_dropped
-                total = numProcessed + numDropped
-                if total == 0:
-                    percentageDropped = 0
-                else:
-                    percentageDropped = float(numDropped) / float(total) * 100.0
-                outputQueueSize = self.output_queue.qsize()
-
-                numNoLocation = self.num_no_location
-                numTwitterGeocodedPlace = self.num_twitter_geocoded_place
-                numTwitterGeocodedCoordinate = self.num_twitter_geocoded_coordinate
-                numTwitterGeocodedBoth = self.num_twitter_geocoded_both
-                numNotTwitterGeocoded = self.num_not_twitter_geocoded
-                numGeocodeable = self.num_geocodeable
-
-                self.num_no_location = 0
-                self.num_twitter_geocoded_place = 0
-                self.num_twitter_geocoded_coordinate = 0
-                self.num_twitter_geocoded_both = 0
-                self.num_not_twitter_geocoded = 0
-                self.num_geocodeable = 0
-
-                self.num_dropped = 0
-                self.num_processed = 0
-
-                # GCQ = geocode cache queue.
-                logger.info('Processed %d items, dropped %d items (%.2f%%) from GCQ (queue size: %d)' % (numProcessed, numDropped, percentageDropped, outputQueueSize))
-
-                logger.info('Initial tweet state: no twitter geocode %d, twitter place %d, twitter coord %d, twitter place and coord %d, num geocodeable %d, num not geocodeable %d' % (numNotTwitterGeocoded, numTwitterGeocodedPlace, numTwitterGeocodedCoordinate, numTwitterGeocodedBoth, numGeocodeable, numNoLocation))
-
             assert isinstance(tweet, Tweet)
 
             if tweet.has_twitter_place and tweet.coordinate is None:
@@ -140,11 +122,7 @@ class TwitterThread(BaseThread):
                 else:
                     self.num_geocodeable += 1
 
-                if self.output_queue.qsize() < Configuration.GEOCODE_FROM_CACHE_INPUT_THREAD_SIZE_CAP:
-                    self.num_processed += 1
-                    self.output_queue.put(tweet)
-                else:
-                    self.num_dropped += 1
+                self.stats.offer(self.output_queue, tweet)
 
     def stop(self):
         super(TwitterThread,self).stop()
@@ -169,7 +147,9 @@ class GeocodeFromCacheThread(BaseThread):
                  successOutputQueue=None,
                  primaryFailureOutputQueue=None,
                  highLoadFailureOutputQueue=None,
-                 inMemoryOnly=None):
+                 inMemoryOnly=None,
+                 geocodeProcessPool=None,
+                 rateLimiter=None):
         if inMemoryOnly:
             inMemoryOnlyStr = '_MEMORY_ONLY'
         else:
@@ -193,20 +173,34 @@ class GeocodeFromCacheThread(BaseThread):
         self.high_load_failure_output_queue = highLoadFailureOutputQueue
         self.geocode_config = geocodeConfig
 
-        self.num_dropped_from_success = 0
-        self.num_dropped_from_primary_failure = 0
-        self.num_failed_over = 0
-        self.log_timer = Timer(Configuration.LOG_DROP_AMOUNT_FREQ_MS,False)
-
-        self.num_processed = 0
         self.in_memory_only = inMemoryOnly
 
-        self.sleep_time = float(Configuration.GEOCODE_FROM_CACHE_THREAD_WAIT_TIME_MS) / 1000.0
+        # If not None geocoding is done by child processes, see GeocodeProcessPool.
+        self.geocode_process_pool = geocodeProcessPool
+
+        # Database workers share one limiter so that together they back off
+        # when MongoDB slows down.
+        if rateLimiter is None and not inMemoryOnly:
+            rateLimiter = AdaptiveRateLimiter(Configuration.GEOCODE_FROM_CACHE_TARGET_LATENCY_MS,
+                                              Configuration.GEOCODE_FROM_CACHE_MINIMUM_RATE,
+                                              Configuration.GEOCODE_FROM_CACHE_MAXIMUM_RATE,
+                                              Configuration.GEOCODE_FROM_CACHE_RATE_INCREASE)
+        self.rate_limiter = rateLimiter
+
+        self.stats = StageStatistics(self.getName(), self.input_queue, self._describeCacheSizes)
+
+    def _describeCacheSizes(self):
+        result = 'success output queue size: %d, fail over output queue size: %d - geocode cache size: %d, place cache size %d' % (self.success_output_queue.qsize(), self.primary_failure_output_queue.qsize(), getGeocodeDataInMemoryCacheSize(), getGeocodeQueryInMemoryCacheSize())
+        if not self.in_memory_only:
+            result = '%s - negative cache size %d, negative cache hits %d' % (result, getGeocodeQueryNegativeCacheSize(), getGeocodeQueryNegativeCacheHits())
+        if self.rate_limiter is not None:
+            result = '%s - %s' % (result, self.rate_limiter)
+        return result
 
     def _run(self):
-        for item in self.input_queue:
-            if not self.in_memory_only:
-                time.sleep(self.sleep_time)
+        for item in self.stats.iterate(self.input_queue):
+            if self.rate_limiter is not None:
+                self.rate_limiter.waitForTurn()
 
             user = getUser(item)
             assert user is not None
@@ -215,56 +209,29 @@ class GeocodeFromCacheThread(BaseThread):
 
             if user.is_geocoded:
                 success = True
+            # In process mode the child process geocodes from the coordinate too.
+            elif Configuration.REVERSE_GEOCODE_ENABLED and self.geocode_process_pool is None and user.geocodeLocationFromCoordinate(self.geocode_config, self.in_memory_only):
+                success = True
             else:
-                success = user.geocodeLocationFromCache(self.geocode_config, self.in_memory_only)
-
-            if self.log_timer.ticked():
-                numProcessed = self.num_processed
-                numDroppedFromSuccess = self.num_dropped_from_success
-                numDroppedFromPrimaryFailure = self.num_dropped_from_primary_failure
-                numFailedOver = self.num_failed_over
-                total = numProcessed + numDroppedFromSuccess + numDroppedFromPrimaryFailure + numFailedOver
-
-                if total == 0:
-                    percentageDroppedFromSuccess = 0
-                    percentageDroppedFromPrimaryFailure = 0
-                    percentageFailedOver = 0
-                    percentageSuccess = 0
-                else:
-                    percentageDroppedFromSuccess = float(numDroppedFromSuccess) / float(total) * 100.0
-                    percentageDroppedFromPrimaryFailure = float(numDroppedFromPrimaryFailure) / float(total) * 100.0
-                    percentageFailedOver = float(numFailedOver) / float(total) * 100.0
-                    percentageSuccess = float(numProcessed) / float(total) * 100.0
-
-                outputQueueSize = self.success_output_queue.qsize()
-                failOverOutputQueueSize = self.primary_failure_output_queue.qsize()
-
-                geocodeDataInMemoryCacheSize = getGeocodeDataInMemoryCacheSize()
-                geocodeQueryInMemoryCacheSize = getGeocodeQueryInMemoryCacheSize()
+                timer = getEpochMs()
 
-                self.num_dropped_from_success = 0
-                self.num_dropped_from_primary_failure = 0
-                self.num_processed = 0
-                self.num_failed_over = 0
+                if self.geocode_process_pool is not None:
+                    success = self.geocode_process_pool.geocodeUser(user, self.in_memory_only)
+                else:
+                    success = user.geocodeLocationFromCache(self.geocode_config, self.in_memory_only)
 
-                # FEGQ = follower extractor gate queue
-                logger.info('Geocoded %d items (%.2f%%), failed over %d items (%.2f%%), dropped successful geocode items %d items (%.2f%%), dropped failed geocode items %d items (%.2f%%) - success output queue size: %d, fail over output queue size: %d - geocode cache size: %d, place cache size %d' % (numProcessed, percentageSuccess, numFailedOver, percentageFailedOver, numDroppedFromSuccess, percentageDroppedFromSuccess, numDroppedFromPrimaryFailure, percentageDroppedFromPrimaryFailure, outputQueueSize, failOverOutputQueueSize, geocodeDataInMemoryCacheSize, geocodeQueryInMemoryCacheSize))
+                if self.rate_limiter is not None:
+                    self.rate_limiter.onComplete(getEpochMs() - timer)
 
             if success:
-                if self.success_output_queue.qsize() < Configuration.ANALYSIS_INPUT_THREAD_SIZE_CAP:
-                    self.num_processed += 1
-                    self.success_output_queue.put(item)
-                else:
-                    self.num_dropped_from_success += 1
+                self.stats.offer(self.success_output_queue, item)
             else:
-                # Make sure the queue doesn't get too full, we only geocode once a second.
-                # We don't deal with those that followers because that would take too long.
-                if self.primary_failure_output_queue.qsize() <= Configuration.GEOCODE_FROM_CACHE_PRIMARY_FAILURE_OUTPUT_QUEUE_SIZE and (user.has_location or user.has_twitter_place):
-                    self.num_failed_over += 1
-                    self.primary_failure_output_queue.put(item)
+                # The primary failure queue is bounded and spills over to the
+                # high load queue when full, see startThreads.
+                if user.has_location or user.has_twitter_place:
+                    self.stats.offer(self.primary_failure_output_queue, item)
                 elif self.high_load_failure_output_queue is not None:
-                    self.num_dropped_from_primary_failure += 1
-                    self.high_load_failure_output_queue.put(item)
+                    self.stats.put(self.high_load_failure_output_queue, item)
 
 
 class GeocodeFromExternalThread(BaseThread):
@@ -288,29 +255,83 @@ class GeocodeFromExternalThread(BaseThread):
         self.geocode_config = geocodeConfig
         self.failure_output_queue = failureOutputQueue
 
-    def _run(self):
-        for item in self.input_queue:
-            user = getUser(item)
-            assert user is not None
+        # Items are groups of users with the same geocode query, see CoalescingQueue.
+        self.is_coalescing = isinstance(self.input_queue, CoalescingQueue)
+        self.num_lookups = 0
 
-            if user.is_geocoded or not user.has_location:
-                continue
+        self.stats = StageStatistics(self.getName(), self.input_queue, self._describeCoalescing)
 
-            user.clearGeocode(True)
+    def _describeCoalescing(self):
+        if not self.is_coalescing:
+            return 'external lookups: %d' % self.num_lookups
 
-            if user.is_geocoded:
-                success = True
+        return 'external lookups: %d, users joining queued lookups: %d, groups waiting: %d' % (self.num_lookups, self.input_queue.num_joined, self.input_queue.qsize())
+
+    def _geocodeFromExternal(self, user):
+        self.num_lookups += 1
+        return user.geocodeLocationFromExternal(self.geocode_config)
+
+    def _geocodeFromCacheOrExternal(self, user):
+        # Users with this query may have been geocoded from external since user was queued.
+        if user.geocodeLocationFromCache(self.geocode_config):
+            return True
+
+        user.clearGeocode(True)
+        return self._geocodeFromExternal(user)
+
+    def _geocodeFromCache(self, user):
+        return user.geocodeLocationFromCache(self.geocode_config)
+
+    def _geocodeItem(self, item, geocodeFunc):
+        """ @return None if item was skipped, otherwise true if geocoded. """
+        user = getUser(item)
+        assert user is not None
+
+        if user.is_geocoded or not user.has_location:
+            return None
+
+        user.clearGeocode(True)
+
+        if user.is_geocoded:
+            success = True
+        else:
+            success = geocodeFunc(user)
+
+        if success:
+            logger.info('Succeeded in geocoding user with location %s from external' % user.location_text)
+            self.stats.put(self.success_output_queue, item)
+        elif self.failure_output_queue is not None:
+            self.stats.put(self.failure_output_queue, item)
+
+        if not success:
+            logger.info('Failed in geocoding user with location %s from external' % user.location_text)
+
+        return success
+
+    def _geocodeGroup(self, items, success):
+        """ The first user is looked up and the rest use the result from the cache,
+            or fail without a lookup if it failed.
+            @param success result of looking up the group's query, None if not looked up yet.
+            @return success. """
+        for item in items:
+            if success is None:
+                success = self._geocodeItem(item, self._geocodeFromCacheOrExternal)
+            elif success:
+                self._geocodeItem(item, self._geocodeFromCache)
             else:
-                success = user.geocodeLocationFromExternal(self.geocode_config)
+                self._geocodeItem(item, lambda user: False)
 
-            if success:
-                logger.info('Succeeded in geocoding user with location %s from external' % user.location_text)
-                self.success_output_queue.put(item)
-            elif self.failure_output_queue is not None:
-                self.failure_output_queue.put(item)
+        return success
+
+    def _run(self):
+        for item in self.stats.iterate(self.input_queue):
+            if not self.is_coalescing:
+                self._geocodeItem(item, self._geocodeFromExternal)
+                continue
 
-            if not success:
-                logger.info('Failed in geocoding user with location %s from external' % user.location_text)
+            key = self.input_queue.key_func(item[0])
+            success = self._geocodeGroup(item, None)
+            self._geocodeGroup(self.input_queue.completeGroup(key), success)
 
 class FollowerExtractorGateThread(BaseThread):
     # We have a follower extractor per twitter thread so that we can do more
@@ -340,9 +361,8 @@ class FollowerExtractorGateThread(BaseThread):
 
         self.user_analysis_list = userAnalysisList
 
-        self.num_dropped = 0
-        self.num_processed = 0
-        self.log_num_dropped_timer = Timer(Configuration.LOG_DROP_AMOUNT_FREQ_MS,False)
+        # Output is AQ = analysis queue.
+        self.stats = StageStatistics(self.getName(), self.input_queue)
 
     def getExtractorThreadByTwitterSession(self, twitterSession):
         if not twitterSession.is_session_active:
@@ -440,41 +460,20 @@ class FollowerExtractorGateThread(BaseThread):
         return True
 
     def _run(self):
-        for item in self.input_queue:
+        for item in self.stats.iterate(self.input_queue):
             user = getUser(item)
             assert user is not None
             assert isinstance(user, User)
 
-            if self.log_num_dropped_timer.ticked():
-                numDropped = self.num_dropped
-                numProcessed = self.num_processed
-                total = numDropped + numProcessed
-                if total == 0:
-                    percentageDropped = 0
-                else:
-                    percentageDropped = float(numDropped) / float(total) * 100.0
-                outputQueueSize = self.output_queue.qsize()
-
-                self.num_dropped = 0
-                self.num_processed = 0
-
-
-                # AQ = analysis queue
-                logger.info('Processed %d items, dropped %d items (%.2f%%) from AQ (queue size %d)' % (numProcessed, numDropped, percentageDropped, outputQueueSize))
-
             # Always add tweets, even if we don't extract the followers of the user.
             if isinstance(item, Tweet):
-                if self.output_queue.qsize() < Configuration.ANALYSIS_INPUT_THREAD_SIZE_CAP:
-                    self.num_processed += 1
-                    self.output_queue.put(item)
-                else:
-                    self.num_dropped += 1
+                self.stats.offer(self.output_queue, item)
 
             # Already has followers loaded, maybe this came back from
             # geocoder, so we can put it in our output queue safely.
             if user.is_followers_loaded or user.is_followee:
                 # Don't drop follower information, since that is so valuable.
-                self.output_queue.put(item)
+                self.stats.put(self.output_queue, item)
                 continue
 
             # Make sure the queue doesn't get too full.
@@ -543,7 +542,7 @@ class FollowerExtractorThread(BaseThread):
             instance = user.twitter_session.parent_instance
             instance_key = user.instance_key
             startTime = instance.constructed_at
-            temporalCollection = getTemporalInfluenceCollection(instance_key)
+            temporalCollection = getTemporalInfluenceCollection(instance_key, WORKLOAD_INGEST)
 
             analysis_list = list()
             for item in self.user_analysis_list:
@@ -650,8 +649,10 @@ class AnalysisThread(BaseThread):
         self.input_queue = inputQueue
         self.data = data
 
+        self.stats = StageStatistics(self.getName(), self.input_queue)
+
     def _run(self):
-        for item in self.input_queue:
+        for item in self.stats.iterate(self.input_queue):
             if isinstance(item, Tweet):
                 if item.has_user and item.user.is_geocoded:
                     self.data.addTweet(item)
@@ -679,28 +680,56 @@ class DisplayThread(BaseThread):
 
 
 
-def startThreads(data, display, userAnalysers):
-    tweetQueue = QueueEx()
+def buildPipelineQueue(name, maxSize, spillQueue=None, keyFunc=None):
+    """ Bounded queue between pipeline threads using the overflow policy configured for it.
+        @param keyFunc if not None items with the same key are grouped, see CoalescingQueue. """
+    policy = Configuration.PIPELINE_QUEUE_POLICIES.get(name, QueueEx.POLICY_DROP)
+    logger.info('Pipeline queue %s: maximum size %d, overflow policy %s, coalescing %s' % (name, maxSize, policy, keyFunc is not None))
+
+    if keyFunc is not None:
+        return CoalescingQueue(keyFunc,
+                               maxSize=maxSize,
+                               overflowPolicy=policy,
+                               spillQueue=spillQueue,
+                               maxGroupSize=Configuration.GEOCODE_FROM_EXTERNAL_MAX_GROUP_SIZE,
+                               maxGroupWaitMs=Configuration.GEOCODE_FROM_EXTERNAL_MAX_GROUP_WAIT_MS)
+
+    return QueueEx(maxSize=maxSize, overflowPolicy=policy, spillQueue=spillQueue)
+
+def startThreads(data, display, userAnalysers, geocodeProcessPool=None):
+    analysisQueue = buildPipelineQueue('analysis_input', Configuration.ANALYSIS_INPUT_THREAD_SIZE_CAP)
+
+    # Geocode failures from cache go to external geocoder or straight to analysis if there are too many.
+    if Configuration.GEOCODE_FROM_EXTERNAL_COALESCING_ENABLED:
+        geocodeExternalKeyFunc = lambda item: getUser(item).geocode_query_key
+    else:
+        geocodeExternalKeyFunc = None
+
+    geocodeExternalQueue = buildPipelineQueue('geocode_external_input', Configuration.GEOCODE_FROM_CACHE_PRIMARY_FAILURE_OUTPUT_QUEUE_SIZE, analysisQueue, geocodeExternalKeyFunc)
+    geocodeCacheQueue = buildPipelineQueue('geocode_cache_input', Configuration.GEOCODE_FROM_CACHE_PRIMARY_FAILURE_OUTPUT_QUEUE_SIZE, analysisQueue)
+
+    followerExtractorGateQueue = buildPipelineQueue('follower_extractor_gate_input', Configuration.ANALYSIS_INPUT_THREAD_SIZE_CAP)
+    tweetQueue = buildPipelineQueue('geocode_cache_memory_input', Configuration.GEOCODE_FROM_CACHE_INPUT_THREAD_SIZE_CAP)
 
     userGeocodeConfig = UserGeocodeConfig(Configuration.GEOCODE_EXTERNAL_PROVIDER)
 
-    feb = FollowerExtractorGateThread(userGeocodeConfig, dataCollection=data, userAnalysisList=userAnalysers)
+    feb = FollowerExtractorGateThread(userGeocodeConfig, inputQueue=followerExtractorGateQueue, outputQueue=analysisQueue, dataCollection=data, userAnalysisList=userAnalysers)
 
     an = AnalysisThread(inputQueue=feb.output_queue, data=data)
 
-    ge = GeocodeFromExternalThread(geocodeConfig=userGeocodeConfig, failureOutputQueue=an.input_queue, successOutputQueue=feb.input_queue)
+    ge = GeocodeFromExternalThread(geocodeConfig=userGeocodeConfig, inputQueue=geocodeExternalQueue, failureOutputQueue=an.input_queue, successOutputQueue=feb.input_queue)
     di = DisplayThread(display=display)
 
-    gc = GeocodeFromCacheThread(geocodeConfig=userGeocodeConfig, primaryFailureOutputQueue=ge.input_queue, highLoadFailureOutputQueue=an.input_queue, successOutputQueue=feb.input_queue, inMemoryOnly=False)
+    gc = GeocodeFromCacheThread(geocodeConfig=userGeocodeConfig, inputQueue=geocodeCacheQueue, primaryFailureOutputQueue=ge.input_queue, highLoadFailureOutputQueue=an.input_queue, successOutputQueue=feb.input_queue, inMemoryOnly=False, geocodeProcessPool=geocodeProcessPool)
 
-    gcm = GeocodeFromCacheThread(geocodeConfig=userGeocodeConfig, inputQueue=tweetQueue, primaryFailureOutputQueue=gc.input_queue, highLoadFailureOutputQueue=an.input_queue, successOutputQueue=feb.input_queue, inMemoryOnly=True)
+    gcm = GeocodeFromCacheThread(geocodeConfig=userGeocodeConfig, inputQueue=tweetQueue, primaryFailureOutputQueue=gc.input_queue, highLoadFailureOutputQueue=an.input_queue, successOutputQueue=feb.input_queue, inMemoryOnly=True, geocodeProcessPool=geocodeProcessPool)
 
     for n in range(1, Configuration.NUM_GEOCODE_FROM_CACHE_WORKERS_MEMORY_ONLY):
-        aux = GeocodeFromCacheThread(geocodeConfig=gcm.geocode_config, inputQueue=gcm.input_queue, primaryFailureOutputQueue=gcm.primary_failure_output_queue, highLoadFailureOutputQueue=gcm.high_load_failure_output_queue, successOutputQueue=gcm.success_output_queue, inMemoryOnly=gcm.in_memory_only)
+        aux = GeocodeFromCacheThread(geocodeConfig=gcm.geocode_config, inputQueue=gcm.input_queue, primaryFailureOutputQueue=gcm.primary_failure_output_queue, highLoadFailureOutputQueue=gcm.high_load_failure_output_queue, successOutputQueue=gcm.success_output_queue, inMemoryOnly=gcm.in_memory_only, geocodeProcessPool=gcm.geocode_process_pool, rateLimiter=gcm.rate_limiter)
         aux.start()
 
     for n in range(1,Configuration.NUM_GEOCODE_FROM_CACHE_WORKERS):
-        aux = GeocodeFromCacheThread(geocodeConfig=gc.geocode_config, inputQueue=gc.input_queue, primaryFailureOutputQueue=gc.primary_failure_output_queue, highLoadFailureOutputQueue=gc.high_load_failure_output_queue, successOutputQueue=gc.success_output_queue, inMemoryOnly=gc.in_memory_only)
+        aux = GeocodeFromCacheThread(geocodeConfig=gc.geocode_config, inputQueue=gc.input_queue, primaryFailureOutputQueue=gc.primary_failure_output_queue, highLoadFailureOutputQueue=gc.high_load_failure_output_queue, successOutputQueue=gc.success_output_queue, inMemoryOnly=gc.in_memory_only, geocodeProcessPool=gc.geocode_process_pool, rateLimiter=gc.rate_limiter)
         aux.start()
 
     for n in range(1,Configuration.NUM_ANALYSIS_WORKERS):
@@ -710,6 +739,20 @@ def startThreads(data, display, userAnalysers):
         aux = FollowerExtractorGateThread(inputQueue = feb.input_queue, outputQueue = feb.output_queue, geocodeUserConfig=feb.geocode_user_config, dataCollection=feb.data_collection, userAnalysisList=feb.user_analysis_list)
         aux.start()
 
+    if Configuration.TEMPORAL_AGGREGATOR_ENABLED:
+        ta = PeriodicThread('TemporalInfluenceFlushThread', Configuration.TEMPORAL_AGGREGATOR_FLUSH_MS, temporalInfluenceAggregator.flush)
+        ta.start()
+
+    tc = PeriodicThread('TemporalCheckpointFlushThread', Configuration.TEMPORAL_CHECKPOINT_FLUSH_MS, temporalSourceLastTimeCheckpoints.flush)
+    tc.start()
+
+    gh = PeriodicThread('GeocodeQueryHitsFlushThread', Configuration.GEOCODE_QUERY_HITS_FLUSH_MS, flushGeocodeQueryHits)
+    gh.start()
+
+    if Configuration.GEOCODE_CACHE_SNAPSHOT_FILE and Configuration.GEOCODE_CACHE_SNAPSHOT_MS > 0:
+        gs = PeriodicThread('GeocodeCacheSnapshotThread', Configuration.GEOCODE_CACHE_SNAPSHOT_MS, saveGeocodeCacheSnapshot)
+        gs.start()
+
     gc.start()
     gcm.start()
     ge.start()
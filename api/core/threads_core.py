@@ -1,13 +1,42 @@
 import logging
 import os
-from threading import Thread
+from threading import Thread, Lock
 import traceback
 import time
+import unittest
 from api.config import Configuration
-from api.core.utility import EventTimer
+from api.core.data_structures.queues import QueueEx
+from api.core.utility import EventTimer, Timer, getEpochMs
 
 logger = logging.getLogger(__name__)
 
+# Functions which write what is held in memory to the database, called once when the
+# application terminates, whether the web server stopped, the process was interrupted
+# or a critical thread failed.
+shutdownFuncs = []
+shutdownLock = Lock()
+isShutdown = False
+
+def registerShutdownFunc(func, description):
+    shutdownFuncs.append((func, description))
+
+def runShutdownFuncs():
+    """ Calls shutdown functions in the order they were registered, only the first call does anything.
+        A function which fails does not stop the rest from being called. """
+    global isShutdown
+
+    with shutdownLock:
+        if isShutdown:
+            return
+        isShutdown = True
+
+    for func, description in shutdownFuncs:
+        logger.info('Before exiting: %s' % description)
+        try:
+            func()
+        except Exception as e:
+            logger.error('Exception before exiting while: %s - %s' % (description, e))
+
 class BaseThread(Thread):
     def __init__(self, threadName, onTerminateFunc=None, criticalThread=None, maxFailures=None, failureBackoffMaximumMs=None):
         if criticalThread is None:
@@ -97,6 +126,7 @@ class BaseThread(Thread):
 
                     if self.is_critical_thread:
                         logger.error('Critical thread failed, terminating application - thread responsible: %s' % self.getName())
+                        runShutdownFuncs()
                         os._exit(0)
                     else:
                         logger.error('Thread failed without terminating application: %s' % self.getName())
@@ -108,4 +138,128 @@ class BaseThread(Thread):
             self.on_terminate_func()
 
     def stop(self):
-        self.stopped = True
\ No newline at end of file
+        self.stopped = True
+
+
+class PeriodicThread(BaseThread):
+    """ Calls a function every periodMs milliseconds until stopped. """
+    def __init__(self, threadName, periodMs, func, onTerminateFunc=None, criticalThread=None):
+        super(PeriodicThread,self).__init__(threadName, onTerminateFunc, criticalThread)
+
+        assert func is not None
+        self.period = periodMs
+        self.func = func
+
+    def _run(self):
+        timer = Timer(self.period, False)
+        while not self.stopped:
+            timer.waitForTick()
+            self.func()
+
+class StageStatistics(object):
+    """ Uniform counters for a thread which takes items from an input queue
+        and passes them on to output queues.
+
+        Use iterate to take items from the input queue, it measures how long
+        each item takes to process and logs periodically. """
+
+    def __init__(self, stageName, inputQueue=None, describeFunc=None):
+        super(StageStatistics,self).__init__()
+
+        self.stage_name = stageName
+        self.input_queue = inputQueue
+
+        # Returns additional stage specific text to add to log line.
+        self.describe_func = describeFunc
+
+        self.log_timer = Timer(Configuration.LOG_DROP_AMOUNT_FREQ_MS,False)
+        self._reset()
+
+    def _reset(self):
+        self.num_in = 0
+        self.num_out = 0
+        self.num_dropped = 0
+        self.num_spilled = 0
+        self.total_service_time = 0
+
+    def iterate(self, iterable):
+        for item in iterable:
+            self.num_in += 1
+            timer = getEpochMs()
+
+            yield item
+
+            self.total_service_time += getEpochMs() - timer
+            self.logIfDue()
+
+    def offer(self, queue, item):
+        """ Offers item to queue which may drop or spill it if full.
+            @return true if the item was added to queue. """
+        result = queue.offer(item)
+        if result == QueueEx.QUEUED:
+            self.num_out += 1
+            return True
+        elif result == QueueEx.SPILLED:
+            self.num_spilled += 1
+        else:
+            self.num_dropped += 1
+
+        return False
+
+    def put(self, queue, item):
+        """ Adds item to queue, it will not be dropped. """
+        queue.put(item)
+        self.num_out += 1
+
+    def logIfDue(self):
+        if not self.log_timer.ticked():
+            return
+
+        total = self.num_out + self.num_dropped + self.num_spilled
+        if total == 0:
+            percentageDropped = 0
+            percentageSpilled = 0
+        else:
+            percentageDropped = float(self.num_dropped) / float(total) * 100.0
+            percentageSpilled = float(self.num_spilled) / float(total) * 100.0
+
+        if self.num_in == 0:
+            averageServiceTime = 0
+        else:
+            averageServiceTime = float(self.total_service_time) / float(self.num_in)
+
+        if self.input_queue is not None:
+            inputQueueSize = self.input_queue.qsize()
+        else:
+            inputQueueSize = 0
+
+        if self.describe_func is not None:
+            description = ' - %s' % self.describe_func()
+        else:
+            description = ''
+
+        logger.info('%s: in %d, out %d, dropped %d (%.2f%%), spilled %d (%.2f%%), input queue size %d, average service time %.2fms%s' % (self.stage_name, self.num_in, self.num_out, self.num_dropped, percentageDropped, self.num_spilled, percentageSpilled, inputQueueSize, averageServiceTime, description))
+        self._reset()
+
+
+class testShutdownFuncs(unittest.TestCase):
+    def testRunOnce(self):
+        global isShutdown
+        del shutdownFuncs[:]
+        isShutdown = False
+
+        calls = []
+        def fail():
+            calls.append('fail')
+            raise Exception('failed')
+
+        registerShutdownFunc(lambda: calls.append('first'), 'first')
+        registerShutdownFunc(fail, 'fail')
+        registerShutdownFunc(lambda: calls.append('last'), 'last')
+
+        runShutdownFuncs()
+        runShutdownFuncs()
+        assert calls == ['first', 'fail', 'last']
+
+        del shutdownFuncs[:]
+        isShutdown = False
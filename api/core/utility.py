@@ -2,7 +2,9 @@ import hashlib
 from math import sqrt, ceil, log
 from collections import Hashable, OrderedDict, namedtuple, MutableMapping
 import copy
+import fcntl
 import logging
+from multiprocessing import Pipe
 import os
 import string
 import struct
@@ -595,6 +597,74 @@ class EventFrequencyCounter(object):
             else:
                 return result
 
+class AdaptiveRateLimiter(object):
+    """ Limits how often an operation is performed, adjusting the rate based on how long
+        the operation takes (additive increase, multiplicative decrease).
+
+        Starts at maximumRate unless told otherwise, so that nothing is held back until
+        operations are seen to be slow. While the average latency is within targetLatencyMs
+        the rate increases by roughly increasePerSecond every second. When it is slower the
+        rate is halved, at most once per second so that a single slow period does not collapse it. """
+
+    DECREASE_FACTOR = 0.5
+    DECREASE_INTERVAL_MS = 1000
+
+    # Weight given to each new latency sample in the moving average.
+    LATENCY_SAMPLE_WEIGHT = 0.2
+
+    def __init__(self, targetLatencyMs, minimumRate, maximumRate, increasePerSecond, initialRate=None):
+        """ Rates are in operations per second, shared by all threads using the limiter. """
+        super(AdaptiveRateLimiter,self).__init__()
+
+        if initialRate is None:
+            initialRate = maximumRate
+
+        assert 0 < minimumRate <= maximumRate
+
+        self.target_latency = targetLatencyMs
+        self.minimum_rate = float(minimumRate)
+        self.maximum_rate = float(maximumRate)
+        self.increase_per_second = float(increasePerSecond)
+
+        self.rate = min(max(float(initialRate), self.minimum_rate), self.maximum_rate)
+        self.average_latency = 0.0
+
+        self._next_time = getEpochMs()
+        self._last_decrease = 0
+        self._lock = RLock()
+
+    def waitForTurn(self):
+        """ Sleeps until the next operation is allowed. """
+        with self._lock:
+            now = getEpochMs()
+
+            # Don't let idle time build up a burst.
+            turn = max(now, self._next_time)
+            self._next_time = turn + (1000.0 / self.rate)
+
+            timeToWaitSeconds = float(turn - now) / 1000.0
+
+        if timeToWaitSeconds > 0:
+            time.sleep(timeToWaitSeconds)
+
+    def onComplete(self, latencyMs):
+        """ Call after each operation with the time it took. """
+        with self._lock:
+            weight = AdaptiveRateLimiter.LATENCY_SAMPLE_WEIGHT
+            self.average_latency = (self.average_latency * (1.0 - weight)) + (latencyMs * weight)
+
+            if self.average_latency > self.target_latency:
+                now = getEpochMs()
+                if now - self._last_decrease > AdaptiveRateLimiter.DECREASE_INTERVAL_MS:
+                    self._last_decrease = now
+                    self.rate = max(self.minimum_rate, self.rate * AdaptiveRateLimiter.DECREASE_FACTOR)
+            else:
+                # Operations happen rate times per second, so this adds increase_per_second per second.
+                self.rate = min(self.maximum_rate, self.rate + (self.increase_per_second / self.rate))
+
+    def __str__(self):
+        return 'rate %.1f/s, average latency %.1fms' % (self.rate, self.average_latency)
+
 def parseInteger(value, minimum=None, maximum=None, default=None):
     if len(value) == 0:
         return default
@@ -699,6 +769,16 @@ class OrderedDictEx(MutableMapping):
     def removeOrderedItem(self):
         return self._dic.popitem(not self.fifo)
 
+    def getItemsInOrder(self):
+        """ @return list of (key, value) in order of removal, without changing order. """
+        with self._lock:
+            items = self._dic.items()
+
+        if not self.fifo:
+            items.reverse()
+
+        return items
+
 def upperPowerTwo(value):
     if value == 0:
         return 1
@@ -755,6 +835,20 @@ def redirectOutputToLogger():
 
     sys.stderr = writer()
 
+def createBlockingPipe():
+    """ multiprocessing.Pipe is built from socket.socketpair, which gevent monkey patches
+        to make non blocking sockets. A message could then be partly read or written,
+        raising IOError (EAGAIN), so both ends are made blocking again.
+
+        Wait with gevent.socket.wait_read before recv to avoid blocking other greenlets.
+        @return (connection, connection) """
+    connections = Pipe()
+    for connection in connections:
+        flags = fcntl.fcntl(connection.fileno(), fcntl.F_GETFL)
+        fcntl.fcntl(connection.fileno(), fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+
+    return connections
+
 
 
 
@@ -899,6 +993,22 @@ class testUtility(unittest.TestCase):
             if timer.ticked():
                 print 'ticked rate limited'
 
+    def testAdaptiveRateLimiter(self):
+        limiter = AdaptiveRateLimiter(100, 10, 50, 100, 20)
+
+        for n in range(100):
+            limiter.onComplete(10)
+        assert limiter.rate == 50
+
+        limiter.onComplete(1000)
+        assert limiter.rate == 25
+
+        # Only decreases once per interval.
+        limiter.onComplete(1000)
+        assert limiter.rate == 25
+
+        assert AdaptiveRateLimiter(100, 10, 50, 100).rate == 50
+
     def testDistance(self):
         p1 = 5,5
         p2 = 20,25
@@ -1,40 +1,62 @@
+import gzip
+import json
 import logging
+import os
+import unittest
+import zlib
+import pymongo
 from pymongo.database import Database
-from api.caching.caching_shared import getDatabase
-from api.config import Configuration
+from api.caching.caching_shared import getDatabase, WORKLOAD_GEOCODE, registerCollectionIndex, createCollectionIndexes
+from api.config import Configuration, GE_GAZETTEER
+from api.core.data_structures.shared_table import SharedHashTable
 from api.geocode.geocode_external import geocodeFromExternal
+from api.geocode import geocode_gazetteer
 from api.geocode.geocode_shared import processGeocodeResults, GeocodeResultAbstract, buildGeocodeResult, isIntendedForDirectUse, getGeocodeSearchNamePath
-from api.core.utility import join, prepareLowerAlpha, extractWords, callAllCombinations, OrderedDictEx
+from api.geocode.geocode_spatial import spatialIndex
+from api.core.utility import join, prepareLowerAlpha, extractWords, callAllCombinations, OrderedDictEx, getEpochMs
 import re
 
 logger = logging.getLogger(__name__)
 
-def geocodeFromCache(query, providerId, countryCode=None, acceptableTypes=None, biasCoord=None, inMemoryOnly=None):
+# For warmGeocodeCachesFromDatabase, documents which have never been hit don't have the field.
+registerCollectionIndex('geocode', [('hits', pymongo.DESCENDING)], sparse = True)
+
+def buildCandidateQueries(query):
+    """ @return every combination of words in query that we search the cache for,
+                in order of precedence. """
     query = prepareLowerAlpha(query)
-    queries = extractWords(query)
+    words = extractWords(query)
+
+    queries = []
+    callAllCombinations(words, 4, lambda combination: queries.append(' '.join(combination)))
+    return queries
 
-    def func(query):
-        query = ' '.join(query)
+def geocodeFromCache(query, providerId, countryCode=None, acceptableTypes=None, biasCoord=None, inMemoryOnly=None):
+    queries = buildCandidateQueries(query)
+
+    if inMemoryOnly:
+        prefetched = None
+    else:
+        prefetched = prefetchGeocodeFromCache(queries, providerId, countryCode, acceptableTypes)
 
-        results = _geocodeFromCache(query, providerId, countryCode, acceptableTypes, inMemoryOnly, False)
+    # First query with a result wins.
+    for query in queries:
+        results = _geocodeFromCache(query, providerId, countryCode, acceptableTypes, inMemoryOnly, False, prefetched)
         if results is not None:
-            result = processGeocodeResults(results, biasCoord)
+            return processGeocodeResults(results, biasCoord)
 
-            stop = StopIteration()
-            stop.my_result = result
-            raise stop
+    return None
 
-    try:
-        callAllCombinations(queries,4,func)
-    except StopIteration as e:
-        return e.my_result
-    else:
-        return None
+def _resolveCacheId(cacheId):
+    """ @return cache ID suitable for querying the place collection and the importance rating
+                stored with it, cache ID is None if no useful ID was found. """
+    if isinstance(cacheId, list):
+        for item in cacheId:
+            if isIntendedForDirectUse(GeocodeResultAbstract.getProviderIdFromCacheId(item)):
+                return _resolveCacheId(item)
 
-inMemoryCacheGeocodeData = OrderedDictEx(True, Configuration.GEOCODE_IN_MEMORY_CACHE_SIZE, True)
-def geocodeFromCacheById(cacheId, inMemoryOnly=None):
-    if inMemoryOnly is None:
-        inMemoryOnly = False
+        logger.error('Could not find useful ID from ID list %s' % (unicode(cacheId)))
+        return None, None
 
     if 'importance_rating' in cacheId:
         importanceRating = cacheId['importance_rating']
@@ -43,31 +65,165 @@ def geocodeFromCacheById(cacheId, inMemoryOnly=None):
     else:
         importanceRating = None
 
-    if isinstance(cacheId, list):
-        success = False
-        for item in cacheId:
-            if isIntendedForDirectUse(GeocodeResultAbstract.getProviderIdFromCacheId(item)):
-                cacheId = item
-                success = True
-                break
+    return cacheId, importanceRating
 
-        if not success:
-            logger.error('Could not find useful ID from ID list %s' % (unicode(cacheId)))
-            return None
+# Tables shared by the server process with geocode processes, see GEOCODE_SHARED_CACHE_ENABLED.
+# Queries are by in memory lookup key, holding the place list of the query mapping,
+# places are by cache ID tuple, holding compressed place data. None if not open.
+sharedGeocodeQueries = None
+sharedGeocodePlaces = None
+
+# What a process which only reads the shared tables has read from the database since
+# takeSharedGeocodeCacheLoads was last called, to be given to the owner to publish.
+# List of (is query, in memory lookup key or cache ID tuple, place list or place data).
+sharedGeocodeCacheLoads = []
+
+def openSharedGeocodeCache(isOwner, ownerPid=None):
+    """ The owner creates empty tables and is the only process which writes to them,
+        so must open them before other processes do.
+        @param ownerPid process ID of the owner, whose tables are opened. This process if None.
+        @return true if opened. """
+    global sharedGeocodeQueries, sharedGeocodePlaces
+
+    closeSharedGeocodeCache()
+
+    if not Configuration.GEOCODE_SHARED_CACHE_ENABLED:
+        return False
+
+    if ownerPid is None:
+        ownerPid = os.getpid()
+
+    # Several servers can run on one host.
+    prefix = '%s_%d' % (Configuration.GEOCODE_SHARED_CACHE_FILE_PREFIX, ownerPid)
+    try:
+        sharedGeocodeQueries = SharedHashTable(prefix + '_query',
+                                               Configuration.GEOCODE_SHARED_CACHE_QUERY_SLOTS,
+                                               Configuration.GEOCODE_SHARED_CACHE_QUERY_SLOT_SIZE,
+                                               isOwner)
+        sharedGeocodePlaces = SharedHashTable(prefix + '_place',
+                                              Configuration.GEOCODE_SHARED_CACHE_PLACE_SLOTS,
+                                              Configuration.GEOCODE_SHARED_CACHE_PLACE_SLOT_SIZE,
+                                              isOwner)
+    except (EnvironmentError, ValueError) as e:
+        logger.error('Failed to open shared geocode cache %s: %s' % (prefix, e))
+        closeSharedGeocodeCache()
+        return False
+
+    return True
+
+def closeSharedGeocodeCache(removeFiles=False):
+    """ @param removeFiles if true and this process is the owner the tables are deleted,
+                            use when the server stops. """
+    global sharedGeocodeQueries, sharedGeocodePlaces
+
+    for table in [sharedGeocodeQueries, sharedGeocodePlaces]:
+        if table is not None:
+            table.close(removeFiles)
+
+    sharedGeocodeQueries = None
+    sharedGeocodePlaces = None
+
+def _buildSharedKey(items):
+    return json.dumps(list(items), separators=(',',':'))
+
+def _getSharedQueryMapping(memoryLookupKey):
+    """ @return query mapping in the same form as the geocode collection, None if not shared. """
+    if sharedGeocodeQueries is None:
+        return None
+
+    value = sharedGeocodeQueries.get(_buildSharedKey(memoryLookupKey))
+    if value is None:
+        return None
+
+    return {'_id' : memoryLookupKey[0], 'place' : json.loads(value)}
+
+def _putSharedQueryMapping(memoryLookupKey, queryMapping):
+    if sharedGeocodeQueries is None:
+        return
+
+    if not sharedGeocodeQueries.is_owner:
+        sharedGeocodeCacheLoads.append((True, tuple(memoryLookupKey), queryMapping['place']))
+        return
+
+    sharedGeocodeQueries.put(_buildSharedKey(memoryLookupKey), json.dumps(queryMapping['place'], separators=(',',':')))
+
+def _getSharedPlace(cacheIdTuple):
+    """ @return place in the same form as the place collection, None if not shared. """
+    if sharedGeocodePlaces is None:
+        return None
+
+    value = sharedGeocodePlaces.get(_buildSharedKey(cacheIdTuple))
+    if value is None:
+        return None
+
+    return {'_id' : GeocodeResultAbstract.buildCacheIdFromTuple(cacheIdTuple), 'place_data' : json.loads(zlib.decompress(value))}
+
+def _putSharedPlace(cacheIdTuple, placeData):
+    if sharedGeocodePlaces is None:
+        return
+
+    if not sharedGeocodePlaces.is_owner:
+        sharedGeocodeCacheLoads.append((False, tuple(cacheIdTuple), placeData))
+        return
+
+    sharedGeocodePlaces.put(_buildSharedKey(cacheIdTuple), zlib.compress(json.dumps(placeData, separators=(',',':'))))
+
+def takeSharedGeocodeCacheLoads():
+    """ @return what this process read from the database and could not add to the shared tables itself,
+                pass to publishSharedGeocodeCacheLoads in the owner. """
+    global sharedGeocodeCacheLoads
+
+    loads = sharedGeocodeCacheLoads
+    sharedGeocodeCacheLoads = []
+    return loads
+
+def publishSharedGeocodeCacheLoads(loads):
+    """ Adds what another process read from the database to the shared tables, owner only. """
+    for isQuery, key, value in loads:
+        if isQuery:
+            _putSharedQueryMapping(key, {'place' : value})
+        else:
+            _putSharedPlace(key, value)
+
+def getSharedGeocodeCacheStats():
+    if sharedGeocodeQueries is None:
+        return 'shared geocode cache not open'
+
+    return 'shared geocode queries: %s, places: %s' % (sharedGeocodeQueries, sharedGeocodePlaces)
+
+
+inMemoryCacheGeocodeData = OrderedDictEx(True, Configuration.GEOCODE_IN_MEMORY_CACHE_SIZE, True)
+def geocodeFromCacheById(cacheId, inMemoryOnly=None, prefetchedPlaces=None):
+    """ @param prefetchedPlaces place documents already read from the database by cache ID tuple,
+                                see prefetchGeocodeFromCache. """
+    if inMemoryOnly is None:
+        inMemoryOnly = False
+
+    cacheId, importanceRating = _resolveCacheId(cacheId)
+    if cacheId is None:
+        return None
 
     if isIntendedForDirectUse(GeocodeResultAbstract.getProviderIdFromCacheId(cacheId)):
         tup = GeocodeResultAbstract.buildTupleFromCacheId(cacheId)
         returnVal = inMemoryCacheGeocodeData.get(tup,None)
 
         if returnVal is None:
-            if not inMemoryOnly:
-                db = getDatabase()
-                assert isinstance(db, Database)
-                result = db.place.find_one({'_id' : cacheId})
-                if result is None:
-                    logger.warn('Could not find place cache ID in database: %s' % unicode(cacheId))
-                    return None
+            if prefetchedPlaces is not None and tup in prefetchedPlaces:
+                result = prefetchedPlaces[tup]
             else:
+                result = _getSharedPlace(tup)
+                if result is None:
+                    if inMemoryOnly:
+                        return None
+
+                    db = getDatabase(WORKLOAD_GEOCODE)
+                    assert isinstance(db, Database)
+                    result = db.place.find_one({'_id' : cacheId})
+                    if result is not None:
+                        _putSharedPlace(tup, result['place_data'])
+
+            if result is None:
+                logger.warn('Could not find place cache ID in database: %s' % unicode(cacheId))
                 return None
 
             returnVal = buildGeocodeResult(result['place_data'], cacheId['providerId'], importanceRating)
@@ -89,8 +245,159 @@ def getGeocodeDataInMemoryCacheSize():
     return len(inMemoryCacheGeocodeData)
 
 
+class GeocodePrefetch(object):
+    """ Database documents read in bulk for one geocode, see prefetchGeocodeFromCache. """
+    def __init__(self):
+        super(GeocodePrefetch,self).__init__()
+
+        # By geocode ID, None if we know there is no mapping.
+        self.query_mappings = dict()
+
+        # By cache ID tuple.
+        self.places = dict()
+
+def prefetchGeocodeFromCache(queries, providerId, countryCode=None, acceptableTypes=None):
+    """ Reads everything that geocoding any of queries could need from the database and
+        is not already in memory, using one query per collection instead of one per item.
+        Nothing is added to the in memory caches, that happens when items are used.
+        @return GeocodePrefetch to pass to _geocodeFromCache. """
+    prefetch = GeocodePrefetch()
+
+    mappings = []
+    missingGeocodeIds = []
+    for query in queries:
+        geocodeId = buildKey(query, countryCode, acceptableTypes)
+        memoryLookupKey = (geocodeId, countryCode, providerId)
+        queryMapping = inMemoryCacheGeocodeQuery.get(memoryLookupKey)
+        if queryMapping is None:
+            queryMapping = _getSharedQueryMapping(memoryLookupKey)
+            prefetch.query_mappings[geocodeId] = queryMapping
+            if queryMapping is None and not isGeocodeQueryKnownMissing(geocodeId, providerId):
+                missingGeocodeIds.append(geocodeId)
+
+        if queryMapping is not None:
+            mappings.append(queryMapping)
+
+    if len(missingGeocodeIds) > 0:
+        db = getDatabase(WORKLOAD_GEOCODE)
+        assert isinstance(db, Database)
+
+        for queryMapping in db.geocode.find({'_id': {'$in' : missingGeocodeIds}, 'place.providerId' : providerId}):
+            prefetch.query_mappings[queryMapping['_id']] = queryMapping
+            mappings.append(queryMapping)
+            _putSharedQueryMapping((queryMapping['_id'], countryCode, providerId), queryMapping)
+
+        for geocodeId in missingGeocodeIds:
+            if prefetch.query_mappings[geocodeId] is None:
+                setGeocodeQueryKnownMissing(geocodeId, providerId)
+
+    placeIds = []
+    for queryMapping in mappings:
+        placeIds += queryMapping['place']
+
+    prefetch.places = prefetchPlaces(placeIds)
+    return prefetch
+
+def prefetchPlaces(cacheIds):
+    """ Reads place documents which are not already in memory with one query.
+        @param cacheIds cache IDs as stored in the database, as passed to geocodeFromCacheById.
+        @return place documents by cache ID tuple to pass to geocodeFromCacheById,
+                None for places which are not in the database. """
+    places = dict()
+
+    missingCacheIds = []
+    for placeId in cacheIds:
+        cacheId, importanceRating = _resolveCacheId(placeId)
+        if cacheId is None or not isIntendedForDirectUse(GeocodeResultAbstract.getProviderIdFromCacheId(cacheId)):
+            continue
+
+        tup = GeocodeResultAbstract.buildTupleFromCacheId(cacheId)
+        if tup not in places and inMemoryCacheGeocodeData.get(tup,None) is None:
+            places[tup] = _getSharedPlace(tup)
+            if places[tup] is None:
+                missingCacheIds.append(cacheId)
+
+    if len(missingCacheIds) > 0:
+        db = getDatabase(WORKLOAD_GEOCODE)
+        assert isinstance(db, Database)
+
+        for place in db.place.find({'_id' : {'$in' : missingCacheIds}}):
+            tup = GeocodeResultAbstract.buildTupleFromCacheId(place['_id'])
+            places[tup] = place
+            _putSharedPlace(tup, place['place_data'])
+
+    return places
+
+
 inMemoryCacheGeocodeQuery = OrderedDictEx(True, Configuration.GEOCODE_QUERY_IN_MEMORY_CACHE_SIZE, True)
-def _geocodeFromCache(query, providerId, countryCode=None, acceptableTypes=None, inMemoryOnly=None, allowPartial=None):
+
+# Geocode queries with no mapping in the database, value is time at which we stop believing it.
+# Oldest entries are removed first, which are also the first to expire.
+negativeCacheGeocodeQuery = OrderedDictEx(True, Configuration.GEOCODE_QUERY_NEGATIVE_CACHE_SIZE, False)
+negativeCacheGeocodeQueryHits = 0
+
+def isGeocodeQueryKnownMissing(geocodeId, providerId):
+    global negativeCacheGeocodeQueryHits
+
+    key = (geocodeId, providerId)
+    expiry = negativeCacheGeocodeQuery.get(key)
+    if expiry is None:
+        return False
+
+    if expiry < getEpochMs():
+        clearGeocodeQueryKnownMissing(geocodeId, providerId)
+        return False
+
+    negativeCacheGeocodeQueryHits += 1
+    return True
+
+def setGeocodeQueryKnownMissing(geocodeId, providerId):
+    negativeCacheGeocodeQuery[(geocodeId, providerId)] = getEpochMs() + Configuration.GEOCODE_QUERY_NEGATIVE_CACHE_TTL_MS
+
+def clearGeocodeQueryKnownMissing(geocodeId, providerId):
+    try:
+        del negativeCacheGeocodeQuery[(geocodeId, providerId)]
+    except KeyError:
+        pass
+
+def clearAllGeocodeQueryKnownMissing():
+    negativeCacheGeocodeQuery.clear()
+
+# Queries written to the database since takeFoundGeocodeQueries was last called, so that geocode
+# processes, which have their own negative caches, can be told. Only kept once startRecordingFoundGeocodeQueries is called.
+foundGeocodeQueries = []
+isRecordingFoundGeocodeQueries = False
+
+def startRecordingFoundGeocodeQueries():
+    global isRecordingFoundGeocodeQueries
+    isRecordingFoundGeocodeQueries = True
+
+def takeFoundGeocodeQueries():
+    """ @return list of (geocode ID, provider ID) written to the database since last call. """
+    global foundGeocodeQueries
+
+    found = foundGeocodeQueries
+    foundGeocodeQueries = []
+    return found
+
+def _onGeocodeQueryFound(geocodeId, providerId):
+    clearGeocodeQueryKnownMissing(geocodeId, providerId)
+
+    if isRecordingFoundGeocodeQueries:
+        foundGeocodeQueries.append((geocodeId, providerId))
+
+def getGeocodeQueryNegativeCacheSize():
+    return len(negativeCacheGeocodeQuery)
+
+def getGeocodeQueryNegativeCacheHits():
+    """ @return number of database reads avoided by negative cache since last call. """
+    global negativeCacheGeocodeQueryHits
+
+    hits = negativeCacheGeocodeQueryHits
+    negativeCacheGeocodeQueryHits = 0
+    return hits
+
+def _geocodeFromCache(query, providerId, countryCode=None, acceptableTypes=None, inMemoryOnly=None, allowPartial=None, prefetch=None):
     if inMemoryOnly is None:
         inMemoryOnly = False
     if allowPartial is None:
@@ -102,21 +409,37 @@ def _geocodeFromCache(query, providerId, countryCode=None, acceptableTypes=None,
     queryMapping = inMemoryCacheGeocodeQuery.get(memoryLookupKey)
 
     if queryMapping is None:
-        if not inMemoryOnly:
-            db = getDatabase()
-            queryMapping = db.geocode.find_one({'_id': geocodeId, 'place.providerId' : providerId})
-            if queryMapping is None:
-                return None
-            inMemoryCacheGeocodeQuery[memoryLookupKey] = queryMapping
+        if prefetch is not None and geocodeId in prefetch.query_mappings:
+            queryMapping = prefetch.query_mappings[geocodeId]
         else:
+            queryMapping = _getSharedQueryMapping(memoryLookupKey)
+            if queryMapping is None:
+                if inMemoryOnly or isGeocodeQueryKnownMissing(geocodeId, providerId):
+                    return None
+
+                db = getDatabase(WORKLOAD_GEOCODE)
+                queryMapping = db.geocode.find_one({'_id': geocodeId, 'place.providerId' : providerId})
+                if queryMapping is None:
+                    setGeocodeQueryKnownMissing(geocodeId, providerId)
+                else:
+                    _putSharedQueryMapping(memoryLookupKey, queryMapping)
+        if queryMapping is None:
             return None
+        inMemoryCacheGeocodeQuery[memoryLookupKey] = queryMapping
 
     assert geocodeId == queryMapping['_id']
     placeIdList = queryMapping['place']
 
+    _onGeocodeQueryHit(memoryLookupKey)
+
+    if prefetch is not None:
+        prefetchedPlaces = prefetch.places
+    else:
+        prefetchedPlaces = None
+
     geocodeResults = []
     for placeId in placeIdList:
-        place = geocodeFromCacheById(placeId, inMemoryOnly)
+        place = geocodeFromCacheById(placeId, inMemoryOnly, prefetchedPlaces)
         if place is not None:
             geocodeResults.append(place)
         else:
@@ -134,6 +457,150 @@ def getGeocodeQueryInMemoryCacheSize():
     return len(inMemoryCacheGeocodeQuery)
 
 
+# Number of times each query was found, by in memory lookup key, since last flushGeocodeQueryHits.
+geocodeQueryHits = dict()
+
+def _onGeocodeQueryHit(memoryLookupKey):
+    # Not locked, losing the odd hit doesn't matter.
+    geocodeQueryHits[memoryLookupKey] = geocodeQueryHits.get(memoryLookupKey, 0) + 1
+
+def flushGeocodeQueryHits():
+    """ Adds hits counted in memory to the geocode collection, see warmGeocodeCachesFromDatabase.
+        The country code of the query is stored too, as it cannot be recovered from the geocode ID. """
+    global geocodeQueryHits
+
+    hits = geocodeQueryHits
+    geocodeQueryHits = dict()
+
+    if len(hits) == 0:
+        return
+
+    db = getDatabase(WORKLOAD_GEOCODE)
+    assert isinstance(db, Database)
+
+    bulk = db.geocode.initialize_unordered_bulk_op()
+    for (geocodeId, countryCode, providerId), count in hits.iteritems():
+        bulk.find({'_id' : geocodeId}).update_one({'$inc' : {'hits' : count}, '$set' : {'country_code' : countryCode}})
+
+    try:
+        bulk.execute()
+    except Exception as e:
+        logger.error('Failed to write %d geocode query hit counts: %s' % (len(hits), e))
+
+def saveGeocodeCacheSnapshot(fileName=None):
+    """ Writes the in memory geocode caches to a file, in least recently used order,
+        see loadGeocodeCacheSnapshot.
+        @return true if written. """
+    if fileName is None:
+        fileName = Configuration.GEOCODE_CACHE_SNAPSHOT_FILE
+
+    if not fileName:
+        return False
+
+    timer = getEpochMs()
+
+    places = []
+    for (providerId, placeId), result in inMemoryCacheGeocodeData.getItemsInOrder():
+        places.append([providerId, placeId, result.geocodeData, result.importance_rating])
+
+    queries = []
+    for memoryLookupKey, queryMapping in inMemoryCacheGeocodeQuery.getItemsInOrder():
+        queries.append([list(memoryLookupKey), queryMapping])
+
+    # Written to a temporary file first so that a crash doesn't leave half a snapshot.
+    temporaryFileName = fileName + '.tmp'
+    try:
+        with gzip.open(temporaryFileName, 'wb') as snapshotFile:
+            json.dump({'places' : places, 'queries' : queries}, snapshotFile, separators=(',',':'))
+
+        os.rename(temporaryFileName, fileName)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        logger.error('Failed to write geocode cache snapshot %s: %s' % (fileName, e))
+        return False
+
+    logger.info('Wrote geocode cache snapshot %s with %d places and %d queries in %dms' % (fileName, len(places), len(queries), getEpochMs() - timer))
+    return True
+
+def loadGeocodeCacheSnapshot(fileName=None):
+    """ Fills the in memory geocode caches from a file written by saveGeocodeCacheSnapshot.
+        @return true if loaded. """
+    if fileName is None:
+        fileName = Configuration.GEOCODE_CACHE_SNAPSHOT_FILE
+
+    if not fileName or not os.path.exists(fileName):
+        return False
+
+    timer = getEpochMs()
+    try:
+        with gzip.open(fileName, 'rb') as snapshotFile:
+            snapshot = json.load(snapshotFile)
+    except (IOError, ValueError) as e:
+        logger.error('Failed to read geocode cache snapshot %s: %s' % (fileName, e))
+        return False
+
+    for providerId, placeId, placeData, importanceRating in snapshot['places']:
+        result = buildGeocodeResult(placeData, providerId, importanceRating)
+        if result is not None:
+            cacheIdTuple = GeocodeResultAbstract.buildCacheIdTuple(providerId, placeId)
+            inMemoryCacheGeocodeData[cacheIdTuple] = result
+            _putSharedPlace(cacheIdTuple, placeData)
+
+    for memoryLookupKey, queryMapping in snapshot['queries']:
+        inMemoryCacheGeocodeQuery[tuple(memoryLookupKey)] = queryMapping
+        _putSharedQueryMapping(memoryLookupKey, queryMapping)
+
+    logger.info('Loaded geocode cache snapshot %s with %d places and %d queries in %dms' % (fileName, len(snapshot['places']), len(snapshot['queries']), getEpochMs() - timer))
+    return True
+
+def warmGeocodeCachesFromDatabase(providerId, maxQueries=None, batchSize=1000):
+    """ Fills the in memory geocode caches with the most hit queries of provider and their places.
+        @return number of queries loaded. """
+    if maxQueries is None:
+        maxQueries = Configuration.GEOCODE_QUERY_IN_MEMORY_CACHE_SIZE
+
+    timer = getEpochMs()
+
+    db = getDatabase(WORKLOAD_GEOCODE)
+    assert isinstance(db, Database)
+
+    createCollectionIndexes('geocode')
+
+    # Only queries whose hits were counted have their country code.
+    queryMappings = list(db.geocode.find({'hits' : {'$gt' : 0}, 'country_code' : {'$exists' : True}, 'place.providerId' : providerId}).sort('hits', pymongo.DESCENDING).limit(maxQueries))
+
+    # Least hit first, so that most hit are the last to be removed from the caches.
+    queryMappings.reverse()
+
+    numPlaces = 0
+    for n in range(0, len(queryMappings), batchSize):
+        batch = queryMappings[n:n + batchSize]
+
+        placeIds = []
+        for queryMapping in batch:
+            placeIds += queryMapping['place']
+
+        prefetchedPlaces = prefetchPlaces(placeIds)
+        for placeId in placeIds:
+            if geocodeFromCacheById(placeId, False, prefetchedPlaces) is not None:
+                numPlaces += 1
+
+        for queryMapping in batch:
+            memoryLookupKey = (queryMapping['_id'], queryMapping['country_code'], providerId)
+            inMemoryCacheGeocodeQuery[memoryLookupKey] = queryMapping
+            _putSharedQueryMapping(memoryLookupKey, queryMapping)
+
+    logger.info('Warmed geocode caches with %d queries and %d places from database in %dms' % (len(queryMappings), numPlaces, getEpochMs() - timer))
+    return len(queryMappings)
+
+def warmGeocodeCaches(providerId):
+    """ Fills the in memory geocode caches from snapshot if there is one, otherwise from the database. """
+    if loadGeocodeCacheSnapshot():
+        return
+
+    if Configuration.GEOCODE_CACHE_WARM_UP_FROM_DATABASE:
+        warmGeocodeCachesFromDatabase(providerId)
+
+
 def buildKeyFromList(theList):
     theList = sorted(theList)
 
@@ -149,7 +616,7 @@ def buildKey(query, countryCode, acceptableTypes):
     return buildKeyFromList([query, countryCode] + list(acceptableTypes))
 
 def writeGeocodeResultToCache(query, countryCode, acceptableTypes, results):
-    db = getDatabase()
+    db = getDatabase(WORKLOAD_GEOCODE)
     assert(isinstance(db, Database))
 
     placeIdList = []
@@ -166,9 +633,61 @@ def writeGeocodeResultToCache(query, countryCode, acceptableTypes, results):
 
         # probably should make result.geocodeData part of GeocodeResultAbstract.
         db.place.update({'_id': cacheId}, {'_id' : cacheId, 'place_data': result.geocodeData}, upsert=True)
+        _putSharedPlace(result.cache_id_tuple, result.geocodeData)
+
+        if Configuration.REVERSE_GEOCODE_ENABLED:
+            addPlaceToSpatialIndex(result)
 
     geocodeId = buildKey(query, countryCode, acceptableTypes)
-    db.geocode.update({'_id': geocodeId}, {'_id' : geocodeId, 'place': placeIdList}, upsert=True)
+    db.geocode.update({'_id': geocodeId}, {'$set' : {'place': placeIdList, 'country_code' : countryCode}}, upsert=True)
+
+    for providerId in set([result.provider_id for result in results]):
+        _onGeocodeQueryFound(geocodeId, providerId)
+        _putSharedQueryMapping((geocodeId, countryCode, providerId), {'place' : placeIdList})
+
+
+def addPlaceToSpatialIndex(result):
+    # Countries are found by GNS bounding box instead, their point is only a centre.
+    if result is None or result.place_type == GeocodeResultAbstract.PlaceTypes.COUNTRY:
+        return False
+
+    return spatialIndex.addResult(result)
+
+def loadSpatialIndexFromCache(providerId):
+    """ Adds places of provider in the place collection, GNS countries and continents,
+        and gazetteer cities if loaded to the spatial index used by reverseGeocodeFromCache. """
+    timer = getEpochMs()
+
+    spatialIndex.addGnsData()
+
+    if geocode_gazetteer.isGazetteerInitialized:
+        for placeData in geocode_gazetteer.gazetteer.places:
+            result = buildGeocodeResult(placeData, GE_GAZETTEER)
+            if result is not None:
+                spatialIndex.addResult(result, placeData)
+
+    db = getDatabase(WORKLOAD_GEOCODE)
+    assert isinstance(db, Database)
+
+    for item in db.place.find({'_id.providerId' : providerId}):
+        addPlaceToSpatialIndex(buildGeocodeResult(item['place_data'], providerId))
+
+    logger.info('Loaded %d places into spatial index in %dms' % (spatialIndex.num_points, getEpochMs() - timer))
+
+def reverseGeocodeFromCache(coordinate, acceptableTypes=None, inMemoryOnly=None):
+    """ @param coordinate tuple in form: latitude,longitude.
+        @return nearest place of an acceptable type within REVERSE_GEOCODE_MAX_DISTANCE_KM of coordinate,
+                or if there isn't one, the GNS place containing coordinate.
+                None if no place was found, or the nearest place is not in memory and inMemoryOnly. """
+    nearest = spatialIndex.findNearestPoint(coordinate, Configuration.REVERSE_GEOCODE_MAX_DISTANCE_KM, acceptableTypes)
+    if nearest is None:
+        return spatialIndex.findContainingBox(coordinate, acceptableTypes)
+
+    latitude, longitude, placeType, cacheIdTuple, placeData = nearest
+    if placeData is not None:
+        return buildGeocodeResult(placeData, cacheIdTuple[0])
+
+    return geocodeFromCacheById(GeocodeResultAbstract.buildCacheIdFromTuple(cacheIdTuple), inMemoryOnly)
 
 
 def geocodeFromExternalAndWriteToCache(query, providerId, countryCode=None, acceptableTypes=None, biasCoord=None, retry=2):
@@ -181,7 +700,7 @@ def geocodeFromExternalAndWriteToCache(query, providerId, countryCode=None, acce
 
 
 def geocodeSearch(providerId, placeName, maxResults = 10):
-    db = getDatabase()
+    db = getDatabase(WORKLOAD_GEOCODE)
     assert isinstance(db, Database)
 
     logger.info('Searching for location: %s' % placeName)
@@ -202,3 +721,116 @@ def geocodeSearch(providerId, placeName, maxResults = 10):
                 break
 
     return results
+
+
+class testSharedGeocodeCache(unittest.TestCase):
+    class FakeCollection(object):
+        def __init__(self, documents):
+            self.documents = documents
+            self.num_reads = 0
+
+        def find_one(self, query):
+            self.num_reads += 1
+            for document in self.documents:
+                if document['_id'] == query['_id']:
+                    return document
+            return None
+
+        def find(self, query):
+            self.num_reads += 1
+            return [document for document in self.documents if document['_id'] in query['_id']['$in']]
+
+    class FakeDatabase(Database):
+        def __init__(self):
+            # Collections are set by the test.
+            pass
+
+    def setUp(self):
+        import tempfile
+        global getDatabase
+
+        self.directory = tempfile.mkdtemp()
+        self.configuration = (Configuration.GEOCODE_SHARED_CACHE_ENABLED, Configuration.GEOCODE_SHARED_CACHE_FILE_PREFIX)
+        Configuration.GEOCODE_SHARED_CACHE_ENABLED = True
+        Configuration.GEOCODE_SHARED_CACHE_FILE_PREFIX = os.path.join(self.directory, 'geocode')
+
+        self.place_data = {'place_id' : 1, 'name' : 'Leeds', 'display_name' : 'Leeds, United Kingdom',
+                           'lat' : 53.8, 'lon' : -1.5, 'feature_code' : 'PPL', 'country_code' : 'gb',
+                           'population' : 455123, 'importance' : 0.35}
+        self.cache_id = GeocodeResultAbstract.buildCacheId(GE_GAZETTEER, 1)
+
+        self.database = testSharedGeocodeCache.FakeDatabase()
+        self.database.geocode = testSharedGeocodeCache.FakeCollection([{'_id' : buildKey('leeds', None, None), 'place' : [self.cache_id]}])
+        self.database.place = testSharedGeocodeCache.FakeCollection([{'_id' : self.cache_id, 'place_data' : self.place_data}])
+
+        self.get_database = getDatabase
+        getDatabase = lambda workload=None: self.database
+
+        self._clearMemory()
+
+    def tearDown(self):
+        import shutil
+        global getDatabase
+
+        closeSharedGeocodeCache(True)
+        getDatabase = self.get_database
+        Configuration.GEOCODE_SHARED_CACHE_ENABLED, Configuration.GEOCODE_SHARED_CACHE_FILE_PREFIX = self.configuration
+        self._clearMemory()
+        takeSharedGeocodeCacheLoads()
+        shutil.rmtree(self.directory)
+
+    def _clearMemory(self):
+        inMemoryCacheGeocodeData.clear()
+        inMemoryCacheGeocodeQuery.clear()
+        negativeCacheGeocodeQuery.clear()
+
+    def _numReads(self):
+        return self.database.geocode.num_reads + self.database.place.num_reads
+
+    def testOwner(self):
+        assert openSharedGeocodeCache(True)
+
+        # Not in memory or shared.
+        assert _geocodeFromCache('leeds', GE_GAZETTEER, inMemoryOnly=True) is None
+
+        # Read from the database and shared.
+        assert _geocodeFromCache('leeds', GE_GAZETTEER)[0].place_id == 1
+        numReads = self._numReads()
+        assert numReads == 2
+
+        # In memory.
+        assert _geocodeFromCache('leeds', GE_GAZETTEER, inMemoryOnly=True)[0].place_id == 1
+
+        # Shared, as another process would see it.
+        self._clearMemory()
+        assert _geocodeFromCache('leeds', GE_GAZETTEER, inMemoryOnly=True)[0].place_id == 1
+        self._clearMemory()
+        assert geocodeFromCacheById(self.cache_id, True).display_name == 'Leeds, United Kingdom'
+        self._clearMemory()
+        assert geocodeFromCache('leeds', GE_GAZETTEER).place_id == 1
+        assert self._numReads() == numReads
+
+    def testReader(self):
+        assert openSharedGeocodeCache(True)
+        owner = (sharedGeocodeQueries, sharedGeocodePlaces)
+
+        # The owner's tables stay open, as they would in the parent process.
+        globals()['sharedGeocodeQueries'], globals()['sharedGeocodePlaces'] = None, None
+        assert openSharedGeocodeCache(False, os.getpid())
+
+        assert _geocodeFromCache('leeds', GE_GAZETTEER)[0].place_id == 1
+        loads = takeSharedGeocodeCacheLoads()
+        assert len(loads) == 2
+        assert _getSharedQueryMapping((buildKey('leeds', None, None), None, GE_GAZETTEER)) is None
+
+        readers = (sharedGeocodeQueries, sharedGeocodePlaces)
+        globals()['sharedGeocodeQueries'], globals()['sharedGeocodePlaces'] = owner
+        publishSharedGeocodeCacheLoads(loads)
+        globals()['sharedGeocodeQueries'], globals()['sharedGeocodePlaces'] = readers
+
+        self._clearMemory()
+        assert _geocodeFromCache('leeds', GE_GAZETTEER, inMemoryOnly=True)[0].place_id == 1
+
+        for table in owner:
+            table.close()
+
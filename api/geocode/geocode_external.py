@@ -1,7 +1,8 @@
 import unittest
 import requests
-from api.config import Configuration, GE_MAP_QUEST, GE_GOOGLE
+from api.config import Configuration, GE_MAP_QUEST, GE_GOOGLE, GE_GAZETTEER
 from api.core.utility import Timer
+from api.geocode.geocode_gazetteer import geocodeFromGazetteer
 from api.geocode.geocode_shared import GeocodeResult, GeocodeResultGoogle, BadGeocodeException
 import logging
 import itertools
@@ -126,6 +127,8 @@ def geocodeFromExternal(query, providerId, countryCode=None, acceptableTypes=Non
                 results = _geocodeFromExternalOMQ(query, countryCode, acceptableTypes)
             elif providerId == GE_GOOGLE:
                 results = _geocodeFromExternalGoogle(query, countryCode, acceptableTypes)
+            elif providerId == GE_GAZETTEER:
+                results = geocodeFromGazetteer(query, countryCode, acceptableTypes)
             else:
                 logger.error('Invalid geocode external provider: %s' % providerId)
                 results = None
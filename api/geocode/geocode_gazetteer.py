@@ -0,0 +1,274 @@
+import csv
+import logging
+import math
+import unittest
+from api.config import Configuration, GE_GAZETTEER
+from api.core.utility import prepareLowerAlpha, extractWords, callAllCombinations
+from api.geocode.geocode_shared import GeocodeResultAbstract, GeocodeResultGazetteer
+
+__author__ = 'Michael Pryor'
+
+logger = logging.getLogger(__name__)
+
+# GE_GAZETTEER geocodes from a GeoNames city dump held in memory, so unlike the external
+# providers there is no web request and no rate limit. Results are written to the cache
+# like those of any other provider.
+#
+# Cities are indexed by their name, ASCII name and alternate names, normalized in the same way
+# as cache queries. Importance ratings come from population, so that when a name is shared
+# the larger city is preferred, as it is by processGeocodeResults.
+
+# Columns of GeoNames dump files.
+GEONAMES_NUM_COLUMNS = 19
+GEONAMES_ID = 0
+GEONAMES_NAME = 1
+GEONAMES_ASCII_NAME = 2
+GEONAMES_ALTERNATE_NAMES = 3
+GEONAMES_LATITUDE = 4
+GEONAMES_LONGITUDE = 5
+GEONAMES_FEATURE_CLASS = 6
+GEONAMES_FEATURE_CODE = 7
+GEONAMES_COUNTRY_CODE = 8
+GEONAMES_POPULATION = 14
+
+# Feature class of populated places.
+GEONAMES_FEATURE_CLASS_CITY = 'P'
+
+def getImportanceFromPopulation(population):
+    """ @return importance rating between 0 and 0.5, a city of 10 million people is rated 0.44.
+                Kept below the ratings of open map quest, which are halved. """
+    return min(0.5, math.log10(max(population, 0) + 1) / 16.0)
+
+def _getCountryDisplayName(countryCode):
+    if GeocodeResultAbstract.isGnsDataInitialized:
+        country = GeocodeResultAbstract.gnsCountryDataByIsoCode.get(countryCode, None)
+        if country is not None:
+            return country.display_name
+
+    return countryCode.upper()
+
+def parseGazetteerRow(row, includeAlternateNames=True):
+    """ @param row columns of a line of a GeoNames dump.
+        @return place data to build GeocodeResultGazetteer from and the names of the place,
+                None, None if the row is not a city. """
+    if len(row) <= GEONAMES_POPULATION:
+        raise ValueError('Expected %d columns, found %d' % (GEONAMES_NUM_COLUMNS, len(row)))
+
+    if row[GEONAMES_FEATURE_CLASS] != GEONAMES_FEATURE_CLASS_CITY:
+        return None, None
+
+    name = row[GEONAMES_NAME].decode('utf-8')
+    countryCode = row[GEONAMES_COUNTRY_CODE].lower()
+
+    population = row[GEONAMES_POPULATION]
+    if len(population) > 0:
+        population = int(population)
+    else:
+        population = 0
+
+    placeData = {'place_id' : int(row[GEONAMES_ID]),
+                 'name' : name,
+                 'display_name' : u'%s, %s' % (name, _getCountryDisplayName(countryCode)),
+                 'lat' : float(row[GEONAMES_LATITUDE]),
+                 'lon' : float(row[GEONAMES_LONGITUDE]),
+                 'feature_code' : row[GEONAMES_FEATURE_CODE],
+                 'country_code' : countryCode,
+                 'population' : population,
+                 'importance' : getImportanceFromPopulation(population)}
+
+    names = [name, row[GEONAMES_ASCII_NAME].decode('utf-8')]
+    if includeAlternateNames:
+        alternateNames = row[GEONAMES_ALTERNATE_NAMES]
+        if len(alternateNames) > 0:
+            names += alternateNames.decode('utf-8').split(',')
+
+    return placeData, names
+
+
+class Gazetteer(object):
+    def __init__(self):
+        super(Gazetteer,self).__init__()
+
+        # Normalized name -> list of place data, most populated first.
+        self.places_by_name = dict()
+        self.places = []
+
+    @property
+    def num_places(self):
+        return len(self.places)
+
+    def clear(self):
+        self.places_by_name.clear()
+        del self.places[:]
+
+    def addPlace(self, placeData, names):
+        keys = set()
+        for name in names:
+            key = prepareLowerAlpha(name)
+            if key is not None and len(key) > 0:
+                keys.add(key)
+
+        for key in keys:
+            self.places_by_name.setdefault(key, []).append(placeData)
+
+        self.places.append(placeData)
+
+    def sortPlaces(self):
+        """ Call once all places have been added. """
+        for places in self.places_by_name.itervalues():
+            places.sort(key=lambda x: x['population'], reverse=True)
+
+    def _getCountryCodesInQuery(self, words):
+        countryCodes = set()
+        for word in words:
+            for country in GeocodeResultAbstract.searchCountryByName(word):
+                if prepareLowerAlpha(country.display_name) == word and country.has_iso_code:
+                    countryCodes.add(country.iso_code)
+
+        return countryCodes
+
+    def search(self, query, countryCode=None, acceptableTypes=None, maxResults=None):
+        """ Searches for every combination of words in query, longest first, as geocodeFromCache does.
+            The first combination naming a city wins. If other words in the query name a country,
+            cities in that country are preferred.
+            @return list of GeocodeResultGazetteer, empty if nothing found. """
+        if maxResults is None:
+            maxResults = Configuration.GAZETTEER_MAX_RESULTS
+
+        query = prepareLowerAlpha(query)
+        if query is None:
+            return []
+
+        words = extractWords(query)
+
+        candidates = []
+        callAllCombinations(words, 4, lambda combination: candidates.append(combination))
+
+        if countryCode is not None:
+            countryCode = countryCode.lower()
+
+        for combination in candidates:
+            places = self.places_by_name.get(' '.join(combination), None)
+            if places is None:
+                continue
+
+            results = []
+            for placeData in places:
+                if countryCode is not None and placeData['country_code'] != countryCode:
+                    continue
+
+                result = GeocodeResultGazetteer(placeData)
+                if acceptableTypes is None or result.place_type in acceptableTypes:
+                    results.append(result)
+
+            if len(results) == 0:
+                continue
+
+            if countryCode is None and len(results) > 1:
+                otherWords = [word for word in words if word not in combination]
+                queryCountryCodes = self._getCountryCodesInQuery(otherWords)
+                inQueryCountries = [result for result in results if result.country_iso_code in queryCountryCodes]
+                if len(inQueryCountries) > 0:
+                    results = inQueryCountries
+
+            return results[:maxResults]
+
+        return []
+
+    def loadFromFile(self, fileName, minPopulation=0, includeAlternateNames=True):
+        self.clear()
+
+        numBadRows = 0
+        with open(fileName, 'rb') as gazetteerFile:
+            # GeoNames does not quote fields.
+            gazetteerCsv = csv.reader(gazetteerFile, delimiter='\t', quoting=csv.QUOTE_NONE)
+
+            for row in gazetteerCsv:
+                try:
+                    placeData, names = parseGazetteerRow(row, includeAlternateNames)
+                except ValueError as e:
+                    numBadRows += 1
+                    logger.debug('Skipping bad row of gazetteer file %s: %s' % (fileName, e))
+                    continue
+
+                if placeData is None or placeData['population'] < minPopulation:
+                    continue
+
+                self.addPlace(placeData, names)
+
+        self.sortPlaces()
+
+        if numBadRows > 0:
+            logger.warn('Skipped %d bad rows of gazetteer file %s' % (numBadRows, fileName))
+
+        logger.info('Loaded %d cities with %d names from gazetteer file %s' % (self.num_places, len(self.places_by_name), fileName))
+
+gazetteer = Gazetteer()
+isGazetteerInitialized = False
+
+def initializeGazetteerFromFile():
+    global isGazetteerInitialized
+
+    if isGazetteerInitialized:
+        return
+
+    # Display names include country names.
+    GeocodeResultAbstract.initializeCountryContinentDataFromCsv()
+
+    gazetteer.loadFromFile(Configuration.GAZETTEER_DATA_FILE,
+                           Configuration.GAZETTEER_MIN_POPULATION,
+                           Configuration.GAZETTEER_ALTERNATE_NAMES_ENABLED)
+
+    isGazetteerInitialized = True
+
+def geocodeFromGazetteer(query, countryCode=None, acceptableTypes=None):
+    """ Same as external geocode functions but searches the gazetteer.
+        @return list of GeocodeResultGazetteer, None if nothing found. """
+    if query is None:
+        return None
+
+    if not isGazetteerInitialized:
+        initializeGazetteerFromFile()
+
+    results = gazetteer.search(query, countryCode, acceptableTypes)
+    if len(results) == 0:
+        return None
+    else:
+        return results
+
+
+class testGazetteer(unittest.TestCase):
+    def testSearch(self):
+        def buildRow(placeId, name, alternateNames, countryCode, population, featureCode='PPL'):
+            row = [''] * GEONAMES_NUM_COLUMNS
+            row[GEONAMES_ID] = str(placeId)
+            row[GEONAMES_NAME] = name
+            row[GEONAMES_ASCII_NAME] = name
+            row[GEONAMES_ALTERNATE_NAMES] = alternateNames
+            row[GEONAMES_LATITUDE] = '51.5'
+            row[GEONAMES_LONGITUDE] = '-0.1'
+            row[GEONAMES_FEATURE_CLASS] = GEONAMES_FEATURE_CLASS_CITY
+            row[GEONAMES_FEATURE_CODE] = featureCode
+            row[GEONAMES_COUNTRY_CODE] = countryCode
+            row[GEONAMES_POPULATION] = str(population)
+            return row
+
+        theGazetteer = Gazetteer()
+        for row in [buildRow(1, 'London', 'Londres,Lundain', 'GB', 7556900),
+                    buildRow(2, 'London', '', 'CA', 346765),
+                    buildRow(3, 'York', '', 'GB', 153717),
+                    buildRow(4, 'New York City', 'New York,NYC', 'US', 8175133),
+                    buildRow(5, 'Soho', '', 'GB', 0, 'PPLX')]:
+            theGazetteer.addPlace(*parseGazetteerRow(row))
+        theGazetteer.sortPlaces()
+
+        results = theGazetteer.search('London')
+        assert [x.place_id for x in results] == [1, 2]
+        assert results[0].importance_rating > results[1].importance_rating
+        assert results[0].cache_id == GeocodeResultAbstract.buildCacheId(GE_GAZETTEER, 1)
+
+        assert [x.place_id for x in theGazetteer.search('london', 'ca')] == [2]
+        assert [x.place_id for x in theGazetteer.search('Londres!')] == [1]
+        assert [x.place_id for x in theGazetteer.search('new york, USA')] == [4]
+        assert theGazetteer.search('soho', acceptableTypes=[GeocodeResultAbstract.PlaceTypes.CITY]) == []
+        assert theGazetteer.search('nowhere') == []
@@ -3,7 +3,7 @@ from collections import Hashable
 import csv
 import hashlib
 import logging
-from api.config import Configuration, GE_GEO_NET, GE_MAP_QUEST, GE_GOOGLE
+from api.config import Configuration, GE_GEO_NET, GE_MAP_QUEST, GE_GOOGLE, GE_GAZETTEER
 from api.core.data_structures.tree import Tree
 from api.core.utility import getDistance, lower_item, searchDictionary, hashStringToInteger32
 
@@ -637,6 +637,70 @@ class GeocodeResultGoogle(GeocodeResultAbstract):
                 self._country_iso_code = None
 
 
+class GeocodeResultGazetteer(GeocodeResultAbstract):
+    def __init__(self, geocodeData):
+        """ @param geocodeData dictionary of place data, see geocode_gazetteer. """
+        super(GeocodeResultGazetteer, self).__init__()
+
+        self.geocodeData = Tree.make(geocodeData)
+
+    @property
+    def provider(self):
+        return 'gazetteer'
+
+    @property
+    def provider_id(self):
+        return GE_GAZETTEER
+
+    @property
+    def display_name(self):
+        return self.geocodeData.getFromTree(['display_name'])
+
+    @property
+    def display_name_short(self):
+        return self.geocodeData.getFromTree(['name'])
+
+    @property
+    def cache_id(self):
+        return GeocodeResultAbstract.buildCacheId(self.provider_id,self.place_id)
+
+    @property
+    def place_id(self):
+        return int(self.geocodeData.getFromTree(['place_id']))
+
+    @property
+    def coordinate(self):
+        """ @return center coordinate tuple in form: latitude,longitude """
+        return float(self.geocodeData.getFromTree(['lat'])), float(self.geocodeData.getFromTree(['lon']))
+
+    @property
+    def bounding_box_true(self):
+        # Gazetteers have points only.
+        return None
+
+    @property
+    def place_type(self):
+        """ @return type of place e.g. PlaceType.CITY """
+        featureCode = self.geocodeData.getFromTree(['feature_code'])
+        if featureCode == 'PPLX':
+            # Section of populated place.
+            return GeocodeResultAbstract.PlaceTypes.BOROUGH
+        else:
+            return GeocodeResultAbstract.PlaceTypes.CITY
+
+    @property
+    def country_iso_code(self):
+        return self.geocodeData.getFromTree(['country_code'])
+
+    @GeocodeResultAbstract.importance_rating.getter
+    def importance_rating(self):
+        rating = super(GeocodeResultGazetteer,self).importance_rating
+        if rating is not None:
+            return rating
+
+        return self.geocodeData.getFromTree(['importance'])
+
+
 class GeocodeResultGNS(GeocodeResultAbstract):
     currentHashCode = 0
 
@@ -754,6 +818,8 @@ def buildGeocodeResult(data, providerId, importanceRating=None):
             result = GeocodeResult(data)
         elif providerId == GE_GOOGLE:
             result = GeocodeResultGoogle(data)
+        elif providerId == GE_GAZETTEER:
+            result = GeocodeResultGazetteer(data)
         elif providerId == GE_GEO_NET:
             raise NotImplementedError()
         else:
@@ -775,7 +841,7 @@ def getGeocodeSearchNamePath(providerId):
     """ Item of data within raw geocode data that is used for searching. """
     if providerId == GE_GOOGLE:
         return ['formatted_address']
-    elif providerId == GE_MAP_QUEST:
+    elif providerId == GE_MAP_QUEST or providerId == GE_GAZETTEER:
         return ['display_name']
     else:
         raise NotImplementedError()
@@ -785,7 +851,7 @@ def isIntendedForDirectUse(providerId):
         We store this in memory but store references to it in the database.
         We never store this data in the database and it is used dynamically.
         Users are not expected to construct GE_GEO_NET type objects from the database. """
-    if providerId == GE_MAP_QUEST or providerId == GE_GOOGLE:
+    if providerId == GE_MAP_QUEST or providerId == GE_GOOGLE or providerId == GE_GAZETTEER:
         return True
     elif providerId == GE_GEO_NET:
         return False
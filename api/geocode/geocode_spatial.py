@@ -0,0 +1,204 @@
+import logging
+import math
+import unittest
+from api.geocode.geocode_shared import GeocodeResultAbstract
+
+__author__ = 'Michael Pryor'
+
+logger = logging.getLogger(__name__)
+
+# Finds places near a coordinate, so that geotagged tweets can be geocoded from where
+# they were sent instead of by searching for their user's location text.
+#
+# Places with a point (cities, boroughs) are kept in a grid of small cells, and searching
+# only looks at cells within the maximum distance. Places with a bounding box (GNS countries
+# and continents) are kept in a grid of large cells, by every cell their box overlaps.
+
+KM_PER_DEGREE = 111.2
+
+def getDistanceKm(coord1, coord2):
+    """ Approximate distance between two coordinates in form: latitude,longitude.
+        Accurate enough at the distances we search. """
+    lat1, lon1 = coord1
+    lat2, lon2 = coord2
+
+    lonDifference = abs(lon2 - lon1)
+    if lonDifference > 180:
+        lonDifference = 360 - lonDifference
+
+    x = lonDifference * math.cos(math.radians((lat1 + lat2) / 2.0))
+    y = lat2 - lat1
+    return math.sqrt(x*x + y*y) * KM_PER_DEGREE
+
+
+class SpatialIndex(object):
+    def __init__(self, pointCellSizeDegrees=0.5, boxCellSizeDegrees=10.0):
+        super(SpatialIndex,self).__init__()
+
+        self.point_cell_size = pointCellSizeDegrees
+        self.box_cell_size = boxCellSizeDegrees
+
+        # Cell -> list of (latitude, longitude, place type, cache ID tuple, place data).
+        # Place data is None if the place is to be read from the cache.
+        self.points_by_cell = dict()
+        self.point_cache_ids = set()
+
+        # Cell -> list of (south, north, west, east, centre coordinate, geocode result).
+        self.boxes_by_cell = dict()
+
+    @property
+    def num_points(self):
+        return len(self.point_cache_ids)
+
+    def _getCell(self, latitude, longitude, cellSize):
+        # Longitude wraps around, latitude does not.
+        numLonCells = int(math.ceil(360.0 / cellSize))
+        return int(math.floor(latitude / cellSize)), int(math.floor((longitude + 180.0) / cellSize)) % numLonCells
+
+    def addPoint(self, coordinate, placeType, cacheIdTuple, placeData=None):
+        """ @param placeData data to build the result from with buildGeocodeResult,
+                             None if it is to be read with geocodeFromCacheById. """
+        if coordinate is None or placeType is None or cacheIdTuple is None:
+            return False
+
+        if cacheIdTuple in self.point_cache_ids:
+            return False
+
+        latitude, longitude = coordinate
+        cell = self._getCell(latitude, longitude, self.point_cell_size)
+        self.points_by_cell.setdefault(cell, []).append((latitude, longitude, placeType, cacheIdTuple, placeData))
+        self.point_cache_ids.add(cacheIdTuple)
+        return True
+
+    def addResult(self, result, placeData=None):
+        """ Adds a place with a point, places with only a bounding box should use addBox. """
+        assert isinstance(result, GeocodeResultAbstract)
+        return self.addPoint(result.coordinate, result.place_type, result.cache_id_tuple, placeData)
+
+    def addBox(self, result):
+        assert isinstance(result, GeocodeResultAbstract)
+        if not result.has_bounding_box:
+            return False
+
+        south, north, west, east = result.bounding_box_true
+
+        # Some continent boxes have north and south the wrong way round.
+        south, north = min(south, north), max(south, north)
+
+        # GNS coordinates are read from CSV as strings.
+        latitude, longitude = result.coordinate
+        item = (south, north, west, east, (float(latitude), float(longitude)), result)
+
+        southCell, westCell = self._getCell(south, west, self.box_cell_size)
+        northCell, eastCell = self._getCell(north, east, self.box_cell_size)
+        numLonCells = int(math.ceil(360.0 / self.box_cell_size))
+        if eastCell < westCell:
+            eastCell += numLonCells
+
+        for latCell in range(southCell, northCell + 1):
+            for lonCell in range(westCell, eastCell + 1):
+                self.boxes_by_cell.setdefault((latCell, lonCell % numLonCells), []).append(item)
+
+        return True
+
+    def findNearestPoint(self, coordinate, maxDistanceKm, acceptableTypes=None):
+        """ @return (latitude, longitude, place type, cache ID tuple, place data) of nearest place of an
+                    acceptable type no further than maxDistanceKm from coordinate, None if there isn't one. """
+        latitude, longitude = coordinate
+
+        latRange = maxDistanceKm / KM_PER_DEGREE
+        lonRange = latRange / max(math.cos(math.radians(min(abs(latitude) + latRange, 90.0))), 0.01)
+        lonRange = min(lonRange, 180.0)
+
+        southCell, westCell = self._getCell(latitude - latRange, longitude - lonRange, self.point_cell_size)
+        northCell, eastCell = self._getCell(latitude + latRange, longitude + lonRange, self.point_cell_size)
+        numLonCells = int(math.ceil(360.0 / self.point_cell_size))
+        if eastCell < westCell:
+            eastCell += numLonCells
+        eastCell = min(eastCell, westCell + numLonCells - 1)
+
+        nearest = None
+        nearestDistance = maxDistanceKm
+        for latCell in range(southCell, northCell + 1):
+            for lonCell in range(westCell, eastCell + 1):
+                points = self.points_by_cell.get((latCell, lonCell % numLonCells), None)
+                if points is None:
+                    continue
+
+                for point in points:
+                    if acceptableTypes is not None and point[2] not in acceptableTypes:
+                        continue
+
+                    distance = getDistanceKm(coordinate, (point[0], point[1]))
+                    if distance <= nearestDistance:
+                        nearest = point
+                        nearestDistance = distance
+
+        return nearest
+
+    def findContainingBox(self, coordinate, acceptableTypes=None):
+        """ Boxes overlap, and some include distant islands, so of the boxes containing
+            coordinate the one with the nearest centre is chosen.
+            @return geocode result of an acceptable type whose bounding box contains coordinate,
+                    None if there isn't one. """
+        latitude, longitude = coordinate
+
+        nearest = None
+        nearestDistance = None
+        for south, north, west, east, centre, result in self.boxes_by_cell.get(self._getCell(latitude, longitude, self.box_cell_size), []):
+            if acceptableTypes is not None and result.place_type not in acceptableTypes:
+                continue
+
+            # Boxes crossing the antimeridian have west > east.
+            if west <= east:
+                isLongitudeInBox = west <= longitude <= east
+            else:
+                isLongitudeInBox = longitude >= west or longitude <= east
+
+            if south <= latitude <= north and isLongitudeInBox:
+                distance = getDistanceKm(coordinate, centre)
+                if nearest is None or distance < nearestDistance:
+                    nearest = result
+                    nearestDistance = distance
+
+        return nearest
+
+    def addGnsData(self):
+        """ Adds GNS country and continent bounding boxes. """
+        if not GeocodeResultAbstract.isGnsDataInitialized:
+            GeocodeResultAbstract.initializeCountryContinentDataFromCsv()
+
+        for result in GeocodeResultAbstract.gnsAllByPlaceId.itervalues():
+            self.addBox(result)
+
+spatialIndex = SpatialIndex()
+
+
+class testSpatialIndex(unittest.TestCase):
+    def testFindNearest(self):
+        index = SpatialIndex()
+        city = GeocodeResultAbstract.PlaceTypes.CITY
+        borough = GeocodeResultAbstract.PlaceTypes.BOROUGH
+
+        index.addPoint((51.507, -0.128), city, (2, 1))
+        index.addPoint((51.513, -0.136), borough, (2, 2))
+        index.addPoint((53.801, -1.549), city, (2, 3))
+        index.addPoint((-16.5, 179.9), city, (2, 4))
+        assert not index.addPoint((51.507, -0.128), city, (2, 1))
+        assert index.num_points == 4
+
+        assert index.findNearestPoint((51.514, -0.137), 25)[3] == (2, 2)
+        assert index.findNearestPoint((51.514, -0.137), 25, [city])[3] == (2, 1)
+        assert index.findNearestPoint((52.5, -1.0), 25) is None
+        assert index.findNearestPoint((-16.5, -179.9), 25)[3] == (2, 4)
+
+        assert 160 < getDistanceKm((51.507, -0.128), (53.801, -1.549)) < 290
+
+        index.addGnsData()
+        assert index.findContainingBox((48.85, 2.35)) is not None
+        assert index.findContainingBox((48.85, 2.35), [GeocodeResultAbstract.PlaceTypes.COUNTRY]).iso_code == 'fr'
+        assert index.findContainingBox((48.85, 2.35), [GeocodeResultAbstract.PlaceTypes.CONTINENT]).display_name == 'Europe'
+
+        # Kiribati's box crosses the antimeridian.
+        assert index.findContainingBox((1.0, 179.8), [GeocodeResultAbstract.PlaceTypes.COUNTRY]).display_name == 'Kiribati'
+        assert index.findContainingBox((1.0, -175.0), [GeocodeResultAbstract.PlaceTypes.COUNTRY]).display_name == 'Kiribati'
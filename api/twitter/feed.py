@@ -4,13 +4,14 @@ import logging
 import json
 import math
 import requests
+import unittest
 from requests_oauthlib import OAuth1
 from api.config import Configuration
 from api.core.data_structures.tree import Tree
 from api.core.data_structures.timestamp import Timestamped
 from api.geocode.geocode_shared import GeocodeResultAbstract, GeocodeResultFailed
-from api.geocode.geocode_cached import geocodeFromCache, geocodeFromExternalAndWriteToCache, geocodeFromCacheById
-from ..core.utility import reverse_list, splitList, Timer, getMidPointBox, getEpochMs, getUniqueId
+from api.geocode.geocode_cached import geocodeFromCache, geocodeFromExternalAndWriteToCache, geocodeFromCacheById, reverseGeocodeFromCache
+from ..core.utility import reverse_list, splitList, Timer, getMidPointBox, getEpochMs, getUniqueId, prepareLowerAlpha
 
 __author__ = 'Michael Pryor'
 
@@ -975,6 +976,18 @@ class User(Hashable, Timestamped):
     def has_twitter_place(self):
         return self.twitter_place is not None
 
+    @property
+    def geocode_query_key(self):
+        """ @return normalized text that geocoding of this user is based on,
+                    users with the same key make the same geocode queries. """
+        if self.has_twitter_place:
+            twitterPlace = self.twitter_place
+            twitterPlaceKey = (twitterPlace.country_code, prepareLowerAlpha(twitterPlace.full_name), prepareLowerAlpha(twitterPlace.short_name))
+        else:
+            twitterPlaceKey = None
+
+        return twitterPlaceKey, prepareLowerAlpha(self.location_text)
+
     @property
     def location_geocode(self):
         try:
@@ -1070,6 +1083,35 @@ class User(Hashable, Timestamped):
 
         return self.__doGeocode(geocodeConfig, geocodeFunc)
 
+    def geocodeLocationFromCoordinate(self, geocodeConfig, inMemoryOnly=None):
+        """ Geocodes to the nearest place to where the user tweeted from, if we know.
+            Unlike the other geocode methods, failure does not stop us trying them afterwards. """
+        assert isinstance(geocodeConfig, UserGeocodeConfig)
+
+        if self.is_geocoded:
+            return True
+
+        if self.has_current_location_coordinate:
+            geocodeExplain = 'Tweet coordinate'
+            coordinate = self.current_location_coordinate
+        elif self.has_twitter_place and (geocodeConfig.required_twitter_place_types is None or self.twitter_place.place_type in geocodeConfig.required_twitter_place_types):
+            geocodeExplain = 'Twitter place coordinate'
+            coordinate = self.twitter_place.coordinate
+        else:
+            return False
+
+        if coordinate is None or len(coordinate) < 2:
+            return False
+
+        # Both coordinates are in form: latitude,longitude.
+        result = reverseGeocodeFromCache((coordinate[0], coordinate[1]), geocodeConfig.acceptable_place_types, inMemoryOnly)
+        if result is None:
+            return False
+
+        self._locationGeocode = result
+        self._setGeocodeDescription(geocodeExplain, 'Spatial index', None)
+        return True
+
     def geocodeLocationFromExternal(self, geocodeConfig, retry=2):
         def geocodeFunc(geocodeExplain, providerId, acceptableTypes, geocodeBias, countryCode, geocodeText):
             result = geocodeFromExternalAndWriteToCache(geocodeText, providerId, countryCode=countryCode, acceptableTypes=acceptableTypes, biasCoord=geocodeBias, retry=retry)
@@ -1266,6 +1308,7 @@ class Tweet(Hashable, Timestamped):
 
     @property
     def coordinate(self):
+        """ @return [latitude, longitude], Twitter's GeoJSON order is reversed when the tweet is read. """
         return self.data.getFromTree(['coordinates', 'coordinates'])
 
     @property
@@ -1289,4 +1332,33 @@ class Tweet(Hashable, Timestamped):
 
     @property
     def has_twitter_place(self):
-        return self.twitter_place is not None
\ No newline at end of file
+        return self.twitter_place is not None
+
+
+class testUser(unittest.TestCase):
+    def testGeocodeLocationFromCoordinate(self):
+        from api.geocode import geocode_cached
+        from api.geocode.geocode_spatial import SpatialIndex
+
+        index = SpatialIndex()
+        index.addGnsData()
+
+        oldIndex = geocode_cached.spatialIndex
+        geocode_cached.spatialIndex = index
+        try:
+            geocodeConfig = UserGeocodeConfig(Configuration.GEOCODE_EXTERNAL_PROVIDER, [GeocodeResultAbstract.PlaceTypes.COUNTRY])
+
+            # As received from Twitter, GeoJSON is in form: longitude,latitude.
+            tweet = Tweet({'id' : 1,
+                           'coordinates' : {'type' : 'Point', 'coordinates' : [2.35, 48.85]},
+                           'user' : {'id' : 2, 'location' : None}}, None)
+            assert tweet.coordinate == [48.85, 2.35]
+            assert tweet.user.geocodeLocationFromCoordinate(geocodeConfig)
+            assert tweet.user.location_geocode.iso_code == 'fr'
+
+            # Read back from cache the coordinate is not reversed again.
+            tweet = Tweet(tweet.data, None, fromCache=True)
+            assert tweet.user.geocodeLocationFromCoordinate(geocodeConfig)
+            assert tweet.user.location_geocode.iso_code == 'fr'
+        finally:
+            geocode_cached.spatialIndex = oldIndex
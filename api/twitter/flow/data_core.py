@@ -2,11 +2,11 @@ import logging
 from threading import RLock
 import time
 from pymongo.errors import DuplicateKeyError
-from api.caching.tweet_user import writeTweetToCache, writeUserToCache, readUserFromCache, UserProjection
+from api.caching.tweet_user import writeTweetToCache, writeUserToCache, readUserFromCache, UserProjection, flushPendingWrites, userEnrichmentStateIndex
 from api.config import Configuration
 from api.core.data_structures.tree import TreeFunctioned
 from api.core.signals.events import   EventSignaler
-from api.core.threads_core import BaseThread
+from api.core.threads_core import BaseThread, PeriodicThread
 from api.core.utility import criticalSection, OrderedDictEx, EventFrequencyCounter
 from api.geocode.geocode_shared import GeocodeResultAbstract
 from api.twitter.feed import Tweet, User
@@ -189,6 +189,13 @@ class DataCollection(object):
         self.realtime_performance_thread = RealtimePerformanceThread(self.realtime_performance)
         self.realtime_performance_thread.start()
 
+        # Tweets and users are written to the database in batches, this makes sure
+        # that batches which don't fill up quickly are still written.
+        self.write_batch_flush_thread = PeriodicThread('WriteBatchFlushThread',
+                                                       Configuration.MONGO_WRITE_BATCH_MAX_AGE_MS,
+                                                       lambda: flushPendingWrites(True))
+        self.write_batch_flush_thread.start()
+
     def prune(self):
         self.tweets_by_location.prune()
 
@@ -250,6 +257,10 @@ class DataCollection(object):
     def isDeepUserObjectIn(self, sourceUser):
         assert isinstance(sourceUser, User)
 
+        result = userEnrichmentStateIndex.contains(sourceUser.instance_key, sourceUser.id)
+        if result is not None:
+            return result
+
         cachedUser = readUserFromCache(sourceUser.id, sourceUser.twitter_session, sourceUser.instance_key, False, UserProjection.FollowerEnrichmentFlags())
         if cachedUser is None:
             return False
@@ -0,0 +1,516 @@
+import logging
+import unittest
+from api.caching.caching_shared import WORKLOAD_EXPORT
+from api.caching.compact_storage import COMPRESSED_DATA_FIELD, expandDocument
+from api.caching.tweet_counts import readTweetCountFromCache
+from api.caching.tweet_user import FieldProjection, UserProjection, NoQueryProjection, FOLLOWERS_PAGE_SIZE, cursorItemsFromCache, cursorUsersFromCache, getTweetCollectionsInRange, processRawCursor, readUserDataByIdsFromCache, readUsersFromCache, readTweetsFromCache
+from api.config import Configuration
+from api.core.utility import Timer
+from api.geocode.geocode_cached import geocodeFromCacheById, prefetchPlaces
+from api.geocode.geocode_shared import GeocodeResultAbstract
+from api.twitter.feed import User, Tweet, Place, buildAnalyserFromName
+from api.twitter.flow.data_converter import appendCsvRow, getUserRepresentation, getTweetRepresentation
+
+__author__ = 'Michael Pryor'
+
+logger = logging.getLogger(__name__)
+
+# Bulk downloads write the same rows as getUserRepresentation and getTweetRepresentation,
+# but build them straight from cache documents instead of constructing User and Tweet objects.
+# Each output type has a list of columns chosen once per download, a column knows which
+# document fields it needs, so only those fields are read from the database.
+
+class ExportColumn(object):
+    def __init__(self, fields, extractFunc):
+        super(ExportColumn,self).__init__()
+
+        # Document fields needed by extractFunc.
+        self.fields = fields
+
+        # Takes document and _ExportRow, returns cell.
+        self.extract = extractFunc
+
+class _ExportRow(object):
+    """ Data needed by columns which is not in the document itself. """
+    def __init__(self, geocodeCells=None, followerIds=None, followeeIds=None, userData=None):
+        super(_ExportRow,self).__init__()
+
+        # None if not geocoded.
+        self.geocode_cells = geocodeCells
+
+        # None if followers were not read.
+        self.follower_ids = followerIds
+
+        # None to use all followees stored in the document.
+        self.followee_ids = followeeIds
+
+        # Document of user who wrote tweet, None if not in the database.
+        self.user_data = userData
+
+def _getData(data):
+    data = data.get('data',None)
+    if data is None:
+        return dict()
+
+    return data
+
+def _joinIds(ids):
+    return ','.join(str(n) for n in ids)
+
+def _buildGeocodeKey(cacheId):
+    if isinstance(cacheId, list):
+        return tuple([GeocodeResultAbstract.buildTupleFromCacheId(x) for x in cacheId])
+    else:
+        return GeocodeResultAbstract.buildTupleFromCacheId(cacheId)
+
+def _buildGeocodeCells(geocode):
+    assert isinstance(geocode, GeocodeResultAbstract)
+
+    cells = [unicode(geocode.cache_id), unicode(geocode.display_name)]
+
+    if geocode.has_country:
+        cells += [unicode(geocode.country.cache_id), unicode(geocode.country.display_name)]
+    else:
+        cells += [Configuration.CSV_EMPTY_VAL, Configuration.CSV_EMPTY_VAL]
+
+    if geocode.has_continent:
+        cells += [unicode(geocode.continent.cache_id), unicode(geocode.continent.display_name)]
+    else:
+        cells += [Configuration.CSV_EMPTY_VAL, Configuration.CSV_EMPTY_VAL]
+
+    return cells
+
+def _extractId(data, row):
+    return _getData(data).get('id',None)
+
+def _extractTimestamp(data, row):
+    return data.get('timestamp',None)
+
+def _extractJson(data, row):
+    # Objects hold a copy of the document, which can iterate in a different order.
+    return unicode(dict(_getData(data)))
+
+def _extractIsGeocoded(data, row):
+    return row.geocode_cells is not None
+
+def _extractUserLocation(data, row):
+    location = _getData(data).get('location',None)
+    if location is None or len(location) == 0:
+        return Configuration.CSV_EMPTY_VAL
+
+    return location
+
+def _extractTwitterPlace(data, row):
+    twitterPlace = data.get('twitter_place',None)
+    if twitterPlace is None:
+        return Configuration.CSV_EMPTY_VAL
+
+    return dict(twitterPlace)
+
+def _buildGeocodeCellExtractor(index):
+    def extractFunc(data, row):
+        if row.geocode_cells is None:
+            return Configuration.CSV_EMPTY_VAL
+
+        return row.geocode_cells[index]
+
+    return extractFunc
+
+def _extractGeocodeBias(data, row):
+    # User.FromCache sets the bias before the twitter place, so the stored bias is always used.
+    return data.get('geocode_bias',None)
+
+def _extractFollowerIds(data, row):
+    if row.follower_ids is None:
+        return ''
+
+    return _joinIds(row.follower_ids)
+
+def _extractFolloweeIds(data, row):
+    followeeIds = row.followee_ids
+    if followeeIds is None:
+        followeeIds = data.get('known_followees',None)
+        if followeeIds is None:
+            return ''
+
+    uniqueIds = []
+    seen = set()
+    for followeeId in followeeIds:
+        if followeeId not in seen:
+            seen.add(followeeId)
+            uniqueIds.append(followeeId)
+
+    return _joinIds(uniqueIds)
+
+def _extractUserAnalysis(data, row):
+    analysers = dict()
+
+    analysis = data.get('analysis',None)
+    if analysis is not None:
+        for analysisSub in analysis:
+            for analysisName, analysisData in analysisSub.iteritems():
+                analyser = buildAnalyserFromName(analysisName)
+                analyser.from_cache(analysisData)
+                analysers[analyser.analysis_name] = analyser
+
+    return appendCsvRow('', [unicode(analyser.results_viewable) for analyser in analysers.itervalues()])
+
+def _extractTweetUserId(data, row):
+    if row.user_data is None:
+        return Configuration.CSV_EMPTY_VAL
+
+    return _getData(row.user_data).get('id',None)
+
+# Same order as getUserHeader.
+USER_COLUMNS = [ExportColumn(['data'], _extractId),
+                ExportColumn(['timestamp'], _extractTimestamp),
+                ExportColumn(['data', COMPRESSED_DATA_FIELD], _extractJson),
+                ExportColumn(['geocode'], _extractIsGeocoded),
+                ExportColumn(['data'], _extractUserLocation),
+                ExportColumn(['twitter_place'], _extractTwitterPlace)] + \
+               [ExportColumn(['geocode'], _buildGeocodeCellExtractor(n)) for n in range(6)] + \
+               [ExportColumn(['geocode_bias'], _extractGeocodeBias)]
+
+USER_FOLLOWER_COLUMNS = {1 : [],
+                         2 : [ExportColumn([], _extractFollowerIds),
+                              ExportColumn(['known_followees'], _extractFolloweeIds),
+                              ExportColumn(['analysis'], _extractUserAnalysis)],
+                         3 : [ExportColumn(['analysis'], _extractUserAnalysis)]}
+
+# Same order as getTweetHeader.
+TWEET_COLUMNS = [ExportColumn(['data'], _extractId),
+                 ExportColumn(['timestamp'], _extractTimestamp),
+                 ExportColumn([], _extractTweetUserId),
+                 ExportColumn(['data', COMPRESSED_DATA_FIELD], _extractJson)]
+
+def _buildProjection(columns):
+    fields = set()
+    for column in columns:
+        fields.update(column.fields)
+
+    return FieldProjection(fields)
+
+
+class TweetRowBuilder(object):
+    def __init__(self):
+        super(TweetRowBuilder,self).__init__()
+
+        self.extractors = [column.extract for column in TWEET_COLUMNS]
+        self.projection = _buildProjection(TWEET_COLUMNS)
+
+    def buildRow(self, data, userData):
+        expandDocument(data)
+
+        row = _ExportRow(userData=userData)
+        return appendCsvRow('', [extract(data, row) for extract in self.extractors])
+
+
+class UserRowBuilder(object):
+    def __init__(self, outputType):
+        super(UserRowBuilder,self).__init__()
+
+        if outputType not in USER_FOLLOWER_COLUMNS:
+            logger.error('Invalid output type while building user row builder: %s' % outputType)
+            raise NotImplementedError()
+
+        columns = USER_COLUMNS + USER_FOLLOWER_COLUMNS[outputType]
+
+        self.output_type = outputType
+        self.extractors = [column.extract for column in columns]
+        self.projection = _buildProjection(columns)
+
+        # Many users share a location, so geocode cells are only built once
+        # per geocode cache ID. None if the location could not be found.
+        self.geocode_cells = dict()
+
+    def _loadGeocodeCells(self, cacheId, prefetchedPlaces=None):
+        geocode = geocodeFromCacheById(cacheId, prefetchedPlaces=prefetchedPlaces)
+        if geocode is None:
+            cells = None
+        else:
+            cells = _buildGeocodeCells(geocode)
+
+        self.geocode_cells[_buildGeocodeKey(cacheId)] = cells
+        return cells
+
+    def prefetch(self, dataList):
+        """ Loads geocodes of a batch of documents, reading places with one query. """
+        cacheIds = []
+        for data in dataList:
+            cacheId = data.get('geocode',None)
+            if cacheId is not None and _buildGeocodeKey(cacheId) not in self.geocode_cells:
+                cacheIds.append(cacheId)
+
+        if len(cacheIds) == 0:
+            return
+
+        places = prefetchPlaces(cacheIds)
+        for cacheId in cacheIds:
+            self._loadGeocodeCells(cacheId, places)
+
+    def _getGeocodeCells(self, data):
+        cacheId = data.get('geocode',None)
+        if cacheId is None:
+            return None
+
+        key = _buildGeocodeKey(cacheId)
+        if key in self.geocode_cells:
+            return self.geocode_cells[key]
+
+        return self._loadGeocodeCells(cacheId)
+
+    def buildRow(self, data, followerIds=None, followeeIds=None):
+        """ @param followerIds IDs of followers read with the user, None if they were not read.
+            @param followeeIds IDs of followees found in the database, None to use all followees in data. """
+        expandDocument(data)
+
+        row = _ExportRow(self._getGeocodeCells(data), followerIds, followeeIds)
+        return appendCsvRow('', [extract(data, row) for extract in self.extractors])
+
+
+def exportUsersFromCache(instanceId, outputType, onRowFunc, placeId=None, epochMsStartRange=None, epochMsEndRange=None, isFollowersLoadedRequirement=None, associatedWithTweetRequirement=None):
+    """ Writes the same rows as readUsersFromCache followed by getUserRepresentation, including
+        rows of followers if the output type contains follower IDs.
+        @param onRowFunc called with iteration, total, isFinished, user row and tweet row (always None),
+                         rows can be None, returns false to stop. """
+    builder = UserRowBuilder(outputType)
+
+    # The follower IDs column needs each user's followers,
+    # they are exported too, recursion does not go further.
+    includeFollowers = outputType == 2
+
+    existingFolloweeIds = set()
+
+    def onBatch(dataList):
+        builder.prefetch(dataList)
+
+        if includeFollowers:
+            followeeIds = set()
+            for data in dataList:
+                followeeIds.update(data.get('known_followees',None) or [])
+
+            existingFolloweeIds.clear()
+            existingFolloweeIds.update(readUserDataByIdsFromCache(instanceId, followeeIds, FieldProjection([]), WORKLOAD_EXPORT))
+
+    def readFollowers(userId):
+        cursor = cursorUsersFromCache(instanceId, pageNum=0, pageSize=FOLLOWERS_PAGE_SIZE, followeeOfRequirement=userId, userProjection=builder.projection, sortByTimestamp=False, workload=WORKLOAD_EXPORT)
+        try:
+            followers = list(cursor)
+        finally:
+            cursor.close()
+
+        builder.prefetch(followers)
+        return followers
+
+    def onIteration(iteration, total, isFinished, data, iteratorId):
+        if data is None:
+            return onRowFunc(iteration, total, isFinished, None, None)
+
+        followerIds = None
+        followeeIds = None
+        if includeFollowers:
+            followeeIds = [x for x in data.get('known_followees',None) or [] if x in existingFolloweeIds]
+
+            followerIds = []
+            for follower in readFollowers(data['_id']):
+                followerIds.append(_getData(follower).get('id',None))
+
+                if not onRowFunc(iteration, total, False, builder.buildRow(follower), None):
+                    return False
+
+        return onRowFunc(iteration, total, isFinished, builder.buildRow(data, followerIds, followeeIds), None)
+
+    cursor = cursorUsersFromCache(instanceId,
+                                  placeId=placeId,
+                                  epochMsStartRange=epochMsStartRange,
+                                  epochMsEndRange=epochMsEndRange,
+                                  isFollowersLoadedRequirement=isFollowersLoadedRequirement,
+                                  associatedWithTweetRequirement=associatedWithTweetRequirement,
+                                  userProjection=builder.projection,
+                                  workload=WORKLOAD_EXPORT)
+
+    processRawCursor(cursor, onIteration, onBatch)
+
+def exportTweetsFromCache(instanceId, onRowFunc, placeId=None, epochMsStartRange=None, epochMsEndRange=None):
+    """ Writes the same rows as readTweetsFromCache followed by getTweetRepresentation,
+        and getUserRepresentation of each tweet's user with output type 1.
+        @param onRowFunc called with iteration, total, isFinished, user row and tweet row,
+                         rows can be None, returns false to stop. """
+    userBuilder = UserRowBuilder(1)
+    tweetBuilder = TweetRowBuilder()
+
+    # Users of current batch of tweets by user ID.
+    users = dict()
+
+    def getUserId(data):
+        user = _getData(data).get('user',None)
+        if user is None:
+            return None
+
+        return user.get('id',None)
+
+    def onBatch(dataList):
+        userIds = set()
+        for data in dataList:
+            userId = getUserId(data)
+            if userId is not None:
+                userIds.add(userId)
+
+        users.clear()
+        users.update(readUserDataByIdsFromCache(instanceId, userIds, userBuilder.projection, WORKLOAD_EXPORT))
+
+        userBuilder.prefetch(users.values())
+
+    def onIteration(iteration, total, isFinished, data, iteratorId):
+        if data is None:
+            return onRowFunc(iteration, total, isFinished, None, None)
+
+        userData = users.get(getUserId(data),None)
+        if userData is None:
+            userRow = None
+        else:
+            userRow = userBuilder.buildRow(userData)
+
+        return onRowFunc(iteration, total, isFinished, userRow, tweetBuilder.buildRow(data, userData))
+
+    # Progress is by number of tweets if they have been counted, otherwise by time.
+    numTweets = None
+    if Configuration.TWEET_COUNT_ROLLUP_ENABLED:
+        numTweets = readTweetCountFromCache(instanceId, placeId, epochMsStartRange, epochMsEndRange)
+        if numTweets == 0:
+            numTweets = None
+
+    cursor = cursorItemsFromCache(instanceId,
+                                  getTweetCollectionsInRange,
+                                  placeId,
+                                  epochMsStartRange,
+                                  epochMsEndRange,
+                                  projection=tweetBuilder.projection,
+                                  workload=WORKLOAD_EXPORT)
+
+    processRawCursor(cursor, onIteration, onBatch, numItems=numTweets)
+
+def exportFromCache(instanceId, outputType, onRowFunc, placeId=None, epochMsStartRange=None, epochMsEndRange=None):
+    """ Writes rows of bulk download with output type, 1 for tweets, 2 for users with follower and followee IDs,
+        3 for users without. """
+    if outputType == 1:
+        exportTweetsFromCache(instanceId, onRowFunc, placeId, epochMsStartRange, epochMsEndRange)
+    else:
+        exportUsersFromCache(instanceId, outputType, onRowFunc, placeId, epochMsStartRange, epochMsEndRange, isFollowersLoadedRequirement=True)
+
+
+def _exportFromCacheByObjects(instanceId, outputType, onRowFunc, placeId=None, epochMsStartRange=None, epochMsEndRange=None):
+    """ Writes the same rows as exportFromCache by constructing User and Tweet objects,
+        this is how bulk downloads used to work and is kept for comparison. """
+    if outputType == 3:
+        followerProjection = NoQueryProjection()
+    else:
+        followerProjection = None
+
+    includeFollowers = outputType != 1
+    userProjection = UserProjection(True, True, None, True,
+                                    includeFollowers, followerProjection, includeFollowers, UserProjection.Id(),
+                                    True, False, False, True, True, False, False, False, False,
+                                    includeFollowers)
+
+    def onCacheIteration(iteration, total, isFinished, data, iteratorId):
+        userRow = None
+        tweetRow = None
+        if isinstance(data, User) and iteratorId != 'followee':
+            userRow = getUserRepresentation(data, outputType)
+        elif isinstance(data, Tweet):
+            tweetRow = getTweetRepresentation(data)
+            if data.has_user:
+                userRow = getUserRepresentation(data.user, outputType)
+
+        return onRowFunc(iteration, total, isFinished, userRow, tweetRow)
+
+    if outputType == 1:
+        readTweetsFromCache(None, instanceId, placeId=placeId, epochMsStartRange=epochMsStartRange, epochMsEndRange=epochMsEndRange,
+                            onIterationFunc=onCacheIteration, retrieveUserData=True, userProjection=userProjection)
+    else:
+        readUsersFromCache(None, instanceId, placeId=placeId, epochMsStartRange=epochMsStartRange, epochMsEndRange=epochMsEndRange,
+                           isFollowersLoadedRequirement=True, onIterationFunc=onCacheIteration, recursive=True, userProjection=userProjection)
+
+def benchmarkExport(instanceId, outputType, epochMsStartRange=None, epochMsEndRange=None):
+    """ Exports from cache with and without constructing objects and compares time taken and rows.
+        Followee IDs are not compared in order, objects keep them in a set. With compact storage
+        objects only hold the stored fields, so JSON cells of the object path are incomplete.
+        @return dictionary of results. """
+    def runExport(exportFunc):
+        rows = []
+        def onRowFunc(iteration, total, isFinished, userRow, tweetRow):
+            if userRow is not None:
+                rows.append(userRow)
+
+            if tweetRow is not None:
+                rows.append(tweetRow)
+
+            return True
+
+        timer = Timer()
+        exportFunc(instanceId, outputType, onRowFunc, epochMsStartRange=epochMsStartRange, epochMsEndRange=epochMsEndRange)
+        return rows, timer.time_since_constructed
+
+    objectRows, objectTime = runExport(_exportFromCacheByObjects)
+    rawRows, rawTime = runExport(exportFromCache)
+
+    def normalise(row):
+        return sorted(row.split(','))
+
+    numDifferent = 0
+    if len(objectRows) == len(rawRows):
+        for objectRow, rawRow in zip(objectRows, rawRows):
+            if objectRow != rawRow and normalise(objectRow) != normalise(rawRow):
+                numDifferent += 1
+    else:
+        numDifferent = abs(len(objectRows) - len(rawRows))
+
+    results = {'output_type' : outputType,
+               'num_rows' : len(rawRows),
+               'num_bytes' : sum([len(row) for row in rawRows]),
+               'object_time_ms' : objectTime,
+               'raw_time_ms' : rawTime,
+               'num_rows_different' : numDifferent}
+
+    logger.info('Export benchmark of instance %s: %s' % (instanceId, results))
+    return results
+
+
+class testDataExport(unittest.TestCase):
+    def testUserRow(self):
+        placeData = {'id' : 'abc',
+                     'full_name' : 'London, UK',
+                     'bounding_box' : {'coordinates' : [[[-0.5, 51.2], [0.3, 51.2], [0.3, 51.7], [-0.5, 51.7]]]}}
+
+        data = {'_id' : 5,
+                'timestamp' : 1000,
+                'data' : {'id' : 5, 'location' : u'London "town"', 'name' : 'bob'},
+                'twitter_place' : placeData,
+                'geocode_bias' : [1.0, 2.0],
+                'known_followees' : [3, 4, 3]}
+
+        user = User.FromCache(data['data'], None, 1000, None, None, [1.0, 2.0], None, None, None, None,
+                              set([User.Id(3, None)]), Place.FromCache(placeData), None)
+
+        for outputType in (1, 2, 3):
+            builder = UserRowBuilder(outputType)
+            if outputType == 2:
+                row = builder.buildRow(data, [], [3])
+            else:
+                row = builder.buildRow(data)
+
+            assert row == getUserRepresentation(user, outputType)
+
+        assert 'known_followees' in UserRowBuilder(2).projection.projection
+        assert 'known_followees' not in UserRowBuilder(1).projection.projection
+
+    def testTweetRow(self):
+        userData = {'_id' : 5, 'timestamp' : 900, 'data' : {'id' : 5}}
+        data = {'timestamp' : 1000, 'data' : {'id' : 7, 'text' : 'hello, world', 'user' : {'id' : 5}}}
+
+        tweet = Tweet.FromCache(data['data'], None, 1000, None)
+        assert TweetRowBuilder().buildRow(data, userData) == getTweetRepresentation(tweet)
+
+        tweet.user = None
+        assert TweetRowBuilder().buildRow(data, None) == getTweetRepresentation(tweet)
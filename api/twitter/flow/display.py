@@ -2,10 +2,11 @@ import logging
 from math import ceil
 from bottle import template, redirect, request, abort
 from api.caching.temporal_analytics import getTemporalRange, getTemporalInfluenceCollection, getTimeIdFromTimestamp
-from api.caching.tweet_user import readTweetsFromCache, readUsersFromCache, UserProjection, UserDataProjection
+from api.caching.tweet_counts import readTweetCountFromCache, readTweetCountHistogramFromCache
+from api.caching.tweet_user import readTweetsFromCache, readUsersFromCache, UserProjection, UserDataProjection, CursorPosition
 from api.config import Configuration
 from api.core.threads import  FollowerExtractorGateThread
-from api.core.utility import parseInteger, parseString, getDateTime, getEpochMs, splitList
+from api.core.utility import parseInteger, parseString, getDateTime, getEpochMs, splitList, OrderedDictEx, Timer
 from api.geocode.geocode_cached import geocodeFromCacheById, geocodeSearch
 from api.geocode.geocode_shared import GeocodeResultAbstract
 from api.twitter.feed import User, Tweet
@@ -193,7 +194,7 @@ class TwitterCachePage(Display):
     @property
     def page_html_function(self):
         def func(templateArguments, instance):
-            dataType = parseString(request.GET.type,['tweet','user'])
+            dataType = parseString(request.GET.type,['tweet','user','tweet_count','tweet_histogram'])
             start_epoch = parseInteger(request.GET.start_epoch)
             end_epoch = parseInteger(request.GET.end_epoch)
             page_num = parseInteger(request.GET.page)
@@ -201,6 +202,11 @@ class TwitterCachePage(Display):
             provider_id = parseInteger(request.GET.provider_id)
             projection_type = parseString(request.GET.projection_type)
             followee = parseInteger(request.GET.followee)
+            bucket_ms = parseInteger(request.GET.bucket_ms)
+
+            # If specified the page after this position is returned along with the position
+            # of the next page, this is faster than page numbers when reading deep into the cache.
+            continue_from = parseString(request.GET.continue_from)
 
             cache_id = GeocodeResultAbstract.buildCacheId(provider_id, place_id)
 
@@ -210,9 +216,23 @@ class TwitterCachePage(Display):
             if page_num is None:
                 page_num = 0
 
+            if continue_from is not None:
+                position = CursorPosition.fromToken(continue_from)
+                if position is None:
+                    return redirect_problem('Invalid continue_from: %s' % continue_from)
+            else:
+                position = None
+
+            # Counts are read from tweet count rollups, not by counting tweets.
+            if dataType == 'tweet_count':
+                return {'json' : readTweetCountFromCache(instance, cache_id, start_epoch, end_epoch)}
+
+            if dataType == 'tweet_histogram':
+                return {'json' : readTweetCountHistogramFromCache(instance, cache_id, start_epoch, end_epoch, bucket_ms)}
+
             data = []
             if dataType == 'tweet':
-                tweets = readTweetsFromCache(None, instance, cache_id, start_epoch, end_epoch, page_num, TwitterCachePage.PAGE_SIZE_FULL_DATA)
+                tweets = readTweetsFromCache(None, instance, cache_id, start_epoch, end_epoch, page_num, TwitterCachePage.PAGE_SIZE_FULL_DATA, position=position)
                 if tweets is not None:
                     for tweet in tweets:
                         assert isinstance(tweet, Tweet)
@@ -236,7 +256,7 @@ class TwitterCachePage(Display):
                 if followee is None:
                     return redirect_problem('Followee is required')
 
-                users = readUsersFromCache(None, instance, cache_id, start_epoch, end_epoch, page_num, pageSize, followee, userProjection=projection)
+                users = readUsersFromCache(None, instance, cache_id, start_epoch, end_epoch, page_num, pageSize, followee, userProjection=projection, position=position)
                 if users is not None:
                     for user in users:
                         assert isinstance(user, User)
@@ -245,6 +265,9 @@ class TwitterCachePage(Display):
                                      user.profile_image_url,
                                      UserInformationPage.link_info.getPageLink(instance, user.id)])
 
+            if position is not None:
+                return {'json' : data, 'next' : position.token}
+
             return {'json' : data}
         return func
 
@@ -259,13 +282,24 @@ class InfluenceCachePage(Display):
                          webSocketManagers=None,
                          onDisplayUsageFunc=onDisplayUsageFunc)
 
+        # Data of time ranges which have finished never changes, so we keep results here.
+        # (instance key, instance construction time, source provider ID, source place ID, start time ID, end time ID) -> result.
+        # Construction time is part of the key because a restarted instance keeps its key but starts its time IDs again.
+        self.result_cache = OrderedDictEx(True, Configuration.INFLUENCE_RESULT_CACHE_SIZE, True)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.log_cache_timer = Timer(Configuration.LOG_DROP_AMOUNT_FREQ_MS, False)
+
+    def isTimeIdClosed(self, twitterInstance, timeId):
+        """ @return true if no more data can be written with this time ID or earlier. """
+        # Influence data can wait in memory for a little while before being written.
+        writeDelay = Configuration.TEMPORAL_AGGREGATOR_FLUSH_MS * 2
+        openTimeId = getTimeIdFromTimestamp(twitterInstance.constructed_at, Configuration.TEMPORAL_STEP, getEpochMs() - writeDelay)
+        return timeId < openTimeId
+
     @property
     def page_html_function(self):
-        def func(templateArguments, instance):
-            twitterInstance = self.application.twitter_instances.getInstanceByInstanceKey(instance)
-            if twitterInstance is None:
-                return dict()
-
+        def getResultData(twitterInstance, instance):
             baseEpoch = twitterInstance.constructed_at
 
             start_epoch = parseInteger(request.GET.start_epoch, default=None)
@@ -279,8 +313,6 @@ class InfluenceCachePage(Display):
 
             source_cache_id = GeocodeResultAbstract.buildCacheId(source_provider_id, source_place_id)
 
-            temporalCollection = getTemporalInfluenceCollection(instance)
-
             if start_epoch is not None:
                 start_time_id = getTimeIdFromTimestamp(baseEpoch, Configuration.TEMPORAL_STEP, start_epoch)
             else:
@@ -291,6 +323,21 @@ class InfluenceCachePage(Display):
             else:
                 end_time_id = None
 
+            if start_time_id is not None and end_time_id is not None and self.isTimeIdClosed(twitterInstance, end_time_id):
+                cacheKey = (instance, baseEpoch, source_provider_id, source_place_id, start_time_id, end_time_id)
+            else:
+                cacheKey = None
+
+            if cacheKey is not None:
+                result = self.result_cache.get(cacheKey)
+                if result is not None:
+                    self.cache_hits += 1
+                    return result
+
+            self.cache_misses += 1
+
+            temporalCollection = getTemporalInfluenceCollection(instance)
+
             timerMs = getEpochMs()
             cacheData = getTemporalRange(temporalCollection, start_time_id, end_time_id, source_cache_id, preciseFromBack=True, preciseFromFront=True)
             logger.info('Took %dms to read temporal range data' % (getEpochMs() - timerMs))
@@ -345,7 +392,23 @@ class InfluenceCachePage(Display):
 
             logger.info('Took %dms to build temporal range result data' % (getEpochMs() - timerMs))
 
-            return {'json' : resultData}
+            result = {'json' : resultData}
+            if cacheKey is not None:
+                self.result_cache[cacheKey] = result
+
+            return result
+
+        def func(templateArguments, instance):
+            twitterInstance = self.application.twitter_instances.getInstanceByInstanceKey(instance)
+            if twitterInstance is None:
+                return dict()
+
+            resultData = getResultData(twitterInstance, instance)
+
+            if self.log_cache_timer.ticked():
+                logger.info('Influence result cache: %d hits, %d misses, %d cached' % (self.cache_hits, self.cache_misses, len(self.result_cache)))
+
+            return resultData
         return func
 
 
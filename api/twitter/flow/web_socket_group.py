@@ -3,12 +3,13 @@ import json
 import logging
 from bottle import request
 import gevent
-from api.caching.tweet_user import UserProjection, readUsersFromCache, readTweetsFromCache, NoQueryProjection
+from api.caching.tweet_user import UserProjection
 from api.core.signals.events import EventSignaler
 from api.core.utility import Timer, parseInteger, parseBoolean, getPercentage, getEpochMs, parseString
 from api.geocode.geocode_shared import GeocodeResultAbstract, GeocodeResultGNS
 from api.twitter.feed import User, Tweet, UserFollowerEnrichmentProgress, Place, UserAnalysisFollowersGeocoded
-from api.twitter.flow.data_converter import getUserRepresentation, getUserHeader, getTweetHeader, getTweetRepresentation
+from api.twitter.flow.data_converter import getUserHeader, getTweetHeader
+from api.twitter.flow.data_export import exportFromCache
 from api.twitter.flow.data_core import DataCollection, RealtimePerformance
 from api.twitter.flow.display import UserInformationPage, UserFollowerEnrichPage, LocationsPage
 from api.twitter.flow.display_core import Display
@@ -658,61 +659,20 @@ class BulkDownloadDataWsg(WebSocketManagerDataProvider):
             return False
 
         if tweetInfo:
-            followerIdsFlag = False
-            followeeIdsFlag = False
-            analysisFlag = False
-            isFollowersLoadedRequirement = None
-            associatedWithTweetRequirement = True
-            recursiveCacheFlag = False
-            followerIdsProjection = None
             outputType = 1 # for csv.
         elif followerInfo:
-            followerIdsFlag = True
-            followeeIdsFlag = True
-            analysisFlag = True
-            isFollowersLoadedRequirement = True
-            associatedWithTweetRequirement = None
-            recursiveCacheFlag = True
-            followerIdsProjection = None # this gives us all data on each follower.
             outputType = 2
         elif followerInfoShort:
-            followerIdsFlag = True
-            followeeIdsFlag = True
-            followerIdsProjection = NoQueryProjection()
-            analysisFlag = True
-            isFollowersLoadedRequirement = True
-            associatedWithTweetRequirement = None
-            recursiveCacheFlag = True
             outputType = 3
         else:
             raise NotImplementedError()
 
-        userProjection = UserProjection(True,
-                                        True,
-                                        None,
-                                        True,
-                                        followerIdsFlag,
-                                        followerIdsProjection,
-                                        followeeIdsFlag,
-                                        UserProjection.Id(),
-                                        True,
-                                        False,
-                                        False,
-                                        True,
-                                        True,
-                                        False,
-                                        False,
-                                        False,
-                                        False,
-                                        analysisFlag)
-
         isFirstIteration = [True]
 
         twitterInstance = self.application.twitter_instances.getInstanceByInstanceKey(instanceId)
         if twitterInstance is None:
             return False
 
-        twitterSession = twitterInstance.twitter_thread.twitter_session
         progressBarTotalId = 'progress-bar-total'
         progressBarCurrentBatchId = 'progress-bar-current-batch'
 
@@ -742,8 +702,8 @@ class BulkDownloadDataWsg(WebSocketManagerDataProvider):
                          bytesPerBatch=bytesPerBatch,
                          previousCounter=previousCounter,
                          isFirstIteration=isFirstIteration):
-            user = data['user_data']
-            tweet = data['tweet_data']
+            userRow = data['user_row']
+            tweetRow = data['tweet_row']
             percentage = data['percentage']
             isFinished = data['isFinished']
 
@@ -768,19 +728,13 @@ class BulkDownloadDataWsg(WebSocketManagerDataProvider):
             if previousCounter[0] != bytesCounter[0] and updateProgressBarFreq.ticked():
                 updateProgressBars()
 
-            dataToSendToClient = ''
-            if user is not None:
-                assert isinstance(user,User)
-                dataToSendToClient = getUserRepresentation(user, outputType)
-                sendData(userTunnelId, dataToSendToClient)
-
-            if tweet is not None:
-                assert isinstance(tweet, Tweet)
-                dataToSendToClient = getTweetRepresentation(tweet)
-                sendData(tweetTunnelId, dataToSendToClient)
+            if userRow is not None:
+                sendData(userTunnelId, userRow)
+                bytesCounter[0] += len(userRow)
 
-            dataLength = len(dataToSendToClient)
-            bytesCounter[0] += dataLength
+            if tweetRow is not None:
+                sendData(tweetTunnelId, tweetRow)
+                bytesCounter[0] += len(tweetRow)
 
             if bytesCounter[0] > bytesPerBatch or isFinished:
                 updateProgressBars()
@@ -804,37 +758,15 @@ class BulkDownloadDataWsg(WebSocketManagerDataProvider):
 
                     webSocket.cleanup()
 
-        def onCacheIteration(iteration, total, isFinished, data, iteratorId):
-            # Don't write followee data to output as it would duplicate alot of data.
-            if iteratorId == 'followee':
-                data = None
-
+        def onExportRow(iteration, total, isFinished, userRow, tweetRow):
             running = not webSocket.is_cleaned_up
             if running:
                 # We need to do this so that if the client closes the socket we are notified.
                 webSocket.pingFreqLimited()
 
                 percentage = getPercentage(iteration, total)
-                dataId = None
-                if data is not None:
-                    dataId = data.id
-                #logger.info('iteration %.2f of %.2f (%.1f%%) - it: %s, userId: %s' % (iteration, total, percentage,iteratorId,dataId))
-
-                user = None
-                tweet = None
-                if data is None:
-                    pass
-                elif isinstance(data, User):
-                    user = data
-                elif isinstance(data, Tweet):
-                    tweet = data
-                    if tweet.has_user:
-                        user = tweet.user
-                else:
-                    logger.error('Invalid data from cache, type: %s' % type(data))
-                    return running
 
-                signaler.signalEvent({SignalActions.SOCKET: updateSocket, 'percentage' : percentage, 'user_data' : user, 'tweet_data' : tweet, 'isFinished' : isFinished})
+                signaler.signalEvent({SignalActions.SOCKET: updateSocket, 'percentage' : percentage, 'user_row' : userRow, 'tweet_row' : tweetRow, 'isFinished' : isFinished})
                 gevent.sleep(0)
             else:
                 logger.debug('Ending cache download prematurely')
@@ -848,26 +780,13 @@ class BulkDownloadDataWsg(WebSocketManagerDataProvider):
         if endEpoch is None or endEpoch > epochNow:
             endEpoch = epochNow
 
-        if followerInfo or followerInfoShort:
-            readUsersFromCache(twitterSession,
-                               instanceId,
-                               placeId = placeCacheId,
-                               epochMsStartRange=startEpoch,
-                               epochMsEndRange=endEpoch,
-                               isFollowersLoadedRequirement=isFollowersLoadedRequirement,
-                               associatedWithTweetRequirement=associatedWithTweetRequirement,
-                               onIterationFunc=onCacheIteration,
-                               recursive=recursiveCacheFlag,
-                               userProjection=userProjection)
-        else:
-            readTweetsFromCache(twitterSession,
-                                instanceId,
-                                placeId = placeCacheId,
-                                epochMsStartRange=startEpoch,
-                                epochMsEndRange=endEpoch,
-                                onIterationFunc=onCacheIteration,
-                                retrieveUserData=True,
-                                userProjection=userProjection)
+        # Rows are built straight from cache documents, see data_export.
+        exportFromCache(instanceId,
+                        outputType,
+                        onExportRow,
+                        placeId=placeCacheId,
+                        epochMsStartRange=startEpoch,
+                        epochMsEndRange=endEpoch)
 
         # We want to cleanup everything now since we are done.
         return False
@@ -0,0 +1,326 @@
+import logging
+import os
+import time
+from multiprocessing import Process, cpu_count
+from threading import RLock
+from gevent.socket import wait_read
+from api.caching import caching_shared
+from api.config import Configuration
+from api.core.utility import Timer, createBlockingPipe
+from api.geocode.geocode_cached import geocodeFromCacheById, flushGeocodeQueryHits, openSharedGeocodeCache, takeSharedGeocodeCacheLoads, publishSharedGeocodeCacheLoads, \
+    clearGeocodeQueryKnownMissing, clearAllGeocodeQueryKnownMissing, startRecordingFoundGeocodeQueries, takeFoundGeocodeQueries, addPlaceToSpatialIndex
+from api.geocode.geocode_shared import buildGeocodeResult, isIntendedForDirectUse
+from api.twitter.feed import User, Place, UserGeocodeConfig
+
+__author__ = 'Michael Pryor'
+
+logger = logging.getLogger(__name__)
+
+# Geocoding from cache is CPU heavy (building and searching query keys) and
+# all our threads share one interpreter lock with the web server. In process
+# mode the work is done by child processes instead, threads hand them a compact
+# request describing the user and receive the geocode result back.
+#
+# Each process has its own in memory geocode cache, so requests are sharded by
+# the text being geocoded. This means the in memory only stage and database stage
+# send the same user to the same process, and the in memory stage sees what the
+# database stage loaded. If GEOCODE_SHARED_CACHE_ENABLED processes also read what the
+# parent process has geocoded or loaded from a cache shared in memory. Only the parent
+# writes to it, so processes send what they read from the database back with each
+# response for the parent to add.
+#
+# Queries which processes remember are not in the database are written by the parent
+# after geocoding externally, so the parent sends them to every process with its next
+# request, and processes forget they were missing.
+#
+# If REVERSE_GEOCODE_ENABLED processes also geocode from the tweet coordinate, using the
+# spatial index copied from the parent when forked. Places found externally after that are
+# only added to the parent's index, so processes add places as they read them from cache.
+
+def buildGeocodeRequest(user, inMemoryOnly):
+    """ @return small picklable dictionary containing only what geocoding needs,
+                or None if there is nothing to geocode. """
+    assert isinstance(user, User)
+
+    if user.has_twitter_place:
+        twitterPlace = user.twitter_place
+        place = {'full_name' : twitterPlace.full_name,
+                 'name' : twitterPlace.short_name,
+                 'country_code' : twitterPlace.country_code,
+                 'place_type' : twitterPlace.place_type,
+                 'bounding_box' : twitterPlace.data.getFromTree(['bounding_box'])}
+        shardKey = twitterPlace.full_name
+    else:
+        place = None
+        shardKey = user.location_text
+
+    if user.has_current_location_coordinate:
+        coordinate = tuple(user.current_location_coordinate)
+    else:
+        coordinate = None
+
+    if not user.has_location and place is None and coordinate is None:
+        return None
+
+    if shardKey is None:
+        shardKey = user.location_text
+
+    if shardKey is None:
+        shardKey = coordinate
+
+    return {'location' : user.location_text,
+            'place' : place,
+            'coordinate' : coordinate,
+            'bias' : user.geocode_bias,
+            'in_memory_only' : inMemoryOnly,
+            'shard_key' : unicode(shardKey).lower()}
+
+def _serializeGeocodeResult(result):
+    if isIntendedForDirectUse(result.provider_id):
+        return {'provider_id' : result.provider_id,
+                'data' : dict(result.geocodeData),
+                'importance_rating' : result.importance_rating}
+    else:
+        # GNS data is loaded from CSV in every process, so only the ID is needed.
+        return {'cache_id' : result.cache_id}
+
+def _deserializeGeocodeResult(data):
+    if 'cache_id' in data:
+        return geocodeFromCacheById(data['cache_id'])
+    else:
+        return buildGeocodeResult(data['data'], data['provider_id'], data['importance_rating'])
+
+def processGeocodeRequest(request, geocodeConfig):
+    """ Runs in child process.
+        @return response to send back to parent, None if geocode failed. """
+    if request['place'] is not None:
+        twitterPlace = Place(request['place'])
+    else:
+        twitterPlace = None
+
+    user = User({'location' : request['location']}, None, twitterPlace=twitterPlace, currentLocationCoordinate=request['coordinate'])
+    user.geocode_bias = request['bias']
+
+    if not Configuration.REVERSE_GEOCODE_ENABLED:
+        if not user.geocodeLocationFromCache(geocodeConfig, request['in_memory_only']):
+            return None
+    elif not user.geocodeLocationFromCoordinate(geocodeConfig, request['in_memory_only']):
+        if not user.geocodeLocationFromCache(geocodeConfig, request['in_memory_only']):
+            return None
+
+        addPlaceToSpatialIndex(user.location_geocode)
+
+    return {'geocoded_from' : user.geocoded_from,
+            'result' : _serializeGeocodeResult(user.location_geocode)}
+
+def applyGeocodeResponse(user, response):
+    """ Runs in parent process, updates user with geocode result.
+        @return true if user was geocoded. """
+    assert isinstance(user, User)
+
+    if response is not None:
+        locationGeocode = _deserializeGeocodeResult(response['result'])
+    else:
+        locationGeocode = None
+
+    user._locationGeocode = locationGeocode
+    if locationGeocode is not None:
+        user.geocoded_from = response['geocoded_from']
+        return True
+
+    return False
+
+def _geocodeProcessMain(connection, geocodeConfig, parentPid):
+    # Mongo connections cannot be shared with parent process.
+    caching_shared.resetConnections()
+
+    # The forked copy is the parent's, which writes to it.
+    if Configuration.GEOCODE_SHARED_CACHE_ENABLED:
+        openSharedGeocodeCache(False, parentPid)
+
+    # Query hits are counted by each process, and written when idle or exiting too.
+    hitsFlushTimer = Timer(Configuration.GEOCODE_QUERY_HITS_FLUSH_MS, False)
+    try:
+        _geocodeProcessLoop(connection, geocodeConfig, hitsFlushTimer)
+    finally:
+        flushGeocodeQueryHits()
+
+def _geocodeProcessLoop(connection, geocodeConfig, hitsFlushTimer):
+    while True:
+        if hitsFlushTimer.ticked():
+            flushGeocodeQueryHits()
+
+        try:
+            waitMs = max(Configuration.GEOCODE_QUERY_HITS_FLUSH_MS - hitsFlushTimer.time_since_last_tick, 0)
+            if not connection.poll(waitMs / 1000.0):
+                continue
+
+            request = connection.recv()
+        except EOFError:
+            # Parent process has gone away.
+            return
+
+        if request is None:
+            return
+
+        foundQueries = request['found_queries']
+        if foundQueries is None:
+            clearAllGeocodeQueryKnownMissing()
+        else:
+            for geocodeId, providerId in foundQueries:
+                clearGeocodeQueryKnownMissing(geocodeId, providerId)
+
+        try:
+            response = processGeocodeRequest(request, geocodeConfig)
+        except Exception as e:
+            logger.error('Exception in geocode process while geocoding %s: %s' % (request['shard_key'], e.message))
+            response = None
+
+        connection.send((response, takeSharedGeocodeCacheLoads()))
+
+
+# Most found queries sent to a process with one request.
+MAX_FOUND_QUERIES_PER_REQUEST = 1000
+
+class GeocodeProcess(object):
+    """ A child process which geocodes one request at a time. """
+
+    def __init__(self, geocodeConfig):
+        super(GeocodeProcess,self).__init__()
+
+        # Blocking, or a large message could be partly read or written.
+        parentConnection, childConnection = createBlockingPipe()
+
+        self.process = Process(target=_geocodeProcessMain, args=(childConnection, geocodeConfig, os.getpid()))
+        self.process.daemon = True
+        self.process.start()
+
+        childConnection.close()
+
+        self.connection = parentConnection
+        self.lock = RLock()
+        self.failed = False
+
+        # Queries written to the database which the process has not been told about yet,
+        # None if so many that it is told to forget every query it knows is missing.
+        self.found_queries = []
+
+    def addFoundQueries(self, foundQueries):
+        if self.found_queries is None:
+            return
+
+        self.found_queries += foundQueries
+        if len(self.found_queries) > Configuration.GEOCODE_QUERY_NEGATIVE_CACHE_SIZE:
+            self.found_queries = None
+
+    def geocode(self, request):
+        """ @return response from child process.
+            @raise EOFError or IOError if the child process has failed. """
+        self.lock.acquire()
+        try:
+            # Keeps requests small, the rest are sent with later requests.
+            if self.found_queries is None:
+                request['found_queries'] = None
+                self.found_queries = []
+            else:
+                request['found_queries'] = self.found_queries[:MAX_FOUND_QUERIES_PER_REQUEST]
+                self.found_queries = self.found_queries[MAX_FOUND_QUERIES_PER_REQUEST:]
+
+            self.connection.send(request)
+
+            # Yield to other greenlets while the child works.
+            wait_read(self.connection.fileno())
+            response, sharedCacheLoads = self.connection.recv()
+        except (EOFError, IOError):
+            self.failed = True
+            raise
+        finally:
+            self.lock.release()
+
+        publishSharedGeocodeCacheLoads(sharedCacheLoads)
+        return response
+
+    def stop(self):
+        # Not while another greenlet is part way through a request.
+        self.lock.acquire()
+        try:
+            self.connection.send(None)
+        except (EOFError, IOError):
+            pass
+        finally:
+            self.lock.release()
+
+    def join(self, timeoutSeconds):
+        self.process.join(timeoutSeconds)
+
+
+class GeocodeProcessPool(object):
+    """ Geocodes users from cache using child processes.
+
+        Must be created before any other threads are started, because child processes
+        are forked from this process and should not carry running threads with them. """
+
+    def __init__(self, geocodeConfig, numProcesses=None):
+        super(GeocodeProcessPool,self).__init__()
+
+        assert isinstance(geocodeConfig, UserGeocodeConfig)
+
+        if numProcesses is None or numProcesses < 1:
+            numProcesses = cpu_count()
+
+        logger.info('Starting %d geocode processes' % numProcesses)
+
+        self.geocode_config = geocodeConfig
+        self.processes = [GeocodeProcess(geocodeConfig) for n in range(numProcesses)]
+
+        startRecordingFoundGeocodeQueries()
+
+    def _sendFoundQueries(self):
+        foundQueries = takeFoundGeocodeQueries()
+        if len(foundQueries) == 0:
+            return
+
+        for process in self.processes:
+            if not process.failed:
+                process.addFoundQueries(foundQueries)
+
+    def _geocodeUserInThread(self, user, inMemoryOnly):
+        if Configuration.REVERSE_GEOCODE_ENABLED and user.geocodeLocationFromCoordinate(self.geocode_config, inMemoryOnly):
+            return True
+
+        return user.geocodeLocationFromCache(self.geocode_config, inMemoryOnly)
+
+    def geocodeUser(self, user, inMemoryOnly):
+        """ Equivalent to user.geocodeLocationFromCoordinate if REVERSE_GEOCODE_ENABLED
+            followed by user.geocodeLocationFromCache, but performed in a child process.
+            @return true if user was geocoded. """
+        request = buildGeocodeRequest(user, inMemoryOnly)
+        if request is None:
+            user._locationGeocode = None
+            return False
+
+        self._sendFoundQueries()
+
+        process = self.processes[hash(request['shard_key']) % len(self.processes)]
+
+        # Processes are not restarted, forking now would copy our running threads.
+        if process.failed:
+            return self._geocodeUserInThread(user, inMemoryOnly)
+
+        try:
+            response = process.geocode(request)
+        except (EOFError, IOError) as e:
+            logger.error('Geocode process has failed, geocoding in thread instead from now on: %s' % e)
+            return self._geocodeUserInThread(user, inMemoryOnly)
+
+        return applyGeocodeResponse(user, response)
+
+    def stop(self, timeoutSeconds=10):
+        """ Tells processes to exit and waits for them to do so, so that they can write
+            what they have not written yet. """
+        for process in self.processes:
+            process.stop()
+
+        endTime = time.time() + timeoutSeconds
+        for process in self.processes:
+            process.join(max(endTime - time.time(), 0))
@@ -19,12 +19,16 @@ function validateType(type) {
     return type;
 }
 
-function queryCache(type, instance, startEpoch, endEpoch, placeId, providerId, followee, page, onSuccess, onFail, onAlways, projection) {
+function queryCache(type, instance, startEpoch, endEpoch, placeId, providerId, followee, page, onSuccess, onFail, onAlways, projection, continueFrom) {
     type = validateType(type);
     projection = validateProjection(projection);
 
+    // Position returned with the previous page, more efficient than page number.
+    continueFrom = undefArg(continueFrom);
+
     var urlArgs =  {'type' : type,
                     'page' : page,
+                    'continue_from' : continueFrom,
                     'start_epoch' : startEpoch,
                     'end_epoch' : endEpoch,
                     'place_id' : placeId,
@@ -56,6 +60,7 @@ function queryInfluenceCache(instance, startEpoch, endEpoch, sourcePlaceId, sour
 
 function PagedCacheQuery(pageElement, processDataFunc, type, instance, startEpoch, endEpoch, placeId, providerId, followee, projection) {
     var currentPage = 0;
+    var nextPosition = 'start';
     var isWaitingForLoad = false;
     var resetIsQueued = false;
     var dataCache = null;
@@ -63,6 +68,7 @@ function PagedCacheQuery(pageElement, processDataFunc, type, instance, startEpoc
     this.reset = function() {
         resetIsQueued = true;
         currentPage = 0;
+        nextPosition = 'start';
         isWaitingForLoad = false;
     };
 
@@ -92,8 +98,11 @@ function PagedCacheQuery(pageElement, processDataFunc, type, instance, startEpoc
     };
 
     var onSuccess = function(data) {
+        var next = null;
+
         data = undefArg(data);
         if(data != null) {
+            next = undefArg(data['next']);
             data = data['json'];
         }
 
@@ -120,6 +129,9 @@ function PagedCacheQuery(pageElement, processDataFunc, type, instance, startEpoc
         }
 
         currentPage++;
+        if(next != null) {
+            nextPosition = next;
+        }
         isWaitingForLoad = false;
 
         processDataFunc(data, pageElement);
@@ -145,7 +157,7 @@ function PagedCacheQuery(pageElement, processDataFunc, type, instance, startEpoc
     this.loadNextPage = function() {
         if(!isWaitingForLoad) {
             isWaitingForLoad = true;
-            queryCache(type, instance, startEpoch, endEpoch, placeId, providerId, followee, currentPage, onSuccess, onFailure, null, projection);
+            queryCache(type, instance, startEpoch, endEpoch, placeId, providerId, followee, currentPage, onSuccess, onFailure, null, projection, nextPosition);
         }
     };
 }
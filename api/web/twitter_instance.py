@@ -3,9 +3,10 @@ import logging
 from threading import RLock
 import time
 from api.caching.instance_codes import consumeCode, unconsumeCode
-from api.caching.instance_lifetime import removeInstance, addInstance, setInstanceTemporalSourceLastTime
-from api.caching.temporal_analytics import getTemporalInfluenceCollection, addTemporalEntry
-from api.caching.tweet_user import getUserCollection, getTweetCollection
+from api.caching.instance_lifetime import removeInstance, addInstance, temporalSourceLastTimeCheckpoints
+from api.caching.temporal_analytics import dropTemporalInfluenceCollection, addTemporalEntry, temporalInfluenceAggregator
+from api.caching.tweet_user import dropUserCollection, dropTweetCollection, discardPendingWrites
+from api.caching.tweet_counts import dropTweetCountCollection
 from api.config import Configuration
 from api.core.data_structures.timestamp import Timestamped
 from api.core.threads import startTwitterThread
@@ -237,20 +238,28 @@ class TwitterInstance(Timestamped):
             # collection is made again.
             time.sleep(1.5)
 
+            logger.info('Discarding pending writes on instance %s..' % instanceKey)
+            discardPendingWrites(instanceKey)
+
             logger.info('Dropping twitter user data on instance %s..' % instanceKey)
-            getUserCollection(instanceKey).drop()
+            dropUserCollection(instanceKey)
 
             logger.info('Dropping twitter tweet data on instance %s..' % instanceKey)
-            getTweetCollection(instanceKey).drop()
+            dropTweetCollection(instanceKey)
+
+            logger.info('Dropping twitter tweet counts on instance %s..' % instanceKey)
+            dropTweetCountCollection(instanceKey)
 
             logger.info('Dropping twitter temporal influence data on instance %s..' % instanceKey)
-            getTemporalInfluenceCollection(instanceKey).drop()
+            temporalInfluenceAggregator.discardCollection('influence_%s' % instanceKey)
+            dropTemporalInfluenceCollection(instanceKey)
 
             if self.instance_setup_code is not None:
                 logger.info('Returning instance setup code %s on instance %s..' % (instanceKey, self.instance_setup_code))
                 unconsumeCode(self.instance_setup_code)
 
             logger.info('Removing instance from instance %s lifetime collection..' % instanceKey)
+            temporalSourceLastTimeCheckpoints.discardInstance(self.instance_key)
             removeInstance(instanceKey)
 
             logger.info('Instance %s cleaned up successfully' % instanceKey)
@@ -264,10 +273,14 @@ class TwitterInstance(Timestamped):
         lastTimeId = self.last_temporal_time_id_by_source.get(tupleUserCacheId,None)
 
         destination = '%s_%s' % (followerPlaceType, followerPlaceId)
-        addTemporalEntry(temporalCollection, lastTimeId, timeId, dictUserCacheId, destination, followerProviderId)
+        if Configuration.TEMPORAL_AGGREGATOR_ENABLED:
+            temporalInfluenceAggregator.addTemporalEntry(temporalCollection, lastTimeId, timeId, dictUserCacheId, destination, followerProviderId)
+        else:
+            addTemporalEntry(temporalCollection, lastTimeId, timeId, dictUserCacheId, destination, followerProviderId)
 
-        self.last_temporal_time_id_by_source[tupleUserCacheId] = timeId
-        setInstanceTemporalSourceLastTime(self.instance_key, userProviderId, userPlaceId, timeId)
+        if lastTimeId != timeId:
+            self.last_temporal_time_id_by_source[tupleUserCacheId] = timeId
+            temporalSourceLastTimeCheckpoints.set(self.instance_key, userProviderId, userPlaceId, timeId)
 
 
 
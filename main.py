@@ -6,6 +6,7 @@ if __name__ == '__main__':
     import datetime
     import os
     import logging
+    import signal
     import sys
     from logging import config
     import bottle
@@ -53,11 +54,41 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Use with caution as it will lock up database until completed. Rebuilds indexes on instance collections.')
 
+    parser.add_argument('--build_instance_indexes',
+                        default=False,
+                        action='store_true',
+                        help='The server does not run as normal, it will create indexes on all existing instance collections and then exit. '
+                             'Indexes are built in the background if MONGO_BUILD_INDEXES_IN_BACKGROUND is set.')
+
     parser.add_argument('--view_profiling_info',
                         default=False,
                         action='store_true',
                         help='If profiling is enabled in configuration the server logs MongoDB performance. Use this to retrieve the logged data.')
 
+    parser.add_argument('--profiling_report',
+                        default=False,
+                        action='store_true',
+                        help='The server does not run as normal, it will summarise MongoDB performance logged while profiling was enabled, '
+                             'grouped by collection and query shape, and then exit. Queries of tweets and users not using expected indexes are flagged.')
+
+    parser.add_argument('--compact_instance_data',
+                        default=False,
+                        action='store_true',
+                        help='The server does not run as normal, it will convert tweets and users of all existing instance collections '
+                             'to compact storage and then exit. COMPACT_STORAGE_ENABLED must be set.')
+
+    parser.add_argument('--rebuild_tweet_counts',
+                        default=False,
+                        action='store_true',
+                        help='The server does not run as normal, it will count the tweets of all existing instances again, '
+                             'replacing their tweet count rollups, and then exit. Use this for tweets written before counts were kept.')
+
+    parser.add_argument('--benchmark_export',
+                        metavar='instance',
+                        default=None,
+                        help='The server does not run as normal, it will export all data of the instance with each bulk download output type, '
+                             'with and without constructing objects, and show time taken by each.')
+
     parser._parse_known_args(sys.argv[1:], argparse.Namespace())
     args = parser.parse_args()
 
@@ -81,17 +112,21 @@ if __name__ == '__main__':
     loadConfigFromFile(configParser)
 
     from api.core.utility import parseInteger, Timer
-    from api.caching.instance_lifetime import getInstances
-    from api.core.threads_core import BaseThread
+    from api.caching.instance_lifetime import getInstances, temporalSourceLastTimeCheckpoints
+    from api.core.threads_core import BaseThread, registerShutdownFunc, runShutdownFuncs
     from api.web.twitter_instance import TwitterInstance
     from api.caching.instance_codes import resetCodeConsumerCounts, getInstanceCodeCollection, getCode
-    from api.config import Configuration
-    from api.caching.caching_shared import getCollections, getCollection, getDatabase
-    from api.caching.temporal_analytics import isTemporalInfluenceCollection
-    from api.caching.tweet_user import isUserCollection, isTweetCollection, getUserCollection, getTweetCollection
+    from api.config import Configuration, GE_GAZETTEER
+    from api.caching.caching_shared import getCollections, getCollection, getDatabase, createCollectionIndexes, createAllCollectionIndexes
+    from api.caching.temporal_analytics import isTemporalInfluenceCollection, getTemporalInfluenceCollection, reconcileTemporalSourceLastTimes, temporalInfluenceAggregator
+    from api.caching.tweet_counts import isTweetCountCollection, getTweetCountCollection, checkTweetCountsComplete
+    from api.caching.tweet_user import isUserCollection, isTweetCollection, getUserCollection, getTweetCollectionsInRange, flushPendingWrites
     from api.geocode.geocode_shared import GeocodeResultAbstract
+    from api.geocode.geocode_gazetteer import initializeGazetteerFromFile
+    from api.geocode.geocode_cached import loadSpatialIndexFromCache, warmGeocodeCaches, saveGeocodeCacheSnapshot, flushGeocodeQueryHits, openSharedGeocodeCache, closeSharedGeocodeCache
     from api.core import threads
-    from api.twitter.feed import UserAnalysisFollowersGeocoded, TwitterAuthentication
+    from api.twitter.feed import UserAnalysisFollowersGeocoded, TwitterAuthentication, UserGeocodeConfig
+    from api.twitter.geocode_process import GeocodeProcessPool
     from api.twitter.flow.display_instance_setup import GateInstance, StartInstancePost, ManageInstancePost
     from api.twitter.flow.display_oauth import OAuthSignIn, OAuthCallback
     from api.web import web_core
@@ -121,6 +156,26 @@ if __name__ == '__main__':
 
     GeocodeResultAbstract.initializeCountryContinentDataFromCsv()
 
+    # Loaded before geocode processes are forked so that they share its memory.
+    if Configuration.GEOCODE_EXTERNAL_PROVIDER == GE_GAZETTEER:
+        initializeGazetteerFromFile()
+
+    if Configuration.REVERSE_GEOCODE_ENABLED:
+        loadSpatialIndexFromCache(Configuration.GEOCODE_EXTERNAL_PROVIDER)
+
+    # This process owns the shared geocode cache, it is created before warming up
+    # so that what is loaded is shared, and before geocode processes open it.
+    if Configuration.GEOCODE_SHARED_CACHE_ENABLED:
+        openSharedGeocodeCache(True)
+
+    warmGeocodeCaches(Configuration.GEOCODE_EXTERNAL_PROVIDER)
+
+    # Child processes are forked here, before any of our threads exist.
+    if Configuration.GEOCODE_FROM_CACHE_PROCESS_MODE_ENABLED:
+        geocodeProcessPool = GeocodeProcessPool(UserGeocodeConfig(Configuration.GEOCODE_EXTERNAL_PROVIDER), Configuration.GEOCODE_FROM_CACHE_NUM_PROCESSES)
+    else:
+        geocodeProcessPool = None
+
     dataCollection = DataCollection()
     webApplication = WebApplicationTwitter(None, Configuration.MAX_INSTANCE_INACTIVE_TIME_MS, dataCollection)
 
@@ -159,7 +214,8 @@ if __name__ == '__main__':
                                               tweetsByLocationWebSocketGroup,
                                               userInformationWebSocketGroup,
                                               realtimePerformance],
-                                     userAnalysers=userAnalysers)
+                                     userAnalysers=userAnalysers,
+                                     geocodeProcessPool=geocodeProcessPool)
 
     tweetQueue = resultDic['tweet_queue']
     followerExtractorGateThread = resultDic['follower_extractor_gate_thread']
@@ -235,6 +291,61 @@ if __name__ == '__main__':
         f.flush()
         sys.exit(0)
 
+    if args.build_instance_indexes:
+        print 'Running in build instance indexes mode'
+
+        count = createAllCollectionIndexes()
+
+        print 'Finished building indexes on %d collections!' % count
+        sys.exit(0)
+
+    if args.compact_instance_data:
+        print 'Running in compact instance data mode'
+
+        from api.caching.compact_storage import compactCollection, tweetStorageSchema, userStorageSchema
+        if tweetStorageSchema is None or userStorageSchema is None:
+            print 'COMPACT_STORAGE_ENABLED is not set, nothing to do'
+            sys.exit(0)
+
+        count = 0
+        for collectionName in getCollections():
+            if isTweetCollection(collectionName):
+                count += compactCollection(getCollection(collectionName), tweetStorageSchema)
+            elif isUserCollection(collectionName):
+                count += compactCollection(getCollection(collectionName), userStorageSchema)
+
+        print 'Finished compacting %d documents!' % count
+        sys.exit(0)
+
+    if args.rebuild_tweet_counts:
+        print 'Running in rebuild tweet counts mode'
+
+        from api.caching.tweet_counts import rebuildTweetCountsFromCache
+        count = [0]
+        def onInstanceLoadFunc(instanceKey, *instanceData):
+            count[0] += rebuildTweetCountsFromCache(instanceKey, getTweetCollectionsInRange(instanceKey))
+
+        getInstances(onInstanceLoadFunc)
+
+        print 'Finished counting %d tweets!' % count[0]
+        sys.exit(0)
+
+    if args.benchmark_export is not None:
+        print 'Running in benchmark export mode'
+
+        from api.twitter.flow.data_export import benchmarkExport
+        for outputType in (1, 2, 3):
+            results = benchmarkExport(args.benchmark_export, outputType)
+            print 'Output type %d: %d rows (%d bytes), with objects %dms, without objects %dms, %d rows different' % (outputType,
+                                                                                                                     results['num_rows'],
+                                                                                                                     results['num_bytes'],
+                                                                                                                     results['object_time_ms'],
+                                                                                                                     results['raw_time_ms'],
+                                                                                                                     results['num_rows_different'])
+
+        print 'Finished!'
+        sys.exit(0)
+
     if args.view_profiling_info:
         print 'Running profiling mode'
 
@@ -253,6 +364,16 @@ if __name__ == '__main__':
         print 'Finished!'
         sys.exit(0)
 
+    if args.profiling_report:
+        print 'Running in profiling report mode'
+
+        from api.caching.profiling_report import readProfilingReport, formatProfilingReport
+        for line in formatProfilingReport(readProfilingReport()):
+            print line
+
+        print 'Finished!'
+        sys.exit(0)
+
     if args.wipe_instance_data:
         collections = getCollections()
         logger.info('Collections before startup clean: %s' % unicode(collections))
@@ -261,6 +382,7 @@ if __name__ == '__main__':
             if isTemporalInfluenceCollection(collection) or \
                     isUserCollection(collection) or \
                     isTweetCollection(collection) or \
+                    isTweetCountCollection(collection) or \
                             collection == 'twitter_place' or collection == 'instance_lifetime':
                 logger.info('Dropping collection %s' % collection)
                 getCollection(collection).drop()
@@ -289,6 +411,9 @@ if __name__ == '__main__':
                      temporal[GeocodeResultAbstract.buildCacheIdTuple(providerId, placeId)] = timeId
                      logger.debug('Loaded instance %s last temporal change source %d/%d -> %d' % (instanceKey, providerId, placeId, timeId))
 
+             # Checkpoints are written periodically so may be behind.
+             temporal = reconcileTemporalSourceLastTimes(getTemporalInfluenceCollection(instanceKey), temporal)
+
              TwitterInstance(instanceKey,
                              webApplication.twitter_instances,
                              TwitterAuthentication(Configuration.CONSUMER_TOKEN, Configuration.CONSUMER_SECRET, oauthToken, oauthSecret),
@@ -302,11 +427,14 @@ if __name__ == '__main__':
                              # then maybe our server lost network connectivity.
                              isCritical = True)
 
-             # can delete, was debugging indexes.
+             if Configuration.TWEET_COUNT_ROLLUP_ENABLED:
+                checkTweetCountsComplete(instanceKey, getTweetCollectionsInRange(instanceKey))
+
              if args.rebuild_instance_indexes:
-                logger.info('Dropping indexes of instance %s' % instanceKey)
-                getUserCollection(instanceKey).drop_indexes()
-                getTweetCollection(instanceKey).drop_indexes()
+                logger.info('Rebuilding indexes of instance %s' % instanceKey)
+                for collection in [getUserCollection(instanceKey), getTemporalInfluenceCollection(instanceKey), getTweetCountCollection(instanceKey)] + getTweetCollectionsInRange(instanceKey):
+                    collection.drop_indexes()
+                    createCollectionIndexes(collection.name)
              count[0] += 1
 
         getInstances(onInstanceLoadFunc)
@@ -322,8 +450,30 @@ if __name__ == '__main__':
         def _run(self):
             web_core.startServer(Configuration.LISTEN_IP, Configuration.LISTEN_PORT, webApplication.bottle_app)
 
+    # Called however we exit, including when a critical thread fails.
+    registerShutdownFunc(flushPendingWrites, 'writing pending tweets and users')
+
+    if Configuration.TEMPORAL_AGGREGATOR_ENABLED:
+        registerShutdownFunc(temporalInfluenceAggregator.flush, 'writing temporal influence data')
+
+    registerShutdownFunc(temporalSourceLastTimeCheckpoints.flush, 'writing temporal checkpoints')
+
+    if geocodeProcessPool is not None:
+        registerShutdownFunc(geocodeProcessPool.stop, 'stopping geocode processes')
+    registerShutdownFunc(flushGeocodeQueryHits, 'writing geocode query hits')
+    registerShutdownFunc(saveGeocodeCacheSnapshot, 'writing geocode cache snapshot')
+    registerShutdownFunc(lambda: closeSharedGeocodeCache(True), 'removing shared geocode cache')
+
+    # Stop in the same way as Ctrl+C.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
     # Start server and only exit application when it terminates.
     webServer = WebServerThread()
     webServer.start()
 
-    webServer.join()
\ No newline at end of file
+    try:
+        webServer.join()
+    except KeyboardInterrupt:
+        logger.critical('SERVER INTERRUPTED')
+    finally:
+        runShutdownFuncs()
\ No newline at end of file